@@ -1,43 +1,44 @@
 import xively
+import xively.pipeline
 import datetime
 import sys
-import time
 import xml.etree.ElementTree as etree
 
 XIVELY_API_KEY = "YOUR_API_KEY"
 XIVELY_FEED_ID = 12345
 
 
-def read_data(stream):
-    for data in stream:
+class CurrentCostParser(xively.pipeline.Parser):
+    """Parses the XML messages sent by a CurrentCost meter."""
+
+    def parse(self, data):
         if data == '\n':
-            continue
+            return []
         try:
             msg = etree.fromstring(data)
-        except ET.ParseError:
+        except etree.ParseError:
             print("Error parsing data: '{}'".format(data), end='',
                   file=sys.stderr)
-            continue
+            return []
         date = msg.find('./date')
         hr = int(date.findtext('./hr'))
         min = int(date.findtext('./min'))
         sec = int(date.findtext('./sec'))
         watts = int(msg.findtext('.//watts'))
         tmpr = float(msg.findtext('./tmpr'))
-        yield datetime.time(hr, min, sec), watts, tmpr
+        print(datetime.time(hr, min, sec), watts, tmpr)
+        return [('tmpr', tmpr), ('watts', watts)]
 
 
 def main(device='/dev/ttyUSB0'):
     api = xively.XivelyAPIClient(XIVELY_API_KEY)
     feed = api.feeds.get(XIVELY_FEED_ID)
-    for at, watts, tmpr in read_data(open(device, errors='ignore')):
-        now = datetime.datetime.utcnow()
-        feed.datastreams = [
-            xively.Datastream(id='tmpr', current_value=tmpr, at=now),
-            xively.Datastream(id='watts', current_value=watts, at=now),
-        ]
-        feed.update()
-        print(at, watts, tmpr)
+    pipeline = xively.pipeline.Pipeline(feed, open(device, errors='ignore'),
+                               CurrentCostParser(), flush_interval=5)
+    try:
+        pipeline.run()
+    finally:
+        pipeline.stop()
 
 
 if __name__ == '__main__':
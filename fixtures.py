@@ -644,6 +644,10 @@ def handle_request(method, url, params=None, *args, **kwargs):
         response.headers['Location'] = url + '/7021'
     elif relative_url == 'feeds/7021':
         content = GET_FEED_JSON
+    elif relative_url == 'feeds/3819':
+        content = MOBILE_FEED_JSON
+    elif relative_url == 'feeds/61916':
+        content = HISTORY_FEED_JSON
     elif relative_url == 'triggers':
         response.headers['location'] = url + '/3'
     elif relative_url == 'feeds/7021/datastreams/':
@@ -653,6 +657,8 @@ def handle_request(method, url, params=None, *args, **kwargs):
         '''.format(GET_DATASTREAM_JSON)
     elif relative_url == 'feeds/7021/datastreams/random5':
         content = HISTORY_DATASTREAM_JSON
+    elif relative_url.startswith('feeds/7021/datastreams/'):
+        content = HISTORY_DATASTREAM_JSON
     elif relative_url == 'keys':
         response.headers['Location'] = (
             url + '1nAYR5W8jUqiZJXIMwu3923Qfuq_lnFCDOKtf3kyw4g')
@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 try:
     from io import BytesIO
@@ -12,10 +21,38 @@ except TypeError:
 
 import requests
 
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue  # NOQA
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
 from mock import Mock, call, patch
 
 import xively
 import xively.api
+import xively.cache
+import xively.export
+import xively.geo
+import xively.journal
+import xively.payload
+import xively.pipeline
+import xively.scheduler
+import xively.uploader
 import fixtures
 
 
@@ -79,6 +116,44 @@ class BaseTestCase(RequestsFixtureMixin, unittest.TestCase):
         return json.dumps(json.loads(s.decode('utf8')), sort_keys=True)
 
 
+@unittest.skipIf(sys.version_info < (3, 7), "needs module __getattr__")
+class ImportTest(unittest.TestCase):
+
+    # Most microseconds `import xively` may take, requests alone takes more.
+    budget = 50000
+
+    def _run(self, *args):
+        output = subprocess.check_output(
+            (sys.executable,) + args, stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode('utf-8')
+
+    def test_import_is_lazy(self):
+        output = self._run('-c', (
+            "import sys, xively; "
+            "print(sorted(m for m in ('requests', 'xively.client', "
+            "'xively.managers', 'xively.models') if m in sys.modules))"))
+        self.assertEqual(output.strip(), "[]")
+
+    def test_names_are_loaded_on_access(self):
+        output = self._run('-c', (
+            "import sys, xively; xively.Feed; "
+            "print('xively.models' in sys.modules, 'requests' in sys.modules)"))
+        self.assertEqual(output.strip(), "True False")
+        self.assertIs(xively.Feed, xively.models.Feed)
+        self.assertRaises(AttributeError, getattr, xively, 'Missing')
+
+    def test_import_time(self):
+        output = self._run('-X', 'importtime', '-c', "import xively")
+        for line in output.splitlines():
+            fields = [field.strip() for field in line.split('|')]
+            if fields[-1] == 'xively':
+                self.assertLess(int(fields[1]), self.budget)
+                break
+        else:
+            self.fail("no import time reported for xively")
+
+
 class KeyAuthTest(unittest.TestCase):
     """
     Key based authentication tests.
@@ -113,6 +188,73 @@ class ClientTest(BaseTestCase):
         client.request('GET', "http://example.com")
         self.request.assert_called_with('GET', "http://example.com")
 
+    def test_coalesce_identical_gets(self):
+        """Tests identical GETs in flight at once share one request."""
+        self.client.coalesce_requests = True
+        release = threading.Event()
+
+        def handle_request(*args, **kwargs):
+            release.wait()
+            response = requests.Response()
+            response.status_code = 200
+            response._content = fixtures.GET_FEED_JSON
+            return response
+        self.request.side_effect = handle_request
+        feeds = []
+        threads = [threading.Thread(target=lambda: feeds.append(self.api.feeds.get(7021)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.request.call_count, 1)
+        self.assertEqual(len(set(id(feed) for feed in feeds)), 8)
+        self.assertEqual(len(set(id(feed.datastreams[0]) for feed in feeds)), 8)
+        self.assertEqual(self.client._in_flight, {})
+
+    def test_coalesce_disabled_by_default(self):
+        self.assertFalse(self.client.coalesce_requests)
+        self.client.get('/v2/feeds/7021', params={'show_user': True})
+        self.request.assert_called_with(
+            'GET', 'http://api.xively.com/v2/feeds/7021',
+            allow_redirects=True, params={'show_user': True})
+
+    def test_chunked_uploads(self):
+        """Tests data is sent as a stream of JSON chunks when enabled."""
+        self.client.chunked_uploads = True
+        feed = self._create_feed(
+            id='1977', title="Office",
+            datastreams=[xively.Datastream(id=str(i), current_value=i)
+                         for i in range(1000)])
+        feed.update()
+        data = self.request.call_args[1]['data']
+        self.assertFalse(isinstance(data, (bytes, str)))
+        chunks = list(data)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(b''.join(chunks).decode('utf8'),
+                         self.client._encode_data(feed))
+
+    def test_chunked_uploads_match_encoded_data(self):
+        """Tests chunked data is encoded exactly like data sent whole."""
+        values = [{True: 1, False: 2}, {None: 3}, {1: 4, 2: 5},
+                  {2.5: 6, float('inf'): 7}, {"a": [{"b": datetime(2013, 1, 1)}]},
+                  "text", 42, None]
+        for value in values:
+            self.client.chunked_uploads = False
+            self.client.post('/v2/feeds', data=value)
+            expected = self.request.call_args[1]['data']
+            self.client.chunked_uploads = True
+            self.client.post('/v2/feeds', data=value)
+            data = self.request.call_args[1]['data']
+            if isinstance(value, dict):
+                data = b''.join(data).decode('utf8')
+            self.assertEqual(data, expected)
+        self.assertEqual(expected, 'null')
+        self.assertEqual(self.client._encode_data({True: 1, False: 2}),
+                         '{"false": 2, "true": 1}')
+
     def test_serialise_data(self):
         """Tests data is serialised using __getstate__ when requested."""
         class TestObject:
@@ -129,6 +271,224 @@ class ClientTest(BaseTestCase):
                 sort_keys=True))
 
 
+class SerializerTest(BaseTestCase):
+
+    def _assertSameJSON(self, obj, **kwargs):
+        """Checks the serializer gives the stdlib encoder's output."""
+        encoder = xively.client.JSONEncoder(**kwargs)
+        expected = json.JSONEncoder.encode(encoder, obj)
+        self.assertEqual(encoder.encode(obj), expected)
+        # Encoding again uses the encoders found the first time.
+        self.assertEqual(encoder.encode(obj), expected)
+
+    def _feed(self):
+        at = datetime(2013, 1, 1, 12)
+        datastreams = [
+            xively.Datastream(
+                id='temperature', current_value=21.5, at=at, tags=['a'],
+                unit=xively.Unit(label='Celsius', symbol=u'\xb0C'),
+                datapoints=[xively.Datapoint(at, '21.5'),
+                            xively.Datapoint(at, 22.0),
+                            xively.Datapoint('2013-01-01T12:00:01Z', None),
+                            xively.Datapoint(at, float('nan')),
+                            xively.Datapoint(at, True)]),
+            xively.Datastream(id='empty', min_value=0, max_value=10),
+        ]
+        feed = xively.Feed(title=u'Caf\xe9 "Office"', private=False,
+                           location=xively.Location(lat=51.5, lon=-0.1),
+                           datastreams=datastreams)
+        return feed.__getstate__()
+
+    def test_models(self):
+        self._assertSameJSON(self._feed())
+        self._assertSameJSON(self._feed(), sort_keys=True)
+        self._assertSameJSON([xively.Datastream(id=str(i), current_value=i)
+                              for i in range(3)])
+
+    def test_values(self):
+        self._assertSameJSON({
+            'floats': [float('inf'), -float('inf'), 0.1, 1e100],
+            'ints': [0, -1, 2 ** 70, True, False],
+            'nested': {'%s': ({}, [], ()), u'\u20ac': None},
+            'date': datetime(2013, 1, 1, 12, 0, 0, 5),
+        }, sort_keys=True)
+        self._assertSameJSON({1: 'a', None: 'b', 2.5: 'c'})
+        self._assertSameJSON(u'\u2603')
+
+    def test_changed_fields(self):
+        datapoint = xively.Datapoint(datetime(2013, 1, 1), '1')
+        self._assertSameJSON(datapoint)
+        datapoint.value = None
+        self._assertSameJSON(datapoint)
+        datapoint.extra = 'field'
+        self._assertSameJSON(datapoint)
+
+    def test_lists_of_models(self):
+        at = datetime(2013, 1, 1)
+        moved = xively.Datapoint(at, '2')
+        moved._data = {'value': '2', 'at': at}
+        self._assertSameJSON([
+            xively.Datapoint(at, '1'), moved, xively.Datapoint(at, 3),
+            xively.Datapoint(at, None), xively.Unit(label='C'), 'text'])
+        self._assertSameJSON([xively.Datapoint(at, '1'), moved], sort_keys=True)
+
+    def test_overridden_getstate(self):
+        class Reading(xively.Datapoint):
+            def __getstate__(self):
+                return {'reading': self.value}
+        self._assertSameJSON([Reading(datetime(2013, 1, 1), 1)])
+
+    def test_fallbacks(self):
+        encoder = xively.client.JSONEncoder(indent=2)
+        self.assertEqual(encoder.encode({'a': xively.Unit(label='C')}),
+                         '{\n  "a": {\n    "label": "C"\n  }\n}')
+        circular = []
+        circular.append(circular)
+        self.assertRaises(ValueError, self.client._encode_data, circular)
+
+    def test_sort_keys_changed(self):
+        encoder = xively.client.JSONEncoder()
+        datapoint = xively.Datapoint('2013-01-01T00:00:00Z', '1')
+        datapoint.extra = True
+        self.assertEqual(
+            encoder.encode(datapoint),
+            '{"at": "2013-01-01T00:00:00Z", "value": "1", "extra": true}')
+        encoder.sort_keys = True
+        self.assertEqual(
+            encoder.encode(datapoint),
+            '{"at": "2013-01-01T00:00:00Z", "extra": true, "value": "1"}')
+
+
+class ThreadSafeClientTest(BaseTestCase):
+
+    def setUp(self):
+        super(ThreadSafeClientTest, self).setUp()
+        self.request.side_effect = fixtures.handle_request
+        self.api = xively.XivelyAPIClient("API_KEY", thread_safe=True)
+
+    def test_thread_sessions(self):
+        client = self.api.client
+        sessions = []
+        threads = [threading.Thread(
+            target=lambda: sessions.append(client.thread_session()))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(map(id, sessions))), 4)
+        self.assertIs(client.thread_session(), client.thread_session())
+        self.assertIs(sessions[0].headers, client.headers)
+        self.assertIs(sessions[0].auth, client.auth)
+        client.verify = False
+        self.assertFalse(client.thread_session().verify)
+        client.close()
+        self.assertEqual(client._sessions, [])
+
+    def test_stress(self):
+        """64 threads sharing one client make mixed calls."""
+        errors = []
+        done = []
+        start = datetime(2013, 1, 1, 14, 0, 0)
+        end = datetime(2013, 1, 1, 16, 0, 0)
+
+        def work(n):
+            try:
+                for i in range(10):
+                    feed = self.api.feeds.get(7021)
+                    assert feed.title == "Xively Office environment"
+                    if (n + i) % 2:
+                        feed.title = "Thread {}".format(n)
+                        feed.update()
+                    datastream = feed.datastreams[0]
+                    datapoints = list(datastream.datapoints.history(
+                        start=start, end=end))
+                    assert len(datapoints) == 8
+                done.append(n)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(64)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(done), list(range(64)))
+        # Creating a session closes those of the threads that exited.
+        self.api.client.thread_session()
+        self.assertEqual(len(self.api.client._sessions), 1)
+        self.assertLess(elapsed, 30)
+        puts = [c for c in self.request.call_args_list if c[0][0] == 'PUT']
+        self.assertEqual(len(puts), 64 * 5)
+
+
+class RoutingTest(BaseTestCase):
+
+    def setUp(self):
+        super(RoutingTest, self).setUp()
+        self.feed = self._create_feed(id=1977, title="Rother")
+        self.datastream = self.feed.datastreams._coerce_datastream({'id': '1'})
+
+    def test_urls(self):
+        self.assertEqual(self.api.feeds.url(7021), 'http://api.xively.com/v2/feeds/7021')
+        self.assertEqual(self.feed.datastreams.url('..'), 'http://api.xively.com/v2/feeds/1977/')
+        self.assertEqual(self.feed.datastreams.url('http://example.com/1'), 'http://example.com/1')
+        self.assertEqual(self.datastream.datapoints.url(),
+                         'http://api.xively.com/v2/feeds/1977/datastreams/1/datapoints')
+
+    def test_base_url_is_cached(self):
+        self.datastream.datapoints.url()
+        with patch.object(self.api.feeds, 'url') as feed_url:
+            self.datastream.datapoints.url()
+            self.datastream.datapoints.url('..')
+        self.assertFalse(feed_url.called)
+
+    def test_base_url_follows_parent_id(self):
+        self.datastream.datapoints.url()
+        self.feed.id = 2013
+        self.datastream.id = '2'
+        self.assertEqual(self.datastream.datapoints.url(),
+                         'http://api.xively.com/v2/feeds/2013/datastreams/2/datapoints')
+
+
+class RawPayloadTest(BaseTestCase):
+
+    def test_request_sends_raw_payload(self):
+        self.client.post('/v2/feeds', data=xively.payload.RawPayload(b'{"title": "Raw"}'))
+        self.assertEqual(self.request.call_args[0],
+                         ('POST', 'http://api.xively.com/v2/feeds'))
+        self.assertEqual(self.request.call_args[1]['data'], b'{"title": "Raw"}')
+        self.assertNotIn('headers', self.request.call_args[1])
+
+    def test_request_sets_content_type(self):
+        data = memoryview(b"0,123\r\n")
+        self.client.put('/v2/feeds/7021', data=xively.payload.RawPayload(data, 'text/csv'))
+        self.request.assert_called_with(
+            'PUT', 'http://api.xively.com/v2/feeds/7021', data=b"0,123\r\n",
+            headers={'Content-Type': 'text/csv'})
+
+    def test_update_feed_with_payload(self):
+        self.api.feeds.update(7021, payload=xively.payload.RawPayload(b'{"private": true}'))
+        self.request.assert_called_with(
+            'PUT', 'http://api.xively.com/v2/feeds/7021', data=b'{"private": true}')
+        self.assertRaises(ValueError, self.api.feeds.update, 7021,
+                          payload=xively.payload.RawPayload(b'{}'), private=True)
+
+    def test_create_datapoints_with_payload(self):
+        feed = self._create_feed(id=1977, title="Rother")
+        datastream = feed.datastreams._coerce_datastream({'id': '1'})
+        body = b'{"datapoints": [{"at": "2010-05-20T11:01:43Z", "value": "294"}]}'
+        self.assertEqual(datastream.datapoints.create(xively.payload.RawPayload(body)), None)
+        self.assertEqual(
+            self.request.call_args[0],
+            ('POST', 'http://api.xively.com/v2/feeds/1977/datastreams/1/datapoints'))
+        self.assertEqual(self.request.call_args[1]['data'], body)
+
+
 class FeedTest(BaseTestCase):
 
     def test_create_feed(self):
@@ -190,6 +550,73 @@ class FeedTest(BaseTestCase):
         self.assertEqual(feed.datastreams[0].current_value, 42)
 
 
+class ChangeTrackingTest(BaseTestCase):
+
+    def _get_feed(self):
+        self.response.raw = BytesIO(fixtures.GET_FEED_JSON)
+        return self.api.feeds.get(7021)
+
+    def test_update_fetched_feed_sends_changes(self):
+        feed = self._get_feed()
+        feed.title = "Renamed"
+        feed.update()
+        self.request.assert_called_with(
+            'PUT', 'http://api.xively.com/v2/feeds/7021',
+            data='{"title": "Renamed"}')
+
+    def test_update_fetched_feed_sends_changed_datastreams(self):
+        feed = self._get_feed()
+        feed.datastreams[1].current_value = "42"
+        feed.update()
+        self.request.assert_called_with(
+            'PUT', 'http://api.xively.com/v2/feeds/7021',
+            data='{"datastreams": [{"current_value": "42", "id": "4"}]}')
+
+    def test_update_fetched_feed_sends_whole_location(self):
+        feed = self._get_feed()
+        feed.location.name = "lab"
+        feed.update()
+        payload = json.loads(self.request.call_args[1]['data'])
+        self.assertEqual(list(payload), ['location'])
+        self.assertEqual(payload['location']['name'], "lab")
+        self.assertEqual(payload['location']['domain'], "physical")
+
+    def test_update_fetched_feed_sends_fields_changed_in_place(self):
+        feed = self._get_feed()
+        feed.tags.append("Tag3")
+        feed.update()
+        self.request.assert_called_with(
+            'PUT', 'http://api.xively.com/v2/feeds/7021',
+            data='{"tags": ["Tag1", "Tag2", "Tag3"]}')
+
+    def test_update_saves_changes(self):
+        feed = self._get_feed()
+        feed.private = True
+        feed.update()
+        self.request.reset_mock()
+        feed.update()
+        self.assertFalse(self.request.called)
+
+    def test_update_fetched_datastream_sends_changes(self):
+        feed = self._create_feed(id=7021, title="Rother")
+        self.response.raw = BytesIO(fixtures.GET_DATASTREAM_JSON)
+        datastream = feed.datastreams.get('1')
+        datastream.current_value = "42"
+        datastream.update()
+        self.request.assert_called_with(
+            'PUT', 'http://api.xively.com/v2/feeds/7021/datastreams/1',
+            data='{"current_value": "42", "id": "1"}')
+
+    def test_update_fetched_trigger_sends_changes(self):
+        self.response.raw = BytesIO(fixtures.GET_TRIGGER_JSON)
+        trigger = self.api.triggers.get(14)
+        trigger.threshold_value = "20.0"
+        trigger.update()
+        self.request.assert_called_with(
+            'PUT', 'http://api.xively.com/v2/triggers/14',
+            data='{"threshold_value": "20.0"}')
+
+
 class FeedsManagerTest(BaseTestCase):
 
     def test_create_feed(self):
@@ -305,9 +732,204 @@ class FeedsManagerTest(BaseTestCase):
                          datetime(2012, 6, 1, 12, 25, 5, 999502))
         self.assertEqual(feed.location.waypoints[0].lat, 24.9966)
         self.assertEqual(feed.location.waypoints[0].lon, 55.06608)
+        self.assertTrue(isinstance(feed.location.waypoints[0], xively.Waypoint))
+        feed.location.waypoints[0].lat = 25.0
+        self.assertEqual(feed.location.waypoints[0].lat, 25.0)
+        track = feed.location.track
+        self.assertEqual(len(track), 6)
+        self.assertEqual(track[0].lat, 25.0)
+
+    def test_mobile_feed_track(self):
+        self.response.raw = BytesIO(fixtures.MOBILE_FEED_JSON)
+        with patch.object(xively.managers.FeedsManager, '_coerce_waypoints') as coerce:
+            feed = self.api.feeds.get(3819, waypoints='track')
+        self.assertFalse(coerce.called)
+        track = feed.location.waypoints
+        self.assertTrue(isinstance(track, xively.geo.WaypointTrack))
+        self.assertIs(feed.location.track, track)
+        self.assertEqual(len(track), 6)
+        self.assertEqual(track[0].at, datetime(2012, 6, 1, 12, 25, 5, 999502))
+        self.assertFalse(feed._has_changed())
         self.assertEqual(feed.datastreams[2].unit.label, 'knots')
 
 
+class FeedHistoryTest(BaseTestCase):
+
+    def setUp(self):
+        super(FeedHistoryTest, self).setUp()
+        self.request.side_effect = self._history
+        self.histories = {
+            'a': [datetime(2013, 1, 1, 10, minute)
+                  for minute in range(0, 60, 5)],
+            'b': [datetime(2013, 1, 1, 10, 5), datetime(2013, 1, 1, 17)],
+        }
+
+    def _parse(self, value):
+        value = value.rstrip('Z')
+        if '.' not in value:
+            value += '.000000'
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+
+    def _datapoints(self, datastream_id, params):
+        start, end = self._parse(params['start']), self._parse(params['end'])
+        return [{'at': at.isoformat() + '.000000Z', 'value': str(at.minute)}
+                for at in self.histories[datastream_id]
+                if start <= at < end][:params['limit']]
+
+    def _history(self, method, url, params=None, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        path = url.replace('http://api.xively.com/v2/feeds/1977', '')
+        if path.startswith('/datastreams/'):
+            content = {'datapoints': self._datapoints(path[13:], params)}
+        else:
+            content = {'id': 1977, 'title': "Rother", 'datastreams': [
+                {'id': datastream_id,
+                 'datapoints': self._datapoints(datastream_id, params)}
+                for datastream_id in sorted(self.histories)]}
+        response._content = json.dumps(content).encode('utf-8')
+        return response
+
+    def test_history(self):
+        feed = self.api.feeds.history(
+            1977, datetime(2013, 1, 1, 10), datetime(2013, 1, 1, 22),
+            limit=4)
+        self.assertEqual([d.id for d in feed.datastreams], ['a', 'b'])
+        self.assertEqual([d.at for d in feed.datastreams['a'].datapoints],
+                         self.histories['a'])
+        self.assertEqual([d.at for d in feed.datastreams['b'].datapoints],
+                         self.histories['b'])
+        # A feed request per six hour window, then pages of 'a' only.
+        urls = [c[0][1] for c in self.request.call_args_list]
+        self.assertEqual(urls.count('http://api.xively.com/v2/feeds/1977'), 2)
+        self.assertEqual(
+            urls.count('http://api.xively.com/v2/feeds/1977/datastreams/a'),
+            3)
+        self.assertEqual(len(urls), 5)
+        self.assertFalse(feed._has_changed())
+
+    def test_history_empty_range(self):
+        at = datetime(2013, 1, 1, 10)
+        self.assertRaises(ValueError, self.api.feeds.history, 1977, at, at)
+        self.assertFalse(self.request.called)
+
+
+class SubscriptionTest(BaseTestCase):
+
+    def setUp(self):
+        super(SubscriptionTest, self).setUp()
+        self.changes = []
+        self.subscription = xively.subscriptions.Subscription(
+            self.api.feeds, [7021], lambda feed, datastreams: self.changes.append(
+                [d.id for d in datastreams]),
+            min_interval=1, max_interval=60, frozen_interval=600)
+
+    def _poll(self, datastreams, status='live'):
+        self.response._content = json.dumps({
+            'id': 7021, 'title': "Office", 'status': status,
+            'datastreams': datastreams,
+        }).encode('utf8')
+        return self.subscription.poll(7021)
+
+    def test_only_changes_delivered(self):
+        self._poll([{'id': "1", 'current_value': "1"}, {'id': "2", 'current_value': "2"}])
+        self._poll([{'id': "1", 'current_value': "1"}, {'id': "2", 'current_value': "3"}])
+        self._poll([{'id': "1", 'current_value': "1"}, {'id': "2", 'current_value': "3"}])
+        self.assertEqual(self.changes, [["1", "2"], ["2"]])
+
+    def test_interval_backs_off_without_changes(self):
+        self._poll([{'id': "1", 'current_value': "1"}])
+        interval = self.subscription.interval(7021)
+        self._poll([{'id': "1", 'current_value': "1"}])
+        self.assertTrue(self.subscription.interval(7021) > interval)
+
+    def test_frozen_feed_interval(self):
+        self._poll([{'id': "1", 'current_value': "1"}], status='frozen')
+        self.assertEqual(self.subscription.interval(7021), 600)
+
+    def test_callback_error_is_recorded_and_feed_rescheduled(self):
+        error = ValueError("callback failed")
+
+        def callback(feed, datastreams):
+            raise error
+        self.subscription.callback = callback
+        self.subscription._schedule = []
+        self._poll([{'id': "1", 'current_value': "1"}])
+        self.assertEqual(list(self.subscription.errors), [(7021, error)])
+        self.assertEqual([feed_id for _, feed_id in self.subscription._schedule], [7021])
+
+    def test_errors_are_bounded(self):
+        self.subscription = xively.subscriptions.Subscription(
+            self.api.feeds, [7021], None, max_errors=2)
+        self.request.side_effect = [ValueError(n) for n in range(3)]
+        for _ in range(3):
+            self.subscription.poll(7021)
+        self.assertEqual([str(e) for _, e in self.subscription.errors],
+                         ["1", "2"])
+
+    def test_subscribe_polls_in_background(self):
+        polled = threading.Event()
+        self.response._content = fixtures.GET_FEED_JSON
+        subscription = self.api.feeds.subscribe(
+            [7021], lambda feed, datastreams: polled.set())
+        self.assertTrue(polled.wait(5))
+        subscription.cancel()
+
+
+class PipelineTest(BaseTestCase):
+
+    def setUp(self):
+        super(PipelineTest, self).setUp()
+        self.feed = self._create_feed(id=1977, title="Rother")
+
+    def _parse(self, line):
+        datastream_id, value = line.split('=')
+        return [(datastream_id, value, datetime(2013, 1, 1, 0, 0, int(value)))]
+
+    def test_keep_latest(self):
+        pipeline = xively.pipeline.Pipeline(self.feed, ["a=1", "b=2", "a=3"], self._parse)
+        pipeline.run()
+        self.assertEqual(self.request.call_count, 1)
+        payload = json.loads(self.request.call_args[1]['data'])
+        self.assertEqual(payload, {'datastreams': [
+            {'id': "a", 'current_value': "3", 'at': "2013-01-01T00:00:03Z"},
+            {'id': "b", 'current_value': "2", 'at': "2013-01-01T00:00:02Z"},
+        ]})
+
+    def test_keep_all(self):
+        pipeline = xively.pipeline.Pipeline(self.feed, ["a=1", "a=3"], self._parse, keep='all')
+        pipeline.run()
+        payload = json.loads(self.request.call_args[1]['data'])
+        self.assertEqual(payload['datastreams'][0]['datapoints'], [
+            {'at': "2013-01-01T00:00:01Z", 'value': "1"},
+            {'at': "2013-01-01T00:00:03Z", 'value': "3"},
+        ])
+
+    def test_parse_errors_are_skipped(self):
+        pipeline = xively.pipeline.Pipeline(self.feed, ["a=1", "garbled", "a=2"], self._parse)
+        pipeline.run()
+        self.assertEqual((pipeline.read, pipeline.parse_errors), (2, 1))
+        payload = json.loads(self.request.call_args[1]['data'])
+        self.assertEqual(payload['datastreams'][0]['current_value'], "2")
+
+    def test_failed_upload_is_retried(self):
+        pipeline = xively.pipeline.Pipeline(self.feed, [], self._parse)
+        pipeline._pending = {'a': [(datetime(2013, 1, 1), "1")]}
+        self.request.side_effect = requests.ConnectionError()
+        pipeline.flush()
+        self.assertEqual(len(pipeline.errors), 1)
+        self.request.side_effect = None
+        pipeline.flush()
+        self.assertEqual(pipeline.uploads, 1)
+        self.assertEqual(pipeline._pending, {})
+
+    def test_full_queue_drops_readings(self):
+        pipeline = xively.pipeline.Pipeline(self.feed, [], self._parse, queue_size=1)
+        pipeline._put(("a", "1"))
+        pipeline._put(("a", "2"))
+        self.assertEqual((pipeline.read, pipeline.dropped), (1, 1))
+
+
 class DatastreamTest(BaseTestCase):
 
     def setUp(self):
@@ -357,6 +979,19 @@ class DatastreamTest(BaseTestCase):
             'PUT', 'http://api.xively.com/v2/feeds/7021/datastreams/energy',
             data='{"current_value": 294}')
 
+    def test_get_datastream_typed(self):
+        self.response.raw = BytesIO(fixtures.HISTORY_DATASTREAM_JSON)
+        datastream = self.feed.datastreams.get(
+            'random5',
+            start=datetime(2013, 1, 1, 14, 0, 0),
+            end=datetime(2013, 1, 1, 16, 0, 0),
+            typed=True)
+        self.assertEqual(datastream.current_value, 0.00334173)
+        self.assertEqual(
+            (datastream.min_value, datastream.max_value), (0.0, 1.0))
+        self.assertEqual(datastream.datapoints[0].value, 0.2574197)
+        self.assertFalse(datastream._has_changed())
+
     def test_delete_datastream(self):
         datastream = self._create_datastream(id="energy")
         datastream.delete()
@@ -370,6 +1005,36 @@ class DatastreamsManagerTest(BaseTestCase):
         super(DatastreamsManagerTest, self).setUp()
         self.feed = self._create_feed(id=7021, title="Rother")
 
+    def test_indexes(self):
+        self.feed.datastreams = [
+            xively.Datastream(id="flow", tags=["water", "river"],
+                              unit=xively.Unit(label="litres")),
+            xively.Datastream(id="level", tags=["river"]),
+            {'id': "rain", 'tags': ["water"], 'unit': {'label': "mm"}},
+        ]
+        datastreams = self.feed.datastreams
+        self.assertIs(datastreams["flow"], datastreams[0])
+        self.assertRaises(KeyError, lambda: datastreams["temp"])
+        self.assertEqual([d.id for d in datastreams.by_tag("river")],
+                         ["flow", "level"])
+        self.assertEqual(len(datastreams.by_tag("water")), 2)
+        self.assertEqual(datastreams.by_tag("sea"), [])
+        self.assertEqual(datastreams.by_unit("mm")[0].id, "rain")
+        self.assertIn("level", datastreams)
+        self.assertIn(datastreams[1], datastreams)
+        self.assertNotIn(xively.Datastream(id="level"), datastreams)
+        self.assertNotIn("temp", datastreams)
+
+    def test_indexes_follow_changes(self):
+        self.feed.datastreams = [xively.Datastream(id="flow")]
+        self.assertNotIn("level", self.feed.datastreams)
+        self.feed.datastreams._datastreams.append(
+            xively.Datastream(id="level"))
+        self.assertIn("level", self.feed.datastreams)
+        self.feed.datastreams = [xively.Datastream(id="rain")]
+        self.assertEqual(list(self.feed.datastreams._indexes()['id']),
+                         ["rain"])
+
     def test_create_datastream(self):
         datastream = self.feed.datastreams.create(
             id="flow",
@@ -559,6 +1224,49 @@ class DatapointsManagerTest(BaseTestCase):
                          datetime(2013, 1, 1, 14, 14, 55, 118845))
         self.assertEqual(datapoints[0].value, "0.25741970")
 
+    def test_datapoint_history_typed(self):
+        self.response.raw = BytesIO(
+            b'{"datapoints": ['
+            b'{"at": "2013-01-01T14:14:55.000000Z", "value": "1.5"}, '
+            b'{"at": "2013-01-01T14:29:55.000000Z", "value": "off"}, '
+            b'{"at": "2013-01-01T14:44:55.000000Z", "value": "-2"}]}')
+        datapoints = list(self.datastream.datapoints.history(
+            start=datetime(2013, 1, 1, 14, 0, 0),
+            end=datetime(2013, 1, 1, 16, 0, 0),
+            typed=True))
+        self.assertEqual([d.value for d in datapoints], [1.5, "off", -2.0])
+
+    def test_datapoint_history_arrays(self):
+        self.response.raw = BytesIO(
+            b'{"datapoints": ['
+            b'{"at": "2013-01-01T14:14:55.000000Z", "value": "1.5"}, '
+            b'{"at": "2013-01-01T14:29:55.000000Z", "value": "off"}]}')
+        with patch('xively.managers._numpy', False):
+            times, values, mask = self.datastream.datapoints.history_arrays(
+                start=datetime(2013, 1, 1, 14, 0, 0),
+                end=datetime(2013, 1, 1, 16, 0, 0))
+        self.assertEqual(times, [datetime(2013, 1, 1, 14, 14, 55),
+                                 datetime(2013, 1, 1, 14, 29, 55)])
+        self.assertEqual(values[0], 1.5)
+        self.assertTrue(values[1] != values[1])
+        self.assertEqual(list(mask), [False, True])
+
+    def test_to_floats(self):
+        with patch('xively.managers._numpy', False):
+            floats, mask = xively.managers._to_floats(["1.5", None, 2, "x"])
+        self.assertEqual(floats[0], 1.5)
+        self.assertEqual(floats[2], 2.0)
+        self.assertEqual(list(mask), [False, True, False, True])
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_to_floats_numpy(self):
+        floats, mask = xively.managers._to_floats(["1.5", "2"])
+        self.assertEqual(floats.dtype, numpy.float64)
+        self.assertEqual(floats.tolist(), [1.5, 2.0])
+        floats, mask = xively.managers._to_floats(["1.5", "x"])
+        self.assertEqual(mask.tolist(), [False, True])
+        self.assertTrue(numpy.isnan(floats[1]))
+
     def test_datapoint_history_empty(self):
         self.response.raw = BytesIO(b'''{
             "at": "2013-03-06T14:56:20.844980Z",
@@ -598,6 +1306,779 @@ class DatapointsManagerTest(BaseTestCase):
             params={'start': '2010-07-28T07:48:22.014326Z'})
 
 
+class MergedHistoryTest(BaseTestCase):
+
+    histories = {
+        'a': [("10:00", "1"), ("10:20", "2")],
+        'b': [("10:10", "x"), ("10:20", "y"), ("10:45", "z")],
+    }
+
+    def setUp(self):
+        super(MergedHistoryTest, self).setUp()
+        self.feed = self._create_feed(id=1977, title="Rother")
+        self.request.side_effect = self._history
+
+    def _history(self, method, url, params=None, **kwargs):
+        response = requests.Response()
+        datastream_id = url.rsplit('/', 1)[1]
+        if datastream_id not in self.histories:
+            response.status_code = 500
+            return response
+        response.status_code = 200
+        response._content = json.dumps({'datapoints': [
+            {'at': "2013-01-01T{}:00.000000Z".format(at), 'value': value}
+            for at, value in self.histories[datastream_id]
+        ]}).encode('utf-8')
+        return response
+
+    def _rows(self, **kwargs):
+        rows = self.feed.history(
+            ['a', 'b'], datetime(2013, 1, 1, 10), datetime(2013, 1, 1, 11),
+            **kwargs)
+        return [(at.strftime("%H:%M"),) + values for at, values in (
+            (row[0], row[1:]) for row in rows)]
+
+    def test_no_fill(self):
+        self.assertEqual(self._rows(), [
+            ("10:00", "1", None),
+            ("10:10", None, "x"),
+            ("10:20", "2", "y"),
+            ("10:45", None, "z"),
+        ])
+        self.assertEqual(self.request.call_count, 2)
+        self.assertEqual(self.request.call_args[1]['params']['start'],
+                         '2013-01-01T10:00:00Z')
+
+    def test_forward_fill(self):
+        self.assertEqual(self._rows(fill='forward'), [
+            ("10:00", "1", None),
+            ("10:10", "1", "x"),
+            ("10:20", "2", "y"),
+            ("10:45", "2", "z"),
+        ])
+
+    def test_nearest_fill(self):
+        self.assertEqual(self._rows(fill='nearest'), [
+            ("10:00", "1", "x"),
+            ("10:10", "1", "x"),
+            ("10:20", "2", "y"),
+            ("10:45", "2", "z"),
+        ])
+
+    def test_columns(self):
+        columns = self.feed.history(
+            ['b', 'a'], datetime(2013, 1, 1, 10), datetime(2013, 1, 1, 11),
+            columns=True, typed=True, fill='forward')
+        self.assertEqual(sorted(columns), ['a', 'at', 'b'])
+        self.assertEqual(len(columns['at']), 4)
+        self.assertEqual(columns['a'], [1.0, 1.0, 2.0, 2.0])
+        self.assertEqual(columns['b'], [None, "x", "y", "z"])
+
+    def test_errors(self):
+        rows = self.feed.history(
+            ['a', 'c'], datetime(2013, 1, 1, 10), datetime(2013, 1, 1, 11))
+        self.assertRaises(requests.HTTPError, list, rows)
+        self.assertRaises(ValueError, self.feed.history, ['a'],
+                          datetime(2013, 1, 1, 10), datetime(2013, 1, 1, 11),
+                          fill='backward')
+
+
+class DatapointsIndexTest(BaseTestCase):
+
+    def setUp(self):
+        super(DatapointsIndexTest, self).setUp()
+        self.feed = self._create_feed(id=1977, title="Rother")
+        self.datastream = self._create_datastream(id='1')
+        self.datastream.datapoints = [
+            xively.Datapoint(datetime(2013, 1, 1, 10, 0), "1"),
+            xively.Datapoint(datetime(2013, 1, 1, 10, 40), "3"),
+            xively.Datapoint("2013-01-01T10:20:00Z", "2"),
+            xively.Datapoint(datetime(2013, 1, 1, 12, 10), "4"),
+        ]
+        self.datapoints = self.datastream.datapoints
+
+    def test_between(self):
+        view = self.datapoints.between(datetime(2013, 1, 1, 10, 10),
+                                       datetime(2013, 1, 1, 12, 10))
+        self.assertEqual([d.value for d in view], ["2", "3"])
+        self.assertIs(view[1], self.datastream.datapoints[1])
+        self.assertEqual([d.value for d in view[1:]], ["3"])
+        view = self.datapoints.between(end=datetime(2013, 1, 1, 10, 20))
+        self.assertEqual([d.value for d in view], ["1"])
+        self.assertEqual(len(self.datapoints.between()), 4)
+
+    def test_at_or_before_and_nearest(self):
+        at_or_before = self.datapoints.at_or_before
+        self.assertIsNone(at_or_before(datetime(2013, 1, 1, 9)))
+        self.assertEqual(at_or_before(datetime(2013, 1, 1, 10, 20)).value, "2")
+        self.assertEqual(at_or_before(datetime(2013, 1, 1, 13)).value, "4")
+        nearest = self.datapoints.nearest
+        self.assertEqual(nearest(datetime(2013, 1, 1, 9)).value, "1")
+        self.assertEqual(nearest(datetime(2013, 1, 1, 10, 30)).value, "2")
+        self.assertEqual(nearest(datetime(2013, 1, 1, 10, 31)).value, "3")
+        self.assertEqual(nearest(datetime(2013, 1, 2)).value, "4")
+
+    def test_resample(self):
+        view = self.datapoints.resample(1800)
+        self.assertEqual([d.value for d in view], ["2", "3", "4"])
+        view = self.datapoints.resample(
+            timedelta(hours=1), end=datetime(2013, 1, 1, 12))
+        self.assertEqual([d.value for d in view], ["3"])
+
+    def test_contains(self):
+        self.assertIn(datetime(2013, 1, 1, 10, 20), self.datapoints)
+        self.assertNotIn(datetime(2013, 1, 1, 10, 21), self.datapoints)
+        self.assertIn(self.datapoints[3], self.datapoints)
+        self.assertNotIn(
+            xively.Datapoint(datetime(2013, 1, 1, 10), "1"), self.datapoints)
+
+    def test_index_follows_changes(self):
+        self.datapoints.nearest(datetime(2013, 1, 1))
+        self.datastream.datapoints = [
+            xively.Datapoint(datetime(2013, 1, 2), "5")]
+        self.assertEqual(self.datapoints.nearest(datetime(2013, 1, 1)).value,
+                         "5")
+        self.datastream._data['datapoints'].append(
+            xively.Datapoint(datetime(2013, 1, 3), "6"))
+        self.assertEqual(self.datapoints.at_or_before(datetime(2013, 1, 4))
+                         .value, "6")
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "needs async iteration")
+class AsyncIterationTest(BaseTestCase):
+
+    def setUp(self):
+        super(AsyncIterationTest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        super(AsyncIterationTest, self).tearDown()
+
+    def _next(self, iterator):
+        return self.loop.run_until_complete(iterator.__anext__())
+
+    def _collect(self, iterator):
+        items = []
+        while True:
+            try:
+                items.append(self._next(iterator))
+            except StopAsyncIteration:
+                return items
+
+    def _wait_for(self, condition):
+        deadline = time.time() + 2
+        while not condition() and time.time() < deadline:
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+
+    def test_prefetch(self):
+        fetched = []
+
+        def pages():
+            for page in ([1, 2], [], [3], [4, 5]):
+                fetched.append(page)
+                yield page
+
+        iterator = xively.aio.AsyncPageIterator(pages(), prefetch=1)
+        self.assertEqual(self._next(iterator), 1)
+        # The following page is fetched ahead, but no more than that.
+        self._wait_for(lambda: len(fetched) == 2)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertEqual(len(fetched), 2)
+        self.assertEqual(self._collect(iterator), [2, 3, 4, 5])
+
+    def test_errors(self):
+        def pages():
+            yield [1]
+            raise requests.ConnectionError()
+
+        iterator = xively.aio.AsyncPageIterator(pages())
+        self.assertEqual(self._next(iterator), 1)
+        self.assertRaises(requests.ConnectionError, self._next, iterator)
+
+    def test_ahistory(self):
+        feed = self._create_feed(id=1977, title="Rother")
+        datastream = feed.datastreams.create("1")
+        pages = [
+            b'{"datapoints": [{"at": "2013-01-01T10:00:00.000000Z", '
+            b'"value": "1"}]}',
+            b'{"datapoints": [{"at": "2013-01-01T16:00:00.000000Z", '
+            b'"value": "2"}]}',
+        ]
+
+        def history(method, url, params=None, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = pages.pop(0)
+            return response
+
+        self.request.side_effect = history
+        datapoints = self._collect(datastream.datapoints.ahistory(
+            datetime(2013, 1, 1, 10), datetime(2013, 1, 1, 22), typed=True))
+        self.assertEqual([d.value for d in datapoints], [1.0, 2.0])
+        self.assertEqual(self.request.call_args[1]['params']['start'],
+                         '2013-01-01T16:00:00Z')
+
+    def test_alist(self):
+        self.response.raw = BytesIO(fixtures.LIST_TRIGGERS_JSON)
+        triggers = self._collect(self.api.triggers.alist(feed_id=1233))
+        self.assertEqual([trigger.id for trigger in triggers], [13, 14])
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = BytesIO(fixtures.LIST_KEYS_JSON)
+        self.request.return_value = response
+        keys = self._collect(self.api.keys.alist())
+        self.assertEqual(len(keys), 2)
+
+
+class BulkCreateTest(BaseTestCase):
+
+    def setUp(self):
+        super(BulkCreateTest, self).setUp()
+        self.feed = self._create_feed(id=1977, title="Rother")
+        self.datastream = self._create_datastream(id='1', current_value="100")
+
+    def _datapoints(self, count):
+        for i in range(count):
+            yield datetime(2013, 1, 1, 0, 0, i), str(i)
+
+    def test_bulk_create_batches(self):
+        progress = self.datastream.datapoints.bulk_create(
+            self._datapoints(25), batch_size=10, workers=2)
+        self.assertEqual(progress.count, 25)
+        self.assertEqual(progress.batches, 3)
+        sizes = sorted(len(json.loads(c[1]['data'])['datapoints'])
+                       for c in self.request.call_args_list)
+        self.assertEqual(sizes, [5, 10, 10])
+        self.assertEqual(
+            self.request.call_args[0],
+            ('POST', 'http://api.xively.com/v2/feeds/1977/datastreams/1/datapoints'))
+
+    def test_bulk_create_retries(self):
+        error = requests.ConnectionError()
+        self.request.side_effect = [error, self.response]
+        progress = self.datastream.datapoints.bulk_create(
+            self._datapoints(3), workers=1, backoff=0)
+        self.assertEqual(progress.count, 3)
+        self.assertEqual(progress.retries, 1)
+
+    def test_bulk_create_fails(self):
+        self.request.side_effect = requests.ConnectionError()
+        self.assertRaises(
+            requests.ConnectionError, self.datastream.datapoints.bulk_create,
+            self._datapoints(3), workers=1, retries=1, backoff=0)
+        self.assertEqual(self.request.call_count, 2)
+
+    def test_bulk_create_callback_fails(self):
+        def callback(progress):
+            raise ValueError("callback failed")
+        self.assertRaises(
+            ValueError, self.datastream.datapoints.bulk_create,
+            self._datapoints(100), batch_size=10, workers=2, callback=callback)
+        self.assertTrue(self.request.call_count < 10)
+
+
+class WriteJournalTest(BaseTestCase):
+
+    def setUp(self):
+        super(WriteJournalTest, self).setUp()
+        self.feed = self._create_feed(id=1977, title="Rother")
+        self.datastream = self._create_datastream(id='1', current_value="100")
+        self.journal = xively.journal.WriteJournal()
+        self.stored = []
+
+    def _datapoints(self, count):
+        for i in range(count):
+            yield datetime(2013, 1, 1, 0, 0, i), str(i)
+
+    def _request(self, method, url, data=None, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        if method == 'POST':
+            self.stored.extend(
+                d['at'] for d in json.loads(data)['datapoints'])
+            response._content = b''
+        else:
+            response._content = json.dumps({'datapoints': [
+                {'at': at.replace('Z', '.000000Z'), 'value': '0'}
+                for at in self.stored
+            ]}).encode('utf-8')
+        return response
+
+    def _timeout(self, stored):
+        """Time out the first request, after storing it if stored is set."""
+        timeouts = [requests.Timeout()]
+
+        def request(method, url, **kwargs):
+            if not timeouts:
+                return self._request(method, url, **kwargs)
+            if stored:
+                self._request(method, url, **kwargs)
+            raise timeouts.pop()
+        return request
+
+    def test_replay_skips_committed(self):
+        self.request.side_effect = self._request
+        datapoints = list(self._datapoints(5))
+        self.datastream.datapoints.bulk_create(
+            datapoints[:3], workers=1, journal=self.journal)
+        progress = self.datastream.datapoints.bulk_create(
+            datapoints, workers=1, journal=self.journal)
+        self.assertEqual(progress.count, 2)
+        self.assertEqual(progress.skipped, 3)
+        self.assertEqual(len(self.stored), 5)
+        self.assertEqual(
+            self.journal.status(self.datastream.datapoints,
+                                "2013-01-01T00:00:04Z"), 'committed')
+
+    def test_retry_verifies_timed_out_batch(self):
+        self.request.side_effect = self._timeout(stored=True)
+        progress = self.datastream.datapoints.bulk_create(
+            self._datapoints(3), workers=1, backoff=0, journal=self.journal)
+        self.assertEqual(progress.retries, 1)
+        self.assertEqual(progress.skipped, 3)
+        self.assertEqual(len(self.stored), 3)
+        self.assertEqual([c[0][0] for c in self.request.call_args_list],
+                         ['POST', 'GET'])
+        params = self.request.call_args[1]['params']
+        self.assertEqual((params['start'], params['end']),
+                         ("2013-01-01T00:00:00Z",
+                          "2013-01-01T00:00:02.000001Z"))
+
+    def test_retry_resends_lost_batch(self):
+        self.request.side_effect = self._timeout(stored=False)
+        progress = self.datastream.datapoints.bulk_create(
+            self._datapoints(3), workers=1, backoff=0, journal=self.journal)
+        self.assertEqual(progress.count, 3)
+        self.assertEqual(progress.skipped, 0)
+        self.assertEqual([c[0][0] for c in self.request.call_args_list],
+                         ['POST', 'GET', 'POST'])
+
+    def test_create_with_journal(self):
+        self.request.side_effect = self._request
+        at = datetime(2013, 1, 1)
+        self.datastream.datapoints.create('1', at=at, journal=self.journal)
+        self.datastream.datapoints.create('1', at=at, journal=self.journal)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_journal_file(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        filename = os.path.join(path, 'journal')
+        self.request.side_effect = self._request
+        journal = xively.journal.WriteJournal(filename)
+        self.datastream.datapoints.bulk_create(
+            self._datapoints(3), workers=1, journal=journal)
+        with open(filename, 'a') as f:
+            f.write('{"key": ')
+        journal = xively.journal.WriteJournal(filename)
+        progress = self.datastream.datapoints.bulk_create(
+            self._datapoints(4), workers=1, journal=journal)
+        self.assertEqual(progress.count, 1)
+        self.assertEqual(progress.skipped, 3)
+
+    def test_max_entries(self):
+        self.request.side_effect = self._request
+        journal = xively.journal.WriteJournal(max_entries=2, verify=False)
+        self.datastream.datapoints.bulk_create(
+            self._datapoints(3), workers=1, journal=journal)
+        manager = self.datastream.datapoints
+        self.assertEqual(
+            [journal.status(manager, at) for at, value in self._datapoints(3)],
+            [None, 'committed', 'committed'])
+
+
+class HistoryCacheTest(BaseTestCase):
+
+    def setUp(self):
+        super(HistoryCacheTest, self).setUp()
+        self.feed = self._create_feed(id=1977, title="Rother")
+        self.datastream = self._create_datastream(id='1', current_value="100")
+        self.path = tempfile.mkdtemp()
+        self.cache = xively.cache.HistoryCache(self.path)
+        self.key = self.cache.key(1977, '1')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(HistoryCacheTest, self).tearDown()
+
+    def test_missing_ranges(self):
+        self.cache.store(self.key, datetime(2013, 1, 1, 14), datetime(2013, 1, 1, 15),
+                         [(datetime(2013, 1, 1, 14, 30), "1")])
+        self.assertEqual(
+            self.cache.missing(self.key, datetime(2013, 1, 1, 13), datetime(2013, 1, 1, 16)),
+            [(datetime(2013, 1, 1, 13), datetime(2013, 1, 1, 14)),
+             (datetime(2013, 1, 1, 15), datetime(2013, 1, 1, 16))])
+
+    def test_read_across_partitions(self):
+        self.cache.store(self.key, datetime(2013, 1, 1, 12), datetime(2013, 1, 2, 12), [
+            (datetime(2013, 1, 2, 1), "2"),
+            (datetime(2013, 1, 1, 23), "1"),
+        ])
+        self.assertEqual(len(os.listdir(os.path.join(self.path, '1977', '1', '0'))), 2)
+        self.assertEqual(
+            list(self.cache.read(self.key, datetime(2013, 1, 1), datetime(2013, 1, 3))),
+            [(datetime(2013, 1, 1, 23), "1"), (datetime(2013, 1, 2, 1), "2")])
+        self.assertEqual(
+            list(self.cache.read(self.key, datetime(2013, 1, 2), datetime(2013, 1, 3))),
+            [(datetime(2013, 1, 2, 1), "2")])
+
+    def test_history_fetches_only_gaps(self):
+        self.cache.store(self.key, datetime(2013, 1, 1, 14), datetime(2013, 1, 1, 15),
+                         [(datetime(2013, 1, 1, 14, 30), "1")])
+        self.response.raw = BytesIO(b'''{"datapoints": [
+            {"at": "2013-01-01T15:30:00.000000Z", "value": "2"}]}''')
+        datapoints = list(self.datastream.datapoints.history(
+            start=datetime(2013, 1, 1, 14), end=datetime(2013, 1, 1, 16),
+            cache=self.cache))
+        self.request.assert_called_once_with(
+            'GET', 'http://api.xively.com/v2/feeds/1977/datastreams/1',
+            allow_redirects=True, params={
+                'start': '2013-01-01T15:00:00Z',
+                'end': '2013-01-01T16:00:00Z',
+                'limit': 1000,
+            })
+        self.assertEqual([(d.at, d.value) for d in datapoints], [
+            (datetime(2013, 1, 1, 14, 30), "1"),
+            (datetime(2013, 1, 1, 15, 30), "2"),
+        ])
+        self.assertEqual(
+            self.cache.missing(self.key, datetime(2013, 1, 1, 14), datetime(2013, 1, 1, 16)),
+            [])
+
+    def test_evicts_least_recently_used(self):
+        self.cache.max_size = 0
+        self.cache.store(self.key, datetime(2013, 1, 1, 14), datetime(2013, 1, 1, 15),
+                         [(datetime(2013, 1, 1, 14, 30), "1")])
+        self.assertEqual(self.cache.size, 0)
+        self.assertEqual(
+            self.cache.missing(self.key, datetime(2013, 1, 1, 14), datetime(2013, 1, 1, 15)),
+            [(datetime(2013, 1, 1, 14), datetime(2013, 1, 1, 15))])
+
+
+    def test_history_keeps_range_being_read(self):
+        self.cache.store(self.key, datetime(2013, 1, 2), datetime(2013, 1, 3),
+                         [(datetime(2013, 1, 2, 12), "2")])
+        self.cache.max_size = self.cache.size
+        self.response.raw = BytesIO(b'''{"datapoints": [
+            {"at": "2013-01-01T12:00:00.000000Z", "value": "1"}]}''')
+        datapoints = list(self.datastream.datapoints.history(
+            start=datetime(2013, 1, 1), end=datetime(2013, 1, 3),
+            cache=self.cache))
+        self.assertEqual([d.value for d in datapoints], ["1", "2"])
+        # Once unpinned, the next store evicts again.
+        self.cache.store(self.key, datetime(2013, 1, 5), datetime(2013, 1, 6), [])
+        self.assertTrue(self.cache.size <= self.cache.max_size)
+
+    def test_read_while_merging(self):
+        def at(minute):
+            return datetime(2013, 1, 1, 14, minute)
+        self.cache.store(self.key, at(0), at(10), [(at(5), "1")])
+        self.cache.store(self.key, at(20), at(30), [(at(25), "2")])
+        stored = self.cache.read(self.key, at(0), at(40))
+        self.assertEqual(next(stored), (at(5), "1"))
+        # Merging replaces the second segment while it is being read.
+        self.cache.store(self.key, at(30), at(40), [(at(35), "3")])
+        self.assertEqual(list(stored), [(at(25), "2")])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.path, '1977', '1', '0'))),
+                         ['1357048800000000-1357049400000000.seg',
+                          '1357050000000000-1357051200000000.seg'])
+
+
+class HistoryExporterTest(BaseTestCase):
+
+    def setUp(self):
+        super(HistoryExporterTest, self).setUp()
+        self.request.side_effect = fixtures.handle_request
+        self.exporter = xively.export.HistoryExporter(self.api, batch_size=5)
+
+    def test_batches(self):
+        batches = list(self.exporter.batches(
+            [7021], start=datetime(2013, 1, 1, 14), end=datetime(2013, 1, 1, 16)))
+        self.assertEqual([len(batch['at']) for batch in batches], [5, 5, 5, 1])
+        rows = sorted(zip(*[sum((b[name] for b in batches), [])
+                            for name in xively.export.COLUMNS]))
+        self.assertEqual(rows[0], ('7021', '3', datetime(2013, 1, 1, 14, 14, 55, 118845),
+                                   '0.25741970'))
+        self.assertEqual(set(row[1] for row in rows), set(['3', '4']))
+
+    def _wait_for_threads(self, count):
+        deadline = time.time() + 5
+        while threading.active_count() > count and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(threading.active_count(), count)
+
+    def test_batches_closed_early(self):
+        threads = threading.active_count()
+        exporter = xively.export.HistoryExporter(self.api, batch_size=1)
+        batches = exporter.batches(
+            [7021], start=datetime(2013, 1, 1, 14), end=datetime(2013, 1, 1, 16))
+        next(batches)
+        batches.close()
+        self._wait_for_threads(threads)
+
+    def test_batches_fail(self):
+        threads = threading.active_count()
+
+        def request(method, url, **kwargs):
+            if url.endswith('/datastreams/4'):
+                raise requests.ConnectionError()
+            return fixtures.handle_request(method, url, **kwargs)
+        self.request.side_effect = request
+        self.assertRaises(
+            requests.ConnectionError, list, self.exporter.batches(
+                [7021], start=datetime(2013, 1, 1, 14),
+                end=datetime(2013, 1, 1, 16)))
+        self._wait_for_threads(threads)
+
+    def test_history_windows(self):
+        self.request.side_effect = None
+        self.response.raw = BytesIO(b'{"datapoints": []}')
+        feed = self._create_feed(id=1977, title="Rother")
+        datastream = feed.datastreams._coerce_datastream({'id': '1'})
+        list(datastream.datapoints._paginate_history(
+            datetime(2013, 1, 1, 0), datetime(2013, 1, 1, 8)))
+        self.assertEqual(
+            [c[1]['params']['end'] for c in self.request.call_args_list],
+            ['2013-01-01T06:00:00Z', '2013-01-01T08:00:00Z'])
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_export_parquet(self):
+        path = os.path.join(tempfile.mkdtemp(), 'history.parquet')
+        count = self.exporter.export(
+            [7021], start=datetime(2013, 1, 1, 14), end=datetime(2013, 1, 1, 16),
+            path=path)
+        self.assertEqual(count, 16)
+        import pyarrow.parquet
+        self.assertEqual(pyarrow.parquet.read_table(path).num_rows, 16)
+
+
+class WriteSchedulerTest(BaseTestCase):
+
+    def setUp(self):
+        super(WriteSchedulerTest, self).setUp()
+        self.scheduler = xively.scheduler.WriteScheduler(concurrency=1)
+        self.sent = []
+
+    def _write(self, name):
+        self.sent.append(name)
+        return name
+
+    def _submit(self, feed_id, name, **kwargs):
+        return self.scheduler.submit(feed_id, self._write, (name,), **kwargs)
+
+    def test_realtime_before_bulk(self):
+        for i in range(3):
+            self._submit(1, 'backfill', priority='bulk')
+        write = self._submit(2, 'update')
+        self.scheduler.start().close()
+        self.assertEqual(self.sent, ['update'] + ['backfill'] * 3)
+        self.assertEqual(write.result(), 'update')
+
+    def test_weighted_fair_queuing(self):
+        self.scheduler.weights[3] = 2
+        for i in range(4):
+            self._submit(1, 'burst', priority='bulk')
+        self._submit(2, 'small', priority='bulk', cost=2)
+        for i in range(4):
+            self._submit(3, 'heavy', priority='bulk')
+        self.scheduler.start().close()
+        self.assertEqual(self.sent, [
+            'heavy', 'burst', 'heavy', 'heavy', 'burst', 'small', 'heavy',
+            'burst', 'burst'])
+
+    def test_late_feed_is_not_starved(self):
+        started = threading.Event()
+        submitted = threading.Event()
+        self.scheduler.submit(1, lambda: started.set() or submitted.wait(),
+                              priority='bulk')
+        for i in range(100):
+            self._submit(1, 'backfill', priority='bulk')
+        self.scheduler.start()
+        started.wait()
+        self._submit(2, 'late', priority='bulk')
+        submitted.set()
+        self.scheduler.close()
+        self.assertEqual(self.sent.index('late'), 1)
+
+    def test_metrics(self):
+        self._submit(1, 'update')
+        self.scheduler.submit(1, [].pop, priority='bulk')
+        self.assertEqual(self.scheduler.depth(1), 1)
+        self.scheduler.start().close()
+        metrics = self.scheduler.metrics()
+        self.assertEqual(
+            [(key, m['depth'], m['completed'], m['failed'])
+             for key, m in sorted(metrics.items())],
+            [(('bulk', 1), 0, 0, 1), (('realtime', 1), 0, 1, 0)])
+        self.assertGreaterEqual(metrics[('bulk', 1)]['max_wait'], 0.0)
+        self.assertRaises(ValueError, self.scheduler.submit, 1, self._write,
+                          priority='urgent')
+
+    def test_concurrency_limit(self):
+        scheduler = xively.scheduler.WriteScheduler(concurrency=3).start()
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def write():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.005)
+            with lock:
+                running.pop()
+        for i in range(30):
+            scheduler.submit(i % 5, write, priority='bulk')
+        scheduler.close()
+        self.assertEqual(max(peak), 3)
+
+    def test_bulk_create_batches(self):
+        self.feed = self._create_feed(id=1977, title="Rother")
+        datastream = self._create_datastream(id='1', current_value="100")
+        rows = ((datetime(2013, 1, 1, 0, 0, i), i) for i in range(25))
+        writes = self.scheduler.bulk_create(datastream, rows, batch_size=10)
+        self.scheduler.start().close()
+        self.assertEqual([w.result().count for w in writes], [10, 10, 5])
+        self.assertEqual(
+            self.scheduler.metrics()[('bulk', 1977)]['completed'], 3)
+
+    def test_bulk_create_reads_batches_lazily(self):
+        self.feed = self._create_feed(id=1977, title="Rother")
+        datastream = self._create_datastream(id='1', current_value="100")
+        read = []
+
+        def rows():
+            for i in range(50):
+                read.append(i)
+                yield datetime(2013, 1, 1, 0, 0, i), i
+        writes = self.scheduler.bulk_create(datastream, rows(), batch_size=10, ahead=2)
+        self.assertEqual((len(read), len(writes)), (20, 2))
+        self.assertEqual(self.scheduler.depth(1977, 'bulk'), 2)
+        self.scheduler.start().close()
+        self.assertEqual([w.result().count for w in writes], [10] * 5)
+
+
+class DiagnosticsTest(BaseTestCase):
+
+    def setUp(self):
+        super(DiagnosticsTest, self).setUp()
+        import xively.diagnostics
+        self.diagnostics = xively.diagnostics
+        self.diagnostics.reset()
+        self.addCleanup(self.diagnostics.disable)
+        self.addCleanup(self.diagnostics.reset)
+
+    def test_timings(self):
+        getstate = xively.Datastream.__getstate__
+        self.diagnostics.enable(allocations=False)
+        self.assertNotEqual(xively.Datastream.__getstate__, getstate)
+        feed = self._create_feed(id=1977, title="Rother", datastreams=[
+            {'id': '1', 'current_value': '10'},
+            {'id': '2', 'current_value': '20'}])
+        # The serializer still reads the models' data directly.
+        self.client._encode_data(feed)
+        feed.__getstate__()
+        timings = self.diagnostics.timings()
+        self.assertEqual(timings['FeedsManager._coerce_feed'][0], 1)
+        self.assertIn('DatastreamsManager._coerce_datastream', timings)
+        self.assertEqual(timings['Serializer.encode'][0], 1)
+        self.assertEqual(timings['Feed.__getstate__'][0], 1)
+        self.assertNotIn('Datastream.__getstate__', timings)
+        self.diagnostics.disable()
+        self.assertEqual(xively.Datastream.__getstate__, getstate)
+
+    def test_live_instances(self):
+        datapoints = [xively.Datapoint(datetime(2013, 1, 1), i)
+                      for i in range(5)]
+        counts = self.diagnostics.live_instances()
+        self.assertGreaterEqual(counts['Datapoint'], len(datapoints))
+
+    @unittest.skipIf(sys.version_info < (3, 4), "requires tracemalloc")
+    def test_allocations(self):
+        self.diagnostics.enable()
+        datapoints = [xively.Datapoint(datetime(2013, 1, 1), i)
+                      for i in range(1000)]
+        allocations = self.diagnostics.allocations(limit=3)
+        self.assertTrue(allocations)
+        self.assertTrue(all(location.startswith('xively')
+                            for location, size, count in allocations))
+        self.assertIn('models.py', allocations[0][0])
+        self.assertEqual(len(datapoints), 1000)
+
+    def test_report(self):
+        self.diagnostics.enable(allocations=False)
+        self._create_feed(id=1977, title="Rother")
+        out = Mock()
+        self.diagnostics.report(out)
+        text = out.write.call_args[0][0]
+        self.assertIn("Live instances:", text)
+        self.assertIn("FeedsManager._coerce_feed", text)
+        self.assertNotIn("Allocations:", text)
+
+
+class ShardedUploaderTest(BaseTestCase):
+
+    def test_shard_is_stable(self):
+        uploader = xively.uploader.ShardedUploader("API_KEY", processes=4)
+        shards = [uploader.shard(feed_id) for feed_id in range(100)]
+        self.assertEqual(shards, [uploader.shard(feed_id) for feed_id in range(100)])
+        self.assertEqual(set(shards), set(range(4)))
+
+    def test_models_pickle_without_manager(self):
+        feed = self._create_feed(id=7021, title="Rother", datastreams=[
+            xively.Datastream(id="3", current_value=1, unit=xively.Unit(symbol="C")),
+        ])
+        datastream = pickle.loads(pickle.dumps(feed.datastreams[0]))
+        self.assertEqual(datastream.__getstate__()['current_value'], 1)
+        self.assertEqual(datastream.unit.symbol, "C")
+        self.assertEqual(list(vars(datastream)), ['_data'])
+
+    def _uploader(self):
+        if getattr(multiprocessing, 'get_start_method', lambda: 'fork')() != 'fork':
+            self.skipTest("workers only see the mocked requests when forked")
+        return xively.uploader.ShardedUploader("API_KEY", processes=2)
+
+    def test_submit_and_close(self):
+        uploader = self._uploader()
+        for feed_id in range(10):
+            uploader.submit(feed_id, [xively.Datastream(id="3", current_value=feed_id)])
+        metrics = uploader.close()
+        self.assertEqual((metrics['submitted'], metrics['sent'], metrics['failed']),
+                         (10, 10, 0))
+        self.assertFalse(any(worker.is_alive() for worker in uploader._workers))
+
+    def test_close_with_dead_worker(self):
+        uploader = self._uploader()
+        uploader.start()
+        dead = uploader._workers[0]
+        dead.terminate()
+        dead.join()
+        feed_id = next(i for i in range(10) if uploader.shard(i) == 1)
+        uploader.submit(feed_id, [{'id': "3", 'current_value': 1}])
+        metrics = uploader.close()
+        self.assertEqual(metrics['sent'], 1)
+        self.assertEqual(metrics['errors'], [
+            (None, "Worker 0 exited with code {}".format(dead.exitcode))])
+
+    def test_worker_sends_updates(self):
+        queue, results = Queue(), Queue()
+        queue.put((7021, [{'id': "3", 'current_value': 1}], {'private': True}))
+        queue.put(None)
+        xively.uploader._work("API_KEY", {}, queue, results)
+        self.assertEqual(self.request.call_args[0],
+                         ('PUT', 'http://api.xively.com/v2/feeds/7021'))
+        self.assertEqual(json.loads(self.request.call_args[1]['data']), {
+            'datastreams': [{'current_value': 1, 'id': "3"}],
+            'private': True,
+        })
+        feed_id, seconds, error = results.get()
+        self.assertEqual((feed_id, error), (7021, None))
+        self.assertEqual(results.get(), None)
+
+
 class TriggerTest(BaseTestCase):
 
     def setUp(self):
@@ -844,6 +2325,121 @@ class WaypointTest(BaseTestCase):
         self.assertEqual(waypoint.lon, -0.0807666778564453)
 
 
+class WaypointTrackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.track = xively.geo.WaypointTrack.from_data([
+            {'at': "2012-06-01T12:00:00.000000Z", 'lat': 0.0, 'lon': 0.0},
+            {'at': "2012-06-01T12:00:20.500000Z", 'lat': 0.0, 'lon': 0.01,
+             'ele': 12.5},
+            {'at': "2012-06-01T12:00:10.000000Z", 'lat': 0.0, 'lon': 0.005},
+            {'at': "2012-06-01T12:00:30.000000Z", 'lat': 1.0, 'lon': 0.01},
+        ])
+
+    def test_waypoints(self):
+        self.assertEqual(len(self.track), 4)
+        waypoint = self.track[2]
+        self.assertEqual(waypoint.at, datetime(2012, 6, 1, 12, 0, 20, 500000))
+        self.assertEqual((waypoint.lat, waypoint.lon), (0.0, 0.01))
+        self.assertEqual(waypoint.ele, 12.5)
+        self.assertEqual(self.track[-1].lat, 1.0)
+        self.assertRaises(IndexError, lambda: self.track[4])
+        self.assertEqual(self.track.__getstate__()[0], {
+            'at': datetime(2012, 6, 1, 12), 'lat': 0.0, 'lon': 0.0})
+
+    def test_between(self):
+        track = self.track.between(datetime(2012, 6, 1, 12, 0, 10),
+                                   datetime(2012, 6, 1, 12, 0, 30))
+        self.assertEqual([w.lon for w in track], [0.005, 0.01])
+        self.assertEqual(len(self.track.between(None, None)), 4)
+
+    def test_distance_and_speed(self):
+        distances = self.track.distances()
+        self.assertAlmostEqual(distances[0], 556.0, places=1)
+        self.assertAlmostEqual(self.track.distance(), 112307.0, places=1)
+        self.assertAlmostEqual(self.track.speeds()[0], 55.60, places=2)
+        self.assertAlmostEqual(self.track.speed(), 3743.6, places=1)
+
+    def test_within(self):
+        track = self.track.within(-0.5, 0.004, 0.5, 0.02)
+        self.assertEqual([w.lon for w in track], [0.005, 0.01])
+        self.track.append({'at': datetime(2012, 6, 1, 12, 0, 40),
+                           'lat': 0.1, 'lon': 0.015})
+        self.assertEqual(len(self.track.within(-0.5, 0.004, 0.5, 0.02)), 3)
+        self.assertEqual(len(self.track.within(-1, 0.0, 1, 0.0)), 1)
+        self.assertEqual(len(self.track.within(-1, 179, 1, 0.001)), 1)
+
+    def test_append_out_of_order(self):
+        self.track.append(xively.Waypoint(
+            at=datetime(2012, 6, 1, 11), lat=2.0, lon=2.0))
+        self.assertEqual(self.track[0].lat, 2.0)
+        self.assertEqual(list(self.track.times), sorted(self.track.times))
+
+    def test_encode(self):
+        location = xively.Location(waypoints=self.track[:1])
+        encoder = xively.client.JSONEncoder(sort_keys=True)
+        self.assertEqual(
+            encoder.encode(location),
+            '{"waypoints": [{"at": "2012-06-01T12:00:00Z", '
+            '"lat": 0.0, "lon": 0.0}]}')
+
+
+class FeedLocationIndexTest(BaseTestCase):
+
+    def setUp(self):
+        super(FeedLocationIndexTest, self).setUp()
+        self.feeds = []
+        self.request.side_effect = self._list
+        self.index = xively.geo.FeedLocationIndex(self.api.feeds, per_page=2)
+
+    def _list(self, method, url, params=None, **kwargs):
+        page, per_page = params['page'], params['per_page']
+        results = self.feeds[(page - 1) * per_page:page * per_page]
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({'results': results}).encode('utf-8')
+        return response
+
+    def _add_feed(self, id, lat, lon):
+        # Feeds are listed newest first.
+        self.feeds.insert(0, {
+            'id': id, 'title': str(id),
+            'created': "2013-01-01T00:00:{:02d}.000000Z".format(id),
+            'location': {'lat': lat, 'lon': lon}})
+
+    def test_refresh(self):
+        self._add_feed(1, 51.52, -0.08)
+        self._add_feed(2, 48.85, 2.35)
+        self._add_feed(3, 40.71, -74.0)
+        self.assertEqual(self.index.refresh(), 3)
+        self.assertEqual(self.request.call_count, 2)
+        self.assertEqual(self.request.call_args[1]['params']['order'],
+                         'created_at')
+        self._add_feed(4, 51.45, -2.58)
+        self.request.reset_mock()
+        self.assertEqual(self.index.refresh(), 1)
+        self.assertEqual(self.request.call_count, 1)
+        self.assertEqual(len(self.index), 4)
+
+    def test_queries(self):
+        for id, lat, lon in ((1, 51.52, -0.08), (2, 48.85, 2.35),
+                             (3, 51.45, -2.58), (4, -16.5, 179.9),
+                             (5, None, None)):
+            self._add_feed(id, lat, lon)
+        self.index.refresh()
+        self.assertNotIn(5, self.index)
+        near = self.index.near(51.5, 0.0, 200)
+        self.assertEqual([feed.id for feed in near], [1, 3])
+        near = self.index.near(51.5, 0.0, 400, distance_units='miles')
+        self.assertEqual([feed.id for feed in near], [1, 3, 2])
+        found = self.index.within(48, -1, 52, 3)
+        self.assertEqual(sorted(feed.id for feed in found), [1, 2])
+        found = self.index.within(-20, 179, -10, -179)
+        self.assertEqual([feed.id for feed in found], [4])
+        self.index.remove(1)
+        self.assertEqual(len(self.index.within(48, -1, 52, 3)), 1)
+
+
 class UnitTest(BaseTestCase):
 
     def test_create_unit(self):
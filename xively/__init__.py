@@ -1,16 +1,79 @@
 # -*- coding: utf-8 -*-
 
+import sys
+
 __title__ = 'xively-python'
 __version__ = '0.1.0-rc2'
 
 __all__ = ['Client', 'XivelyAPIClient', 'Datapoint', 'Datastream', 'Feed', 'Key',
-           'Location', 'Permission', 'Resource', 'Trigger', 'Unit', 'Waypoint']
+           'Location', 'Permission', 'Resource', 'Trigger', 'Unit', 'Waypoint',
+           'HistoryCache', 'HistoryExporter', 'Parser', 'Pipeline', 'RawPayload',
+           'ShardedUploader', 'WaypointTrack', 'FeedLocationIndex',
+           'WriteJournal', 'WriteScheduler']
+
+# The submodule defining each public name. They are only imported when first
+# used, so that `import xively` stays cheap and does not import requests
+# until a client is needed.
+_exports = {
+    'XivelyAPIClient': 'api',
+    'HistoryCache': 'cache',
+    'Client': 'client',
+    'HistoryExporter': 'export',
+    'FeedLocationIndex': 'geo',
+    'WaypointTrack': 'geo',
+    'WriteJournal': 'journal',
+    'Datapoint': 'models',
+    'Datastream': 'models',
+    'Feed': 'models',
+    'Key': 'models',
+    'Location': 'models',
+    'Permission': 'models',
+    'Resource': 'models',
+    'Trigger': 'models',
+    'Unit': 'models',
+    'Waypoint': 'models',
+    'RawPayload': 'payload',
+    'Parser': 'pipeline',
+    'Pipeline': 'pipeline',
+    'WriteScheduler': 'scheduler',
+    'ShardedUploader': 'uploader',
+}
+
+_submodules = ('aio', 'api', 'cache', 'client', 'diagnostics', 'export',
+               'geo', 'journal', 'managers', 'models', 'payload', 'pipeline',
+               'scheduler', 'serializer', 'subscriptions', 'uploader')
+
+
+def __getattr__(name):
+    """Import the submodule providing name on first access (PEP 562)."""
+    import importlib
+    if name in _exports:
+        module = importlib.import_module('xively.' + _exports[name])
+        value = getattr(module, name)
+    elif name in _submodules:
+        value = importlib.import_module('xively.' + name)
+    else:
+        raise AttributeError(
+            "module 'xively' has no attribute {!r}".format(name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_exports) | set(_submodules))
+
 
-from xively.api import XivelyAPIClient
-from xively.client import Client
-from xively.models import (
-    Datapoint, Datastream, Feed, Key, Location, Permission, Resource, Trigger,
-    Unit, Waypoint)
+if sys.version_info < (3, 7):
+    # Module __getattr__ is not supported, so only import the names from api,
+    # client and models up front, as the package always did. The others are
+    # imported from their submodules, e.g. `from xively.cache import
+    # HistoryCache`, so that `import xively` does not pull in multiprocessing,
+    # mmap and friends.
+    __all__ = [_name for _name in __all__
+               if _exports[_name] in ('api', 'client', 'models')]
+    for _name in __all__:
+        __getattr__(_name)
+    del _name
 
 
 def setup_module(module):
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+
+
+__all__ = ['AsyncPageIterator']
+
+
+# Returned by _next_page once the pages have run out.
+_END = object()
+
+
+class AsyncPageIterator(object):
+    """Iterate with ``async for`` over results fetched a page at a time.
+
+    Each page is fetched in the event loop's executor, since requests are
+    blocking, and the following pages are fetched ahead while the current
+    one is consumed. Fetching stops while ``prefetch`` pages are waiting, so
+    a slow consumer holds back the requests rather than filling memory.
+
+    The iterator is written without ``async`` syntax so the module can
+    still be imported on Python 2, but it requires Python 3.5 or later to
+    be used.
+
+    .. note:: Use the ``alist`` and ``ahistory`` methods of the managers to
+        create these iterators.
+
+    :param pages: An iterable of lists of results, iterated in the executor
+    :param prefetch: Number of pages fetched ahead, at least one
+    :param executor: The :class:`concurrent.futures.Executor` to fetch pages
+        in, or None for the loop's default executor
+
+    Usage::
+
+        >>> import xively
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> feed = api.feeds.get(7021)
+        >>> async def print_datastreams():  # doctest: +SKIP
+        ...     async for datastream in feed.datastreams.alist():
+        ...         print(datastream.id)
+
+    """
+
+    def __init__(self, pages, prefetch=1, executor=None):
+        self.prefetch = max(1, prefetch)
+        self.executor = executor
+        self._pages = iter(pages)
+        self._ready = deque()
+        self._items = deque()
+        self._loop = None
+        self._fetching = None
+        self._waiter = None
+        self._error = None
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        self._waiter = self._loop.create_future()
+        waiter = self._waiter
+        self._deliver()
+        self._fill()
+        return waiter
+
+    def _deliver(self):
+        """Complete the waiting __anext__ future, if there is a result."""
+        waiter = self._waiter
+        if waiter is None or waiter.done():
+            return
+        while not self._items and self._ready:
+            self._items.extend(self._ready.popleft())
+        if self._items:
+            waiter.set_result(self._items.popleft())
+        elif self._error is not None:
+            waiter.set_exception(self._error)
+        elif self._done:
+            waiter.set_exception(StopAsyncIteration())
+        else:
+            return
+        self._waiter = None
+
+    def _fill(self):
+        """Start fetching the next page, unless enough are waiting."""
+        if (self._fetching is None and not self._done and
+                self._error is None and len(self._ready) < self.prefetch):
+            self._fetching = self._loop.run_in_executor(
+                self.executor, _next_page, self._pages)
+            self._fetching.add_done_callback(self._fetched)
+
+    def _fetched(self, future):
+        self._fetching = None
+        if future.cancelled():
+            self._done = True
+        elif future.exception() is not None:
+            self._error = future.exception()
+        else:
+            page = future.result()
+            if page is _END:
+                self._done = True
+            else:
+                self._ready.append(page)
+        self._deliver()
+        self._fill()
+
+
+def _next_page(pages):
+    return next(pages, _END)
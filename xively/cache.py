@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+import json
+import mmap
+import os
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote  # NOQA
+
+
+__all__ = ['HistoryCache']
+
+
+EPOCH = datetime(1970, 1, 1)
+
+# Segments never span more than one partition (one day, in microseconds).
+PARTITION = 86400 * 10 ** 6
+
+
+class HistoryCache(object):
+    """A persistent, size limited cache of datastream history.
+
+    Fetched ranges are stored on disk per (feed, datastream, interval) as
+    sorted segments, each one contained in a single day partition. A call to
+    :meth:`.DatapointsManager.history` given a cache only requests the parts
+    of the range not already stored, and reads the rest back from the
+    segments through memory maps.
+
+    :param path: Directory in which to store the segments
+    :param max_size: Maximum total size in bytes of stored segments, least
+        recently used segments are evicted once this is exceeded
+    :type max_size: int [64MB]
+
+    Usage::
+
+        >>> import xively
+        >>> import datetime
+        >>> import tempfile
+        >>> cache = xively.HistoryCache(tempfile.mkdtemp())
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> feed = api.feeds.get(7021)
+        >>> datastream = feed.datastreams.get("random5")
+        >>> datapoints = datastream.datapoints.history(
+        ...     start=datetime.datetime(2013, 1, 1, 14, 0, 0),
+        ...     end=datetime.datetime(2013, 1, 1, 16, 0, 0),
+        ...     cache=cache)
+        >>> len(list(datapoints))
+        8
+
+    """
+
+    def __init__(self, path, max_size=64 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.RLock()
+        self._segments = {}
+        self._sizes = {}
+        self._atimes = {}
+        self._clock = 0
+        self._pins = []
+        self._scan()
+
+    def key(self, feed_id, datastream_id, interval=None, interval_type=None):
+        """Return the cache key for a datastream at the given interval."""
+        interval = str(interval or 0)
+        if interval_type:
+            interval += '-' + interval_type
+        return (str(feed_id), str(datastream_id), interval)
+
+    def missing(self, key, start, end):
+        """Return a list of (start, end) ranges not stored for key."""
+        with self._lock:
+            lo, hi = _to_micros(start), _to_micros(end)
+            gaps = []
+            for seg_start, seg_end, _ in self._load(key):
+                if seg_end <= lo:
+                    continue
+                if seg_start >= hi:
+                    break
+                if seg_start > lo:
+                    gaps.append((lo, seg_start))
+                lo = max(lo, seg_end)
+            if lo < hi:
+                gaps.append((lo, hi))
+            return [(_from_micros(s), _from_micros(e)) for s, e in gaps]
+
+    def store(self, key, start, end, datapoints):
+        """Store the (at, value) pairs fetched for the range start to end.
+
+        Any part of the range later than the current time is not recorded as
+        fetched because new datapoints may still arrive there.
+
+        """
+        lo = _to_micros(start)
+        hi = min(_to_micros(end), _to_micros(datetime.utcnow()))
+        if lo >= hi:
+            return
+        points = sorted((_to_micros(at), value) for at, value in datapoints)
+        with self._lock:
+            partition = lo - lo % PARTITION
+            while partition < hi:
+                seg_start = max(lo, partition)
+                seg_end = min(hi, partition + PARTITION)
+                self._merge(key, seg_start, seg_end, [
+                    p for p in points if seg_start <= p[0] < seg_end])
+                partition += PARTITION
+            self._evict()
+
+    def read(self, key, start, end):
+        """Return an iterator of the stored (at, value) pairs for key between
+        start and end.
+
+        The segments are opened straight away, so segments merged or evicted
+        while the iterator is consumed are still read whole.
+
+        """
+        lo, hi = _to_micros(start), _to_micros(end)
+        with self._lock:
+            segments = [s for s in self._load(key) if s[1] > lo and s[0] < hi]
+            files = []
+            try:
+                for _, _, path in segments:
+                    files.append(open(path, 'rb'))
+                    self._touch(path)
+            except Exception:
+                for f in files:
+                    f.close()
+                raise
+        return self._read(files, lo, hi)
+
+    def _read(self, files, lo, hi):
+        try:
+            for f in files:
+                for at, value in _read_segment(f, lo, hi):
+                    yield _from_micros(at), value
+        finally:
+            for f in files:
+                f.close()
+
+    @contextmanager
+    def pinned(self, key, start, end):
+        """Keep the segments of key between start and end from being evicted
+        while the block runs, e.g. while the gaps of a range being read are
+        stored."""
+        pin = (key, _to_micros(start), _to_micros(end))
+        with self._lock:
+            self._pins.append(pin)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins.remove(pin)
+
+    def clear(self):
+        """Remove every stored segment."""
+        with self._lock:
+            for path in list(self._sizes):
+                self._remove(path)
+            self._segments.clear()
+
+    @property
+    def size(self):
+        """Total size in bytes of the stored segments."""
+        return sum(self._sizes.values())
+
+    def _directory(self, key):
+        return os.path.join(self.path, *[quote(part, safe='') for part in key])
+
+    def _scan(self):
+        """Record the size and age of segments already on disk."""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        found = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    # A segment whose writing was cut short.
+                    os.remove(os.path.join(dirpath, filename))
+                elif filename.endswith('.seg'):
+                    path = os.path.join(dirpath, filename)
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(found):
+            self._sizes[path] = size
+            self._touch(path)
+
+    def _load(self, key):
+        """Return the sorted (start, end, path) segments stored for key."""
+        segments = self._segments.get(key)
+        if segments is None:
+            segments = []
+            directory = self._directory(key)
+            if os.path.isdir(directory):
+                for filename in os.listdir(directory):
+                    if not filename.endswith('.seg'):
+                        continue
+                    start, end = filename[:-4].split('-')
+                    path = os.path.join(directory, filename)
+                    segments.append((int(start), int(end), path))
+            segments.sort()
+            self._segments[key] = segments
+        return segments
+
+    def _merge(self, key, start, end, points):
+        """Write a segment, combining it with touching ones in its partition."""
+        segments = self._load(key)
+        partition = start - start % PARTITION
+        merged = dict(points)
+        replaced = []
+        for segment in segments:
+            seg_start, seg_end, path = segment
+            if seg_start - seg_start % PARTITION != partition:
+                continue
+            if seg_end < start or seg_start > end:
+                continue
+            with open(path, 'rb') as f:
+                for at, value in _read_segment(f, seg_start, seg_end):
+                    merged.setdefault(at, value)
+            start, end = min(start, seg_start), max(end, seg_end)
+            replaced.append(segment)
+        directory = self._directory(key)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, '{}-{}.seg'.format(start, end))
+        # Write under a temporary name first, so a segment's name never
+        # claims a range its file does not hold in full.
+        with open(path + '.tmp', 'wb') as f:
+            for at in sorted(merged):
+                line = '{} {}\n'.format(at, json.dumps(merged[at]))
+                f.write(line.encode('utf-8'))
+        _replace(path + '.tmp', path)
+        for segment in replaced:
+            segments.remove(segment)
+            if segment[2] != path:
+                self._remove(segment[2])
+        segments.append((start, end, path))
+        segments.sort()
+        self._sizes[path] = os.path.getsize(path)
+        self._touch(path)
+
+    def _touch(self, path):
+        self._clock += 1
+        self._atimes[path] = self._clock
+
+    def _remove(self, path):
+        self._sizes.pop(path, None)
+        self._atimes.pop(path, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Remove least recently used segments until within max_size.
+
+        Pinned segments are kept, even if that leaves the cache over size.
+
+        """
+        pinned = set(path for key, lo, hi in self._pins
+                     for start, end, path in self._segments.get(key, ())
+                     if end > lo and start < hi)
+        total = self.size
+        for path in sorted(self._atimes, key=self._atimes.get):
+            if total <= self.max_size:
+                break
+            if path in pinned:
+                continue
+            total -= self._sizes.get(path, 0)
+            self._remove(path)
+            for segments in self._segments.values():
+                segments[:] = [s for s in segments if s[2] != path]
+
+
+def _read_segment(f, start, end):
+    """Yield (micros, value) pairs from an open segment within start to end."""
+    if os.fstat(f.fileno()).st_size == 0:
+        return
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        data.seek(_bisect_segment(data, start))
+        for line in iter(data.readline, b''):
+            at, value = line.split(b' ', 1)
+            at = int(at)
+            if at >= end:
+                break
+            yield at, json.loads(value.decode('utf-8'))
+    finally:
+        data.close()
+
+
+# Renames a file over an existing one, on Windows too.
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _bisect_segment(data, at):
+    """Return the offset of the first line in data not earlier than at."""
+    lo, hi = 0, len(data)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        line_start = data.rfind(b'\n', 0, mid) + 1
+        line_end = data.find(b'\n', line_start)
+        if int(data[line_start:data.find(b' ', line_start)]) < at:
+            lo = line_end + 1
+        else:
+            hi = line_start
+    return lo
+
+
+def _to_micros(value):
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def _from_micros(value):
+    return EPOCH + timedelta(microseconds=value)
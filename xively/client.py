@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import json
+import threading
+import weakref
 
 from datetime import datetime
 
@@ -13,6 +15,8 @@ from requests.auth import AuthBase
 from requests.sessions import Session
 
 import xively
+from xively.payload import RawPayload
+from xively.serializer import Serializer
 
 
 __all__ = ['Client']
@@ -41,6 +45,17 @@ class Client(Session):
     :param use_ssl: Use https for all connections instead of http
     :type use_ssl: bool [False]
     :param verify: Verify SSL certificates (default: True)
+    :param coalesce_requests: Share a single request and response between
+        identical GET requests made at the same time from several threads.
+        Only the round trip is shared, each caller still decodes the body
+    :type coalesce_requests: bool [False]
+    :param chunked_uploads: Encode request data as it is sent, using chunked
+        transfer encoding, so the whole JSON document is never held in
+        memory at once
+    :type chunked_uploads: bool [False]
+    :param thread_safe: Send the requests of each thread through a session
+        of its own, so one client can be shared between threads
+    :type thread_safe: bool [False]
 
     A Client instance can also be used when you want low level access to the
     API and can be used with CSV or XML instead of the default JSON.
@@ -55,7 +70,13 @@ class Client(Session):
     """
     BASE_URL = "//api.xively.com"
 
-    def __init__(self, key, use_ssl=False, verify=True):
+    # Settings shared by the client with the sessions of each thread.
+    _shared_attrs = ('headers', 'auth', 'proxies', 'hooks', 'params',
+                     'verify', 'cert', 'stream', 'trust_env', 'max_redirects')
+
+    def __init__(self, key, use_ssl=False, verify=True,
+                 coalesce_requests=False, chunked_uploads=False,
+                 thread_safe=False):
         super(Client, self).__init__()
         self.auth = KeyAuth(key)
         self.base_url = ('https:' if use_ssl else 'http:') + self.BASE_URL
@@ -64,17 +85,124 @@ class Client(Session):
             xively.__version__, self.headers['User-Agent'])
         self._json_encoder = JSONEncoder()
         self.verify = verify
+        self.coalesce_requests = coalesce_requests
+        self.chunked_uploads = chunked_uploads
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self.thread_safe = thread_safe
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
 
     def request(self, method, url, *args, **kwargs):
         """Constructs and sends a Request to the Xively API.
 
-        Objects that implement __getstate__  will be serialised.
+        Objects that implement __getstate__  will be serialised. A
+        :class:`.RawPayload` is sent as it is, with its content type.
+
+        With ``coalesce_requests`` set, while a GET request is in flight,
+        identical GET requests (same url and parameters) from other threads
+        wait for it and are given the same response instead of being sent
+        themselves. The managers change the data they decode, so each caller
+        decodes the shared body on its own.
+
+        In thread safe mode the request is sent through the calling thread's
+        own session, see :meth:`thread_session`.
 
         """
-        full_url = urljoin(self.base_url, url)
-        if 'data' in kwargs:
+        if url.startswith(('http://', 'https://')):
+            full_url = url
+        else:
+            full_url = urljoin(self.base_url, url)
+        if isinstance(kwargs.get('data'), RawPayload):
+            payload = kwargs['data']
+            kwargs['data'] = payload.body
+            if payload.content_type != self.headers['Content-Type']:
+                headers = dict(kwargs.get('headers') or {})
+                headers['Content-Type'] = payload.content_type
+                kwargs['headers'] = headers
+        elif self.chunked_uploads and 'data' in kwargs and not isinstance(
+                kwargs['data'], _plain_types):
+            kwargs['data'] = self._json_encoder.iterchunks(kwargs['data'])
+        elif 'data' in kwargs:
             kwargs['data'] = self._encode_data(kwargs['data'])
-        return super(Client, self).request(method, full_url, *args, **kwargs)
+        if self.thread_safe:
+            send = self.thread_session().request
+        else:
+            send = super(Client, self).request
+        if (self.coalesce_requests and method.upper() == 'GET' and
+                not args and not kwargs.get('stream')):
+            key = (full_url, repr(sorted(
+                (name, sorted(value.items()) if isinstance(value, dict)
+                 else value) for name, value in kwargs.items())))
+            return self._single_flight(
+                key, lambda: send(method, full_url, **kwargs))
+        return send(method, full_url, *args, **kwargs)
+
+    def thread_session(self):
+        """Returns the session used to send the calling thread's requests.
+
+        Each thread's session has its own connection pool and cookies. Its
+        headers, auth and other settings are taken from the client every
+        time this is called, so a change to ``client.headers`` or
+        ``client.verify`` applies to the next request of every thread.
+
+        The sessions of threads which have exited are closed when another
+        thread's session is created.
+
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = Session()
+            thread = threading.current_thread()
+            with self._sessions_lock:
+                sessions, dead = [], []
+                for ref, other in self._sessions:
+                    owner = ref()
+                    if owner is None or not owner.is_alive():
+                        dead.append(other)
+                    else:
+                        sessions.append((ref, other))
+                sessions.append((weakref.ref(thread), session))
+                self._sessions = sessions
+            for other in dead:
+                other.close()
+        for name in self._shared_attrs:
+            setattr(session, name, getattr(self, name))
+        return session
+
+    def close(self):
+        """Closes the connections of the client and of every thread."""
+        with self._sessions_lock:
+            sessions, self._sessions = self._sessions, []
+        for _, session in sessions:
+            session.close()
+        self._local = threading.local()
+        super(Client, self).close()
+
+    def _single_flight(self, key, send):
+        """Returns the response of send, sharing it with identical calls."""
+        with self._in_flight_lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _InFlight()
+        if leader:
+            try:
+                call.response = send()
+                # Read the body now so every caller can decode it.
+                call.response.content
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._in_flight_lock:
+                    del self._in_flight[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.response
 
     def _encode_data(self, data, **kwargs):
         """Returns data encoded as JSON using a custom encoder.
@@ -94,8 +222,37 @@ class Client(Session):
         return encoder.encode(data)
 
 
+class _InFlight(object):
+    """A request in flight and the response or error it ended with."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
 class JSONEncoder(json.JSONEncoder):
-    """Encoder that can handle datetime objects or xively models."""
+    """Encoder that can handle datetime objects or xively models.
+
+    With the default separators and options, models are encoded by a
+    :class:`.Serializer`, which gives the same output without turning each
+    model into a dict first.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(JSONEncoder, self).__init__(*args, **kwargs)
+        # A serializer for each value of sort_keys, which can be changed.
+        self._serializers = {}
+
+    def encode(self, o):
+        if not Serializer.supports(self):
+            return super(JSONEncoder, self).encode(o)
+        serializer = self._serializers.get(self.sort_keys)
+        if serializer is None:
+            serializer = Serializer(self, self.sort_keys)
+            self._serializers[self.sort_keys] = serializer
+        return serializer.encode(o)
 
     def default(self, obj):
         if isinstance(obj, datetime):
@@ -104,3 +261,100 @@ class JSONEncoder(json.JSONEncoder):
             return obj.__getstate__()
         else:
             return json.JSONEncoder.default(self, obj)
+
+    def iterchunks(self, obj, chunk_size=16384):
+        """Yields obj encoded as UTF-8 JSON, about chunk_size bytes at a time.
+
+        Models are only turned into their state as they are reached, so a
+        feed with many datastreams and datapoints is never encoded, or its
+        whole state built, all at once.
+
+        >>> encoder = JSONEncoder(sort_keys=True)
+        >>> feed = xively.Feed(title="The Answer")
+        >>> chunks = list(encoder.iterchunks({'feed': feed}, chunk_size=16))
+        >>> len(chunks)
+        3
+        >>> print(b''.join(chunks).decode('utf-8'))
+        {"feed": {"title": "The Answer", "version": "1.0.0"}}
+
+        """
+        chunk, size = [], 0
+        for fragment in self._iterfragments(obj):
+            chunk.append(fragment)
+            size += len(fragment)
+            if size >= chunk_size:
+                yield ''.join(chunk).encode('utf-8')
+                chunk, size = [], 0
+        if chunk:
+            yield ''.join(chunk).encode('utf-8')
+
+    def _iterfragments(self, obj):
+        """Yields the fragments of JSON text making up obj."""
+        if isinstance(obj, dict):
+            items = sorted(obj.items()) if self.sort_keys else obj.items()
+            separator = '{'
+            for key, value in items:
+                key = self._encode_key(key)
+                if key is None:
+                    continue
+                yield separator + key + ': '
+                for fragment in self._iterfragments(value):
+                    yield fragment
+                separator = ', '
+            yield '}' if separator == ', ' else '{}'
+        elif isinstance(obj, (list, tuple)):
+            separator = '['
+            for value in obj:
+                yield separator
+                for fragment in self._iterfragments(value):
+                    yield fragment
+                separator = ', '
+            yield ']' if separator == ', ' else '[]'
+        elif isinstance(obj, _scalar_types) or obj is None:
+            yield self.encode(obj)
+        else:
+            for fragment in self._iterfragments(self.default(obj)):
+                yield fragment
+
+    def _encode_key(self, key):
+        """Returns a dict key encoded as a JSON string, as json.dumps does.
+
+        None is returned for keys skipped with ``skipkeys``.
+
+        >>> encoder = JSONEncoder()
+        >>> [encoder._encode_key(key) for key in ("a", 1, 1.5, True, None)]
+        ['"a"', '"1"', '"1.5"', '"true"', '"null"']
+
+        """
+        if isinstance(key, _string_types):
+            pass
+        elif isinstance(key, float):
+            key = self.encode(float(key))
+        elif key is True:
+            key = 'true'
+        elif key is False:
+            key = 'false'
+        elif key is None:
+            key = 'null'
+        elif isinstance(key, _integer_types):
+            key = str(int(key))
+        elif self.skipkeys:
+            return None
+        else:
+            raise TypeError(
+                "keys must be str, int, float, bool or None, not {0}".format(
+                    key.__class__.__name__))
+        return self.encode(key)
+
+
+try:
+    _string_types = (basestring,)
+    _integer_types = (int, long)
+    _scalar_types = (basestring, int, long, float)
+except NameError:
+    _string_types = (str,)
+    _integer_types = (int,)
+    _scalar_types = (str, int, float)
+
+# Request data that is encoded whole even with chunked uploads.
+_plain_types = _scalar_types + (bytes, type(None))
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Find out which models hold memory and where time goes in a process.
+
+Diagnostics are off until :func:`enable` is called, and cost nothing until
+then::
+
+    >>> import xively.diagnostics
+    >>> xively.diagnostics.enable()
+    >>> api = xively.XivelyAPIClient("API_KEY")
+    >>> feed = api.feeds.get(7021)
+    >>> xively.diagnostics.live_instances()['Feed'] >= 1
+    True
+    >>> xively.diagnostics.timings()['FeedsManager._coerce_feed'][0]
+    1
+    >>> xively.diagnostics.report()  # doctest: +ELLIPSIS
+    Live instances:
+    ...
+    >>> xively.diagnostics.disable()
+
+"""
+
+import atexit
+import functools
+import gc
+import os
+import sys
+import threading
+import time
+
+from xively import managers, models, serializer
+
+
+__all__ = ['enable', 'disable', 'reset', 'live_instances', 'allocations',
+           'timings', 'report']
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# The methods replaced by timed versions, as (class, name, original).
+_patched = []
+# Number of calls and seconds spent in each timed method, by name.
+_timings = {}
+_timings_lock = threading.Lock()
+# The names of the timed methods running in each thread, so that calls
+# nested in a call of the same method are not counted twice.
+_running = threading.local()
+_state = {'enabled': False, 'tracemalloc': False, 'at_exit': False}
+
+
+def enable(allocations=True, frames=1, at_exit=False):
+    """Start collecting diagnostics.
+
+    Calls of the ``_coerce_*`` methods of the managers, of the
+    ``__getstate__`` method of the models and of
+    :meth:`.Serializer.encode` are timed, and the allocations made by the
+    package are traced when tracemalloc is available.
+
+    :param allocations: Trace memory allocations with tracemalloc
+    :param frames: Number of frames stored per traced allocation
+    :param at_exit: Print a :func:`report` when the interpreter exits
+
+    """
+    if _state['enabled']:
+        return
+    _state['enabled'] = True
+    for module, prefix in ((managers, '_coerce_'), (models, '__getstate__'),
+                           (serializer, 'encode')):
+        for cls in _classes(module):
+            for name, func in list(vars(cls).items()):
+                if name.startswith(prefix) and callable(func):
+                    _patched.append((cls, name, func))
+                    setattr(cls, name, _timed(name, func))
+    if allocations:
+        tracemalloc = _tracemalloc()
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            _state['tracemalloc'] = True
+    if at_exit and not _state['at_exit']:
+        atexit.register(_report_at_exit)
+        _state['at_exit'] = True
+
+
+def disable():
+    """Stop collecting diagnostics, keeping what was collected."""
+    while _patched:
+        cls, name, func = _patched.pop()
+        setattr(cls, name, func)
+    if _state['tracemalloc']:
+        _tracemalloc().stop()
+        _state['tracemalloc'] = False
+    _state['enabled'] = False
+    _state['at_exit'] = False
+
+
+def reset():
+    """Forget the timings collected so far."""
+    with _timings_lock:
+        _timings.clear()
+
+
+def live_instances():
+    """Return the number of model instances alive, by class name."""
+    counts = {}
+    for obj in gc.get_objects():
+        if isinstance(obj, models.Base):
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def allocations(limit=10):
+    """Return the lines of the package allocating the most memory alive.
+
+    :param limit: Number of lines returned
+    :returns: A list of ``(filename:lineno, size in bytes, count)`` tuples,
+        largest first, or an empty list if allocations are not traced
+
+    """
+    tracemalloc = _tracemalloc()
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return []
+    package = os.path.dirname(os.path.abspath(models.__file__))
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(True, os.path.join(package, '*')),
+        tracemalloc.Filter(False, __file__),
+    ])
+    result = []
+    for stat in snapshot.statistics('lineno')[:limit]:
+        frame = stat.traceback[0]
+        location = "{}:{}".format(
+            os.path.relpath(frame.filename, os.path.dirname(package)),
+            frame.lineno)
+        result.append((location, stat.size, stat.count))
+    return result
+
+
+def timings():
+    """Return the number of calls and seconds spent in each timed method.
+
+    The time of a method includes the methods it calls, e.g. the time of
+    ``FeedsManager._coerce_feed`` includes coercing the feed's datastreams.
+
+    :returns: A dict of ``{'Class.method': (calls, seconds)}``
+
+    """
+    with _timings_lock:
+        return dict((name, tuple(timing))
+                    for name, timing in _timings.items())
+
+
+def report(file=None, limit=10):
+    """Print the live instances, allocations and timings collected.
+
+    :param file: The file to print to (default: sys.stdout)
+    :param limit: Number of allocating lines printed
+
+    """
+    file = file or sys.stdout
+    lines = ["Live instances:"]
+    for name, count in sorted(live_instances().items(),
+                              key=lambda item: (-item[1], item[0])):
+        lines.append("  {:<24} {:>10}".format(name, count))
+    stats = allocations(limit)
+    if stats:
+        lines.append("Allocations:")
+        for location, size, count in stats:
+            lines.append("  {:<40} {:>10.1f} KiB {:>8} blocks".format(
+                location, size / 1024.0, count))
+    lines.append("Timings:")
+    for name, (calls, seconds) in sorted(timings().items(),
+                                         key=lambda item: -item[1][1]):
+        lines.append("  {:<40} {:>8} calls {:>10.6f} s".format(
+            name, calls, seconds))
+    file.write("\n".join(lines) + "\n")
+
+
+def _report_at_exit():
+    if _state['at_exit']:
+        report(sys.stderr)
+
+
+def _timed(name, func):
+    """Return func wrapped to add its calls to the timings, by class."""
+    @functools.wraps(func)
+    def timed(self, *args, **kwargs):
+        key = "{}.{}".format(type(self).__name__, name)
+        running = getattr(_running, 'keys', None)
+        if running is None:
+            running = _running.keys = set()
+        if key in running:
+            return func(self, *args, **kwargs)
+        running.add(key)
+        started = _clock()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            seconds = _clock() - started
+            running.discard(key)
+            with _timings_lock:
+                timing = _timings.setdefault(key, [0, 0.0])
+                timing[0] += 1
+                timing[1] += seconds
+    return timed
+
+
+def _classes(module):
+    """Return the classes defined in a module."""
+    return [obj for obj in vars(module).values()
+            if isinstance(obj, type) and obj.__module__ == module.__name__]
+
+
+def _tracemalloc():
+    try:
+        import tracemalloc
+    except ImportError:
+        # Python 2 has no tracemalloc.
+        return None
+    return tracemalloc
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+
+try:
+    from Queue import Empty, Full, Queue
+except ImportError:
+    from queue import Empty, Full, Queue  # NOQA
+
+
+__all__ = ['HistoryExporter']
+
+
+COLUMNS = ('feed_id', 'stream_id', 'at', 'value')
+
+# Marks the end of the rows on the output queue.
+_DONE = object()
+
+
+class HistoryExporter(object):
+    """Export the history of many feeds to Arrow IPC or Parquet files.
+
+    Feeds and their datastreams are fetched by a pool of threads, each
+    paging through the history of one datastream at a time. Rows are passed
+    to the writer through a bounded queue and written out in record batches
+    so memory use does not grow with the amount of history exported.
+
+    Writing files requires `pyarrow <https://arrow.apache.org/>`_, the
+    column batches themselves are available without it from
+    :meth:`batches`.
+
+    :param api: A :class:`.XivelyAPIClient` instance
+    :param workers: Number of datastreams to fetch concurrently
+    :type workers: int [4]
+    :param batch_size: Number of rows in each record batch
+    :type batch_size: int [10000]
+
+    Usage::
+
+        >>> import xively
+        >>> import datetime
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> exporter = xively.HistoryExporter(api)
+        >>> batches = exporter.batches(
+        ...     [7021],
+        ...     start=datetime.datetime(2013, 1, 1, 14, 0, 0),
+        ...     end=datetime.datetime(2013, 1, 1, 16, 0, 0))
+        >>> sorted(next(batches))
+        ['at', 'feed_id', 'stream_id', 'value']
+
+    """
+
+    def __init__(self, api, workers=4, batch_size=10000):
+        self.api = api
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def batches(self, feed_ids, start, end, interval=None):
+        """Yield dicts of equal length column lists for the history found.
+
+        :param feed_ids: The IDs of the feeds to export
+        :param start: Defines the starting point of the export
+        :param end: Defines the end point of the export
+        :param interval: The interval of the datapoints exported, see
+            :meth:`~.DatapointsManager.history`
+
+        """
+        rows = Queue(maxsize=self.batch_size)
+        tasks = Queue()
+        errors = []
+        # Set when the export fails or the consumer stops early, so that
+        # the threads stop fetching instead of blocking on a full queue.
+        stopped = threading.Event()
+        for feed_id in feed_ids:
+            tasks.put((feed_id, None))
+
+        def put(row):
+            while not stopped.is_set():
+                try:
+                    rows.put(row, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def work():
+            while True:
+                task = tasks.get()
+                try:
+                    if task is None:
+                        break
+                    if stopped.is_set():
+                        continue
+                    feed_id, datastream = task
+                    if datastream is None:
+                        feed = self.api.feeds.get(feed_id)
+                        for datastream in feed.datastreams:
+                            tasks.put((feed_id, datastream))
+                    else:
+                        self._fetch(put, feed_id, datastream,
+                                    start, end, interval)
+                except Exception:
+                    errors.append(sys.exc_info())
+                    stopped.set()
+                finally:
+                    tasks.task_done()
+
+        def finish():
+            tasks.join()
+            put(_DONE)
+
+        threads = [threading.Thread(target=work)
+                   for _ in range(self.workers)]
+        threads.append(threading.Thread(target=finish))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            batch = _empty_batch()
+            while not errors:
+                try:
+                    row = rows.get(timeout=0.1)
+                except Empty:
+                    continue
+                if row is _DONE:
+                    break
+                for name, value in zip(COLUMNS, row):
+                    batch[name].append(value)
+                if len(batch['at']) >= self.batch_size:
+                    yield batch
+                    batch = _empty_batch()
+            if errors:
+                exc_type, exc_value, traceback = errors[0]
+                raise exc_value
+            if batch['at']:
+                yield batch
+        finally:
+            stopped.set()
+            for _ in range(self.workers):
+                tasks.put(None)
+
+    def export(self, feed_ids, start, end, path, format='parquet',
+               interval=None):
+        """Write the history of the given feeds to a file.
+
+        :param feed_ids: The IDs of the feeds to export
+        :param start: Defines the starting point of the export
+        :param end: Defines the end point of the export
+        :param path: The file to write
+        :param format: Either 'parquet' or 'arrow' (Arrow IPC file format)
+        :param interval: The interval of the datapoints exported
+        :returns: The number of rows written
+
+        """
+        import pyarrow
+        schema = pyarrow.schema([
+            ('feed_id', pyarrow.string()),
+            ('stream_id', pyarrow.string()),
+            ('at', pyarrow.timestamp('us')),
+            ('value', pyarrow.string()),
+        ])
+        if format == 'parquet':
+            import pyarrow.parquet
+            writer = pyarrow.parquet.ParquetWriter(path, schema)
+            write = writer.write_table
+            make = pyarrow.Table.from_batches
+        elif format == 'arrow':
+            import pyarrow.ipc
+            writer = pyarrow.ipc.new_file(path, schema)
+            write = writer.write_batch
+            make = None
+        else:
+            raise ValueError("Unknown export format: {!r}".format(format))
+        count = 0
+        try:
+            for batch in self.batches(feed_ids, start, end, interval):
+                record_batch = pyarrow.RecordBatch.from_arrays(
+                    [pyarrow.array(batch[name], type=field.type)
+                     for name, field in zip(COLUMNS, schema)],
+                    schema=schema)
+                write(make([record_batch]) if make else record_batch)
+                count += record_batch.num_rows
+        finally:
+            writer.close()
+        return count
+
+    def _fetch(self, put, feed_id, datastream, start, end, interval):
+        """Queue a row for each datapoint of a datastream with put, until
+        put returns False."""
+        params = {'interval': interval} if interval is not None else {}
+        datapoints = datastream.datapoints._paginate_history(
+            start, end, **params)
+        feed_id, stream_id = str(feed_id), str(datastream.id)
+        for datapoint in datapoints:
+            value = datapoint.value
+            if not put((feed_id, stream_id, datapoint.at,
+                        value if value is None else str(value))):
+                return
+
+
+def _empty_batch():
+    return {name: [] for name in COLUMNS}
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+import math
+
+from array import array
+from bisect import bisect_left, insort
+from collections import Sequence
+from datetime import datetime, timedelta
+
+from xively.models import Waypoint
+
+
+__all__ = ['FeedLocationIndex', 'WaypointTrack']
+
+
+EPOCH = datetime(1970, 1, 1)
+
+# Mean radius of the earth in metres.
+EARTH_RADIUS = 6371008.8
+
+# Metres in each of the distance units accepted by the API.
+DISTANCE_UNITS = {'kms': 1000.0, 'miles': 1609.344}
+
+
+class WaypointTrack(Sequence):
+    """The waypoints of a mobile feed, stored as parallel arrays.
+
+    Instead of a :class:`.Waypoint` object per fix, a track keeps the time
+    (in seconds since the epoch), latitude, longitude and elevation of every
+    fix in four arrays of floats, sorted by time. Indexing a track returns
+    a new :class:`.Waypoint` each time, and slicing it returns another
+    track.
+
+    Feeds fetched from the API keep their waypoints as a list of
+    :class:`.Waypoint` objects, unless fetched with ``waypoints='track'``,
+    see :meth:`.FeedsManager.get`. :attr:`.Location.track` gives the
+    waypoints as a track either way.
+
+    :param waypoints: :class:`.Waypoint` objects, or dicts with 'at', 'lat',
+        'lon' and optionally 'ele' keys
+    :param cell_size: Size in degrees of the cells of the grid used by
+        :meth:`within`
+
+    Usage::
+
+        >>> import xively
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> feed = api.feeds.get(3819, waypoints='track')
+        >>> track = feed.location.track
+        >>> len(track)
+        6
+        >>> track[0].lat, track[0].lon
+        (24.9966, 55.06608)
+        >>> round(track.distance(), 1)
+        54.7
+
+    """
+
+    def __init__(self, waypoints=(), cell_size=0.01):
+        self.cell_size = cell_size
+        self._times = array('d')
+        self._lats = array('d')
+        self._lons = array('d')
+        self._eles = array('d')
+        self._grid = None
+        for waypoint in waypoints:
+            self.append(waypoint)
+
+    @classmethod
+    def from_data(cls, waypoints_data, **kwargs):
+        """Return a track from waypoints as decoded from API JSON.
+
+        The timestamps are parsed directly into seconds, without creating
+        datetime objects.
+
+        """
+        track = cls(**kwargs)
+        rows = sorted((_to_seconds(data['at']), data['lat'], data['lon'],
+                       data.get('ele')) for data in waypoints_data)
+        for at, lat, lon, ele in rows:
+            track._times.append(at)
+            track._lats.append(lat)
+            track._lons.append(lon)
+            track._eles.append(_NAN if ele is None else ele)
+        return track
+
+    def __len__(self):
+        return len(self._times)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._take(item)
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("waypoint index out of range")
+        waypoint = Waypoint(_from_seconds(self._times[item]),
+                            self._lats[item], self._lons[item])
+        if not math.isnan(self._eles[item]):
+            waypoint.ele = self._eles[item]
+        return waypoint
+
+    def __getstate__(self):
+        return [waypoint.__getstate__() for waypoint in self]
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    @property
+    def times(self):
+        """The times of the fixes, in seconds since the epoch."""
+        return self._times
+
+    @property
+    def lats(self):
+        """The latitudes of the fixes."""
+        return self._lats
+
+    @property
+    def lons(self):
+        """The longitudes of the fixes."""
+        return self._lons
+
+    @property
+    def eles(self):
+        """The elevations of the fixes, NaN where unknown."""
+        return self._eles
+
+    def append(self, waypoint):
+        """Add a waypoint, keeping the track in time order."""
+        if isinstance(waypoint, Waypoint):
+            waypoint = waypoint._data
+        at = _to_seconds(waypoint['at'])
+        ele = waypoint.get('ele')
+        if self._times and at < self._times[-1]:
+            index = bisect_left(self._times, at)
+            self._times.insert(index, at)
+            self._lats.insert(index, waypoint['lat'])
+            self._lons.insert(index, waypoint['lon'])
+            self._eles.insert(index, _NAN if ele is None else ele)
+            self._grid = None
+        else:
+            self._times.append(at)
+            self._lats.append(waypoint['lat'])
+            self._lons.append(waypoint['lon'])
+            self._eles.append(_NAN if ele is None else ele)
+            if self._grid is not None:
+                self._index(len(self) - 1)
+
+    def between(self, start, end):
+        """Return the part of the track from start up to (not including) end.
+
+        :param start: A datetime, or None for the start of the track
+        :param end: A datetime, or None for the end of the track
+
+        """
+        lo = 0 if start is None else bisect_left(
+            self._times, _to_seconds(start))
+        hi = len(self) if end is None else bisect_left(
+            self._times, _to_seconds(end))
+        return self._take(slice(lo, hi))
+
+    def distances(self):
+        """Return the great circle distance in metres between each fix."""
+        distances = array('d')
+        lats, lons = self._lats, self._lons
+        for i in range(1, len(self)):
+            distances.append(_haversine(
+                lats[i - 1], lons[i - 1], lats[i], lons[i]))
+        return distances
+
+    def distance(self):
+        """Return the length of the whole track in metres."""
+        return math.fsum(self.distances())
+
+    def speeds(self):
+        """Return the speed in metres per second between each fix.
+
+        The speed between two fixes taken at the same time is NaN.
+
+        """
+        speeds = array('d')
+        times = self._times
+        for i, distance in enumerate(self.distances(), 1):
+            seconds = times[i] - times[i - 1]
+            speeds.append(distance / seconds if seconds else _NAN)
+        return speeds
+
+    def speed(self):
+        """Return the average speed over the track in metres per second."""
+        if len(self) < 2 or self._times[-1] == self._times[0]:
+            return _NAN
+        return self.distance() / (self._times[-1] - self._times[0])
+
+    def within(self, south, west, north, east):
+        """Return the fixes inside a bounding box as a track.
+
+        The fixes are found through a grid of ``cell_size`` degree cells,
+        built on first use. A box with west greater than east crosses the
+        antimeridian.
+
+        """
+        if west > east:
+            indexes = (self._search(south, west, north, 180.0) +
+                       self._search(south, -180.0, north, east))
+        else:
+            indexes = self._search(south, west, north, east)
+        return self._take(sorted(set(indexes)))
+
+    def _search(self, south, west, north, east):
+        if self._grid is None:
+            self._grid = {}
+            for i in range(len(self)):
+                self._index(i)
+        rows = range(self._cell(south), self._cell(north) + 1)
+        columns = range(self._cell(west), self._cell(east) + 1)
+        if len(rows) * len(columns) > len(self):
+            candidates = range(len(self))
+        else:
+            candidates = [i for row in rows for column in columns
+                          for i in self._grid.get((row, column), ())]
+        lats, lons = self._lats, self._lons
+        return [i for i in candidates
+                if south <= lats[i] <= north and west <= lons[i] <= east]
+
+    def _cell(self, degrees):
+        return int(math.floor(degrees / self.cell_size))
+
+    def _index(self, i):
+        cell = (self._cell(self._lats[i]), self._cell(self._lons[i]))
+        insort(self._grid.setdefault(cell, []), i)
+
+    def _take(self, indexes):
+        """Return a new track of the fixes at a slice or list of indexes."""
+        track = self.__class__(cell_size=self.cell_size)
+        for source, target in ((self._times, track._times),
+                               (self._lats, track._lats),
+                               (self._lons, track._lons),
+                               (self._eles, track._eles)):
+            if isinstance(indexes, slice):
+                target.extend(source[indexes])
+            else:
+                target.extend(source[i] for i in indexes)
+        return track
+
+
+class FeedLocationIndex(object):
+    """A local index of the locations of feeds, for map and radius searches.
+
+    The feeds matching the given :meth:`.FeedsManager.list` filters are
+    fetched once, newest first, and their locations put in a grid of
+    ``cell_size`` degree cells. Radius and bounding box queries are then
+    answered locally, without an API call. :meth:`refresh` only fetches the
+    feeds created since the last refresh.
+
+    :param manager: The :class:`.FeedsManager` to list feeds through
+    :param cell_size: Size in degrees of the grid cells
+    :param per_page: Number of feeds requested per page
+    :param filters: Other :meth:`.FeedsManager.list` parameters, e.g. ``q``,
+        ``tag`` or ``status``
+
+    Usage::
+
+        >>> import xively
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> index = xively.FeedLocationIndex(api.feeds, status='live')
+        >>> index.add(api.feeds.get(7021))
+        >>> index.near(51.5, 0.0, 20, distance_units='miles')
+        [<xively.Feed(7021)>]
+
+    """
+
+    def __init__(self, manager, cell_size=1.0, per_page=100, **filters):
+        self.manager = manager
+        self.cell_size = cell_size
+        self.per_page = per_page
+        self.filters = filters
+        self._locations = {}
+        self._grid = {}
+        self._newest = None
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __contains__(self, feed_id):
+        return feed_id in self._locations
+
+    def refresh(self):
+        """Add the feeds created since the last refresh.
+
+        Pages of feeds ordered by creation are requested until one holding
+        a feed no newer than the newest already seen, or a short page.
+
+        :returns: The number of feeds added or updated
+
+        """
+        count, newest, page = 0, None, 1
+        while True:
+            feeds = self.manager.list(
+                page=page, per_page=self.per_page, order='created_at',
+                **self.filters)
+            seen = False
+            for feed in feeds:
+                created = getattr(feed, 'created', None)
+                if (self._newest is not None and created is not None and
+                        created <= self._newest):
+                    seen = True
+                    continue
+                if created is not None and (newest is None or
+                                            created > newest):
+                    newest = created
+                self.add(feed)
+                count += 1
+            if seen or len(feeds) < self.per_page:
+                break
+            page += 1
+        if newest is not None:
+            self._newest = newest
+        return count
+
+    def add(self, feed):
+        """Index a feed by its location, or remove it if it has none."""
+        self.remove(feed.id)
+        location = getattr(feed, 'location', None)
+        try:
+            lat, lon = float(location.lat), float(location.lon)
+        except (AttributeError, TypeError, ValueError):
+            return
+        cell = (self._cell(lat), self._cell(lon))
+        self._locations[feed.id] = (lat, lon, cell, feed)
+        self._grid.setdefault(cell, {})[feed.id] = feed
+
+    def remove(self, feed_id):
+        """Remove a feed from the index, if it is there."""
+        entry = self._locations.pop(feed_id, None)
+        if entry is not None:
+            cell = self._grid[entry[2]]
+            del cell[feed_id]
+            if not cell:
+                del self._grid[entry[2]]
+
+    def within(self, south, west, north, east):
+        """Return the feeds located inside a bounding box.
+
+        A box with west greater than east crosses the antimeridian.
+
+        """
+        if west > east:
+            return (self._search(south, west, north, 180.0) +
+                    self._search(south, -180.0, north, east))
+        return self._search(south, west, north, east)
+
+    def near(self, lat, lon, distance, distance_units='kms'):
+        """Return the feeds within a distance of a point, nearest first.
+
+        :param distance: The search radius
+        :param distance_units: 'kms' (default) or 'miles', as for
+            :meth:`.FeedsManager.list`
+
+        """
+        metres = distance * DISTANCE_UNITS[distance_units]
+        degrees = math.degrees(metres / EARTH_RADIUS)
+        south, north = max(-90.0, lat - degrees), min(90.0, lat + degrees)
+        cos_lat = math.cos(math.radians(max(abs(south), abs(north))))
+        if north >= 90.0 or south <= -90.0 or degrees >= 180 * cos_lat:
+            west, east = -180.0, 180.0
+        else:
+            span = degrees / cos_lat
+            west = (lon - span + 180.0) % 360.0 - 180.0
+            east = (lon + span + 180.0) % 360.0 - 180.0
+        found = []
+        for feed in self.within(south, west, north, east):
+            feed_lat, feed_lon = self._locations[feed.id][:2]
+            gap = _haversine(lat, lon, feed_lat, feed_lon)
+            if gap <= metres:
+                found.append((gap, feed.id, feed))
+        found.sort(key=lambda item: item[:2])
+        return [feed for _, _, feed in found]
+
+    def _search(self, south, west, north, east):
+        rows = range(self._cell(south), self._cell(north) + 1)
+        columns = range(self._cell(west), self._cell(east) + 1)
+        if len(rows) * len(columns) > len(self._grid):
+            cells = self._grid.values()
+        else:
+            cells = [self._grid[cell] for cell in (
+                (row, column) for row in rows for column in columns)
+                if cell in self._grid]
+        locations = self._locations
+        return [feed for cell in cells for feed_id, feed in cell.items()
+                if south <= locations[feed_id][0] <= north and
+                west <= locations[feed_id][1] <= east]
+
+    def _cell(self, degrees):
+        return int(math.floor(degrees / self.cell_size))
+
+
+_NAN = float('nan')
+
+
+def _to_seconds(value):
+    """Return a datetime or API timestamp string in seconds since the epoch.
+
+    Strings are expected in the API's format, e.g.
+    "2012-06-01T12:25:05.999502Z", and are parsed by position.
+
+    """
+    if isinstance(value, datetime):
+        delta = value - EPOCH
+        return (delta.days * 86400 + delta.seconds +
+                delta.microseconds / 1000000.0)
+    seconds = calendar.timegm((
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19])))
+    fraction = value[19:].rstrip('Z')
+    return seconds + float(fraction) if fraction else float(seconds)
+
+
+def _from_seconds(value):
+    seconds = math.floor(value)
+    microseconds = int(round((value - seconds) * 1000000))
+    return EPOCH + timedelta(seconds=int(seconds), microseconds=microseconds)
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    """Return the great circle distance in metres between two points."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, a)))
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from datetime import timedelta
+
+from xively.managers import _datapoint_time
+
+
+__all__ = ['WriteJournal']
+
+
+PENDING = 'pending'
+COMMITTED = 'committed'
+
+
+class WriteJournal(object):
+    """Records which datapoints were written so retried writes are not
+    sent twice.
+
+    Before a batch of datapoints is sent, the timestamps of its datapoints
+    are recorded as pending for the datastream, and once the API accepts it
+    they are recorded as committed. When the batch is sent again, after a
+    timeout, a retry or a restart, committed datapoints are left out. With
+    ``verify`` set, pending datapoints, which may or may not have been
+    stored, are first looked for with a history query bounded to their time
+    range, and only the ones not found are sent again.
+
+    Give a journal to :meth:`.DatapointsManager.create` or
+    :meth:`~.DatapointsManager.bulk_create` to use it.
+
+    :param path: A file the journal is appended to and read back from, so
+        writes are remembered across restarts, or None to keep it in memory
+    :param verify: Look for pending datapoints in the datastream's history
+        before sending them again
+    :type verify: bool [True]
+    :param max_entries: Most committed datapoints remembered, the oldest
+        recorded are forgotten first
+    :type max_entries: int [100000]
+
+    Usage::
+
+        >>> import xively
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> feed = api.feeds.get(7021)
+        >>> datastream = feed.datastreams[0]
+        >>> journal = xively.WriteJournal()
+        >>> points = [("2013-01-01T00:00:00Z", 1), ("2013-01-01T00:01:00Z", 2)]
+        >>> datastream.datapoints.bulk_create(points, journal=journal).count
+        2
+        >>> replay = datastream.datapoints.bulk_create(points, journal=journal)
+        >>> replay.count, replay.skipped
+        (0, 2)
+
+    """
+
+    def __init__(self, path=None, verify=True, max_entries=100000):
+        self.path = path
+        self.verify = verify
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._committed = 0
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash while it was written.
+                        continue
+                    self._record(record['key'], record['at'],
+                                 record['state'])
+
+    def status(self, manager, at):
+        """Return 'pending', 'committed' or None for a datapoint's timestamp.
+
+        :param manager: The :class:`.DatapointsManager` of the datastream
+        :param at: The timestamp of the datapoint
+
+        """
+        at = _timestamp({'at': at})
+        with self._lock:
+            return self._entries.get((manager.url(), at))
+
+    def prepare(self, manager, datapoints):
+        """Return the datapoints of a batch that need sending.
+
+        Committed datapoints are left out, and so are pending ones found in
+        the datastream's history when verifying. The rest are recorded as
+        pending.
+
+        :param manager: The :class:`.DatapointsManager` of the datastream
+        :param datapoints: :class:`.Datapoint` objects or dicts with 'at' and
+            'value' keys
+
+        """
+        key = manager.url()
+        times = [_timestamp(d) for d in datapoints]
+        with self._lock:
+            states = [self._entries.get((key, t)) for t in times]
+        uncertain = [d for d, state in zip(datapoints, states)
+                     if state == PENDING]
+        if uncertain and self.verify:
+            found = self._find(manager, uncertain)
+            self._write(key, sorted(found), COMMITTED)
+            states = [COMMITTED if t in found else state
+                      for t, state in zip(times, states)]
+        batch = [d for d, state in zip(datapoints, states)
+                 if state != COMMITTED]
+        self._write(key, [_timestamp(d) for d in batch], PENDING)
+        return batch
+
+    def commit(self, manager, datapoints):
+        """Record that the API accepted the datapoints of a batch."""
+        self._write(manager.url(), [_timestamp(d) for d in datapoints],
+                    COMMITTED)
+
+    def _find(self, manager, datapoints):
+        """Return the timestamps of the datapoints found in the history."""
+        wanted = set(_timestamp(d) for d in datapoints)
+        times = sorted(_datapoint_time(d) for d in datapoints)
+        history = manager._paginate_history(
+            times[0], times[-1] + timedelta(microseconds=1))
+        return wanted.intersection(_timestamp(d) for d in history)
+
+    def _write(self, key, times, state):
+        if not times:
+            return
+        with self._lock:
+            self._record(key, times, state)
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(
+                        {'key': key, 'at': times, 'state': state}) + '\n')
+
+    def _record(self, key, times, state):
+        for at in times:
+            if self._entries.pop((key, at), None) == COMMITTED:
+                self._committed -= 1
+            self._entries[(key, at)] = state
+            if state == COMMITTED:
+                self._committed += 1
+        if self._committed > self.max_entries:
+            # Forget the oldest committed datapoints, keeping pending ones.
+            excess = self._committed - self.max_entries
+            stale = []
+            for entry, entry_state in self._entries.items():
+                if len(stale) == excess:
+                    break
+                if entry_state == COMMITTED:
+                    stale.append(entry)
+            for entry in stale:
+                del self._entries[entry]
+            self._committed -= len(stale)
+
+
+def _timestamp(datapoint):
+    """Return the timestamp of a datapoint as a string, however it was
+    given, to compare datapoints by."""
+    return _datapoint_time(datapoint).strftime("%Y-%m-%dT%H:%M:%S.%f")
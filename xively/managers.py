@@ -1,13 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import heapq
+import re
+import threading
+import time
+
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import Sequence
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import islice
 
 try:
     from urlparse import urljoin
 except ImportError:
     from urllib.parse import urljoin  # NOQA
 
+try:
+    from Queue import Empty, Full, Queue
+except ImportError:
+    from queue import Empty, Full, Queue  # NOQA
+
+from xively.aio import AsyncPageIterator
+from xively.geo import WaypointTrack
 from xively.models import (
     Datapoint,
     Datastream,
@@ -20,35 +35,90 @@ from xively.models import (
     Unit,
     Waypoint,
 )
+from xively.payload import RawPayload
+from xively.subscriptions import Subscription
+
+
+# The most datapoints the API will return for a single history query.
+MAX_DATAPOINTS = 1000
+
+# The longest time range that can be queried at once for each interval.
+MAX_HISTORY_RANGES = (
+    (0, timedelta(hours=6)),
+    (30, timedelta(hours=12)),
+    (60, timedelta(hours=24)),
+    (300, timedelta(days=5)),
+    (900, timedelta(days=14)),
+    (1800, timedelta(days=31)),
+    (3600, timedelta(days=31)),
+    (10800, timedelta(days=90)),
+    (21600, timedelta(days=180)),
+    (43200, timedelta(days=365)),
+    (86400, timedelta(days=365)),
+)
+
+
+# Ids which can be appended to a base url as they are, without urljoin.
+_SIMPLE_ID = re.compile(r'^(?!\.\.?$)[^/:?#]+$')
 
 
 class ManagerBase(object):
     """Abstract base class for all of out manager classes."""
 
+    _base_url = None
+
+    # The key, base url and url prefix last built from the parent object.
+    _route = None
+
     @property
     def base_url(self):
-        if getattr(self, '_base_url', None) is not None:
+        if self._base_url is not None:
             return self._base_url
-        parent = getattr(self, 'parent', None)
-        if parent is None:
-            return
-        manager = getattr(parent, '_manager', None)
-        if manager is None:
-            return
-        base_url = manager.url(parent.id) + '/' + self.resource
-        return base_url
+        route = self._parent_route()
+        return route and route[1]
 
     @base_url.setter  # NOQA
     def base_url(self, base_url):
         self._base_url = base_url
+        self._prefix = base_url + '/'
 
     def url(self, id_or_url=None):
         """Return a url relative to the base url."""
-        url = self.base_url
+        if self._base_url is not None:
+            url, prefix = self._base_url, self._prefix
+        else:
+            route = self._parent_route()
+            if route is None:
+                return
+            _, url, prefix = route
         if id_or_url:
-            url = urljoin(url + '/', str(id_or_url))
+            id_or_url = str(id_or_url)
+            if _SIMPLE_ID.match(id_or_url):
+                url = prefix + id_or_url
+            else:
+                url = urljoin(prefix, id_or_url)
         return url
 
+    def _parent_route(self):
+        """Return the base url built from the parent's url and id.
+
+        The url is only built again when the id of the parent, or the base
+        url of its manager, has changed.
+
+        """
+        parent = getattr(self, 'parent', None)
+        if parent is None:
+            return
+        manager = getattr(parent, '_manager', None)
+        if manager is None:
+            return
+        key = (parent.id, manager.base_url)
+        route = self._route
+        if route is None or route[0] != key:
+            base_url = manager.url(parent.id) + '/' + self.resource
+            route = self._route = (key, base_url, base_url + '/')
+        return route
+
     def _parse_datetime(self, value):
         """Parse and return a datetime string from the Xively API."""
         return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
@@ -137,17 +207,21 @@ class FeedsManager(ManagerBase):
         location = response.headers['location']
         feed.feed = location
         feed.id = _id_from_url(location)
+        feed._mark_saved()
         return feed
 
-    def update(self, id_or_url, **kwargs):
+    def update(self, id_or_url, payload=None, **kwargs):
         """Updates an existing feed by its id or url.
 
         :param id_or_url: The id of a :class:`.Feed` or its URL
+        :param payload: A :class:`.RawPayload` to send instead of fields
         :param kwargs: The fields to be updated
 
         """
+        if payload is not None and kwargs:
+            raise ValueError("Give either a payload or fields to update")
         url = self.url(id_or_url)
-        response = self.client.put(url, data=kwargs)
+        response = self.client.put(url, data=payload or kwargs)
         response.raise_for_status()
 
     def list(self, page=None, per_page=None, content=None, q=None, tag=None,
@@ -212,11 +286,13 @@ class FeedsManager(ManagerBase):
         response.raise_for_status()
         json = response.json()
         feeds = [self._coerce_feed(feed_data) for feed_data in json['results']]
+        for feed in feeds:
+            feed._mark_saved()
         return feeds
 
     def get(self, id_or_url, datastreams=None, show_user=None, start=None,
             end=None, duration=None, find_previous=None, limit=None,
-            interval_type=None, interval=None):
+            interval_type=None, interval=None, waypoints=None):
         """Fetches and returns a feed by id or url.
 
         By default the most recent datastreams are returned. It is also
@@ -245,10 +321,15 @@ class FeedsManager(ManagerBase):
             Determines what interval of data is requested and is defined in
             seconds between the datapoints. If a value is passed in which does
             not match one of these values, it is rounded up to the next value.
+        :param waypoints: 'track' to keep the waypoints of a mobile feed as a
+            :class:`.WaypointTrack`, read straight from the JSON without a
+            :class:`.Waypoint` per fix, instead of a list of waypoints
 
         See :meth:`~.DatapointsManager.history` for details.
 
         """
+        if waypoints not in (None, 'track'):
+            raise ValueError("waypoints must be None or 'track'")
         url = self.url(id_or_url)
         if isinstance(datastreams, Sequence):
             datastreams = ','.join(datastreams)
@@ -267,9 +348,138 @@ class FeedsManager(ManagerBase):
         response = self.client.get(url, params=params)
         response.raise_for_status()
         data = response.json()
+        track = None
+        location_data = data.get('location')
+        if waypoints == 'track' and location_data:
+            waypoints_data = location_data.pop('waypoints', None)
+            if waypoints_data is not None:
+                track = WaypointTrack.from_data(waypoints_data)
         feed = self._coerce_feed(data)
+        if track is not None:
+            feed.location._data['waypoints'] = track
+        feed._mark_saved()
+        return feed
+
+    def history(self, id_or_url, start, end, datastreams=None,
+                interval=None, limit=MAX_DATAPOINTS, workers=4):
+        """Fetches a feed with the complete history of its datastreams.
+
+        A feed request returns the history of every datastream at once, but
+        at most ``limit`` datapoints of each. The range is split into the
+        longest windows the API allows for the interval and the feed is
+        requested once per window. Only datastreams that came back with
+        ``limit`` datapoints are then paged through on their own, from their
+        last datapoint to the end of the window. These requests are made by
+        ``workers`` threads and the pages are joined up in time order.
+
+        :param id_or_url: The ID of the feed to retrieve or its URL
+        :param start: Defines the starting point of the history
+        :param end: Defines the end point of the history
+        :param datastreams: Only fetch the history of these datastreams
+        :type datastreams: list of datastream IDs
+        :param interval: The interval of the datapoints requested, see
+            :meth:`.DatapointsManager.history`
+        :param limit: Number of datapoints requested per datastream and
+            request, at most 1000
+        :param workers: Number of requests made at the same time
+        :returns: A :class:`.Feed` object
+        :raises ValueError: If start is not before end
+
+        Usage::
+
+            >>> import xively
+            >>> import datetime
+            >>> api = xively.XivelyAPIClient("API_KEY")
+            >>> feed = api.feeds.history(
+            ...     61916,
+            ...     start=datetime.datetime(2013, 1, 1, 14, 0, 0),
+            ...     end=datetime.datetime(2013, 1, 1, 16, 0, 0))
+            >>> [len(d.datapoints) for d in feed.datastreams]
+            [6, 6, 7]
+
+        """
+        if not start < end:
+            raise ValueError("start must be before end")
+        params = {'interval': interval} if interval is not None else {}
+        window = _max_history_range(interval)
+        windows = []
+        while start < end:
+            windows.append((start, min(end, start + window)))
+            start = windows[-1][1]
+
+        def fetch_window(window):
+            return self.get(id_or_url, datastreams=datastreams,
+                            start=window[0], end=window[1],
+                            limit=limit, **params)
+
+        feeds = _parallel(fetch_window, windows, workers)
+
+        truncated = []
+        for (_, window_end), feed in zip(windows, feeds):
+            for datastream in feed.datastreams:
+                datapoints = datastream._data.get('datapoints') or []
+                if len(datapoints) >= limit:
+                    truncated.append((datastream, datapoints[-1].at,
+                                      window_end))
+
+        def fetch_rest(item):
+            datastream, last, window_end = item
+            return list(datastream.datapoints._paginate_history(
+                last + timedelta(microseconds=1), window_end,
+                page_size=limit, **params))
+
+        rests = dict(zip([id(item[0]) for item in truncated],
+                         _parallel(fetch_rest, truncated, workers)))
+
+        feed = feeds[0]
+        series = {}
+        order = []
+        for window_feed in feeds:
+            for datastream in window_feed.datastreams:
+                if datastream.id not in series:
+                    series[datastream.id] = []
+                    order.append(datastream)
+                series[datastream.id].extend(
+                    datastream._data.get('datapoints') or [])
+                series[datastream.id].extend(rests.get(id(datastream), []))
+        feed.datastreams = order
+        for datastream in order:
+            datastream.datapoints = series[datastream.id]
+        feed._mark_saved()
         return feed
 
+    def subscribe(self, feed_ids, callback, **kwargs):
+        """Watch feeds and call back with datastreams whose values change.
+
+        The feeds are polled in background threads at intervals adapted to
+        how often each one changes. See :class:`.Subscription` for the
+        options that can be given.
+
+        :param feed_ids: The IDs of the feeds to watch
+        :param callback: Called as ``callback(feed, datastreams)`` with the
+            changed datastreams of a feed
+        :returns: The started :class:`.Subscription`, call its
+            :meth:`~.Subscription.cancel` method to stop watching
+
+        >>> import threading
+        >>> import xively
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> changes = []
+        >>> polled = threading.Event()
+        >>> def changed(feed, datastreams):
+        ...     changes.append((feed, datastreams))
+        ...     polled.set()
+        >>> subscription = api.feeds.subscribe([7021], changed)
+        >>> polled.wait(5)
+        True
+        >>> subscription.cancel()
+        >>> changes  # doctest: +IGNORE_UNICODE
+        [(<xively.Feed(7021)>, [<xively.Datastream('3')>, <xively.Datastream('4')>])]
+
+        """
+        subscription = Subscription(self, feed_ids, callback, **kwargs)
+        return subscription.start()
+
     def delete(self, id_or_url):
         """Delete a feed by id or url.
 
@@ -375,11 +585,17 @@ class DatastreamsManager(Sequence, ManagerBase):
         self.parent = feed
         feed_manager = getattr(feed, '_manager', None)
         self.client = getattr(feed_manager, 'client', None)
+        self._index = None
 
     def __contains__(self, value):
-        return value in self.datastreams['datastreams']
+        index = self._indexes()['id']
+        if isinstance(value, Datastream):
+            return index.get(value.id) is value
+        return value in index
 
     def __getitem__(self, item):
+        if isinstance(item, _string_types):
+            return self._indexes()['id'][item]
         return self._datastreams[item]
 
     def __len__(self):
@@ -389,6 +605,66 @@ class DatastreamsManager(Sequence, ManagerBase):
     def _datastreams(self):
         return self.parent._data.setdefault('datastreams', [])
 
+    def by_tag(self, tag):
+        """Return the datastreams of the feed tagged with tag.
+
+        >>> import xively
+        >>> feed = xively.Feed(title="Office", datastreams=[
+        ...     xively.Datastream(id="temp", tags=["temperature"]),
+        ...     xively.Datastream(id="rh", tags=["humidity"]),
+        ... ])
+        >>> feed.datastreams.by_tag("humidity")  # doctest: +IGNORE_UNICODE
+        [<xively.Datastream('rh')>]
+        >>> feed.datastreams["temp"].tags  # doctest: +IGNORE_UNICODE
+        ['temperature']
+        >>> "rh" in feed.datastreams
+        True
+
+        Datastreams can be looked up by ID, as above, and tested for by ID or
+        object, without searching through the list of datastreams.
+
+        """
+        return list(self._indexes()['tags'].get(tag, ()))
+
+    def by_unit(self, label):
+        """Return the datastreams of the feed whose unit has this label."""
+        return list(self._indexes()['units'].get(label, ()))
+
+    def _reindex(self):
+        """Rebuild the indexes of the datastreams by ID, tag and unit label.
+
+        The indexes are also rebuilt on the next lookup if the list of
+        datastreams is replaced or grows or shrinks in place.
+
+        """
+        datastreams = self._datastreams
+        indexes = {'id': {}, 'tags': {}, 'units': {}}
+        for datastream in datastreams:
+            if isinstance(datastream, dict):
+                data = datastream
+            else:
+                data = datastream._data
+            indexes['id'][data.get('id')] = datastream
+            tags = data.get('tags') or ()
+            if isinstance(tags, _string_types):
+                tags = [tags]
+            for tag in tags:
+                indexes['tags'].setdefault(tag, []).append(datastream)
+            unit = data.get('unit')
+            label = (unit.get('label') if isinstance(unit, dict)
+                     else getattr(unit, 'label', None))
+            if label is not None:
+                indexes['units'].setdefault(label, []).append(datastream)
+        self._index = ((id(datastreams), len(datastreams)), indexes)
+        return indexes
+
+    def _indexes(self):
+        datastreams = self._datastreams
+        if (self._index is None or
+                self._index[0] != (id(datastreams), len(datastreams))):
+            return self._reindex()
+        return self._index[1]
+
     def create(self, id, current_value=None, tags=None, unit=None,
                min_value=None, max_value=None, at=None):
         """Creates a new datastream on a feed.
@@ -418,6 +694,7 @@ class DatastreamsManager(Sequence, ManagerBase):
         }
         response = self.client.post(self.url(), data=data)
         response.raise_for_status()
+        datastream._mark_saved()
         return datastream
 
     def update(self, datastream_id, **kwargs):
@@ -450,10 +727,22 @@ class DatastreamsManager(Sequence, ManagerBase):
         json = response.json()
         for datastream_data in json.get('datastreams', []):
             datastream = self._coerce_datastream(datastream_data)
+            datastream._mark_saved()
             yield datastream
 
+    def alist(self, datastreams=None, show_user=None, executor=None):
+        """Return an async iterator of the datastreams of the parent feed.
+
+        The request is made in the executor, see :class:`.AsyncPageIterator`.
+        See :meth:`list` for the other parameters.
+
+        """
+        pages = (list(self.list(datastreams, show_user)) for _ in range(1))
+        return AsyncPageIterator(pages, executor=executor)
+
     def get(self, id_or_url, start=None, end=None, duration=None,
-            find_previous=None, limit=None, interval_type=None, interval=None):
+            find_previous=None, limit=None, interval_type=None, interval=None,
+            typed=False):
         """Fetches and returns a feed's datastream by its id.
 
         If start, end or duration are given, also returns Datapoints for that
@@ -477,6 +766,9 @@ class DatastreamsManager(Sequence, ManagerBase):
             Determines what interval of data is requested and is defined in
             seconds between the datapoints. If a value is passed in which does
             not match one of these values, it is rounded up to the next value.
+        :param typed:
+            Convert the current, min and max values and the datapoint values
+            from strings to floats, see :meth:`~.DatapointsManager.history`.
 
         See :meth:`~.DatapointsManager.history` for details.
 
@@ -496,8 +788,69 @@ class DatastreamsManager(Sequence, ManagerBase):
         response.raise_for_status()
         data = response.json()
         datastream = self._coerce_datastream(data)
+        if typed:
+            fields = [f for f in ('current_value', 'min_value', 'max_value')
+                      if datastream._data.get(f) is not None]
+            _set_floats([datastream] * len(fields), fields)
+            datapoints = datastream._data.get('datapoints') or []
+            _set_floats(datapoints, ['value'] * len(datapoints))
+        datastream._mark_saved()
         return datastream
 
+    def history(self, datastream_ids, start, end, interval=None, fill=None,
+                columns=False, typed=False):
+        """Returns the history of several datastreams merged on time.
+
+        The history of each datastream is paged through by its own thread
+        and the datapoints are merged as they arrive, so only a few pages of
+        each datastream are held in memory at once however long the range.
+
+        There is a row for every timestamp found in any of the datastreams,
+        holding the timestamp followed by the value of each datastream in the
+        order given. When a datastream has no datapoint at a row's timestamp
+        its value is filled in according to ``fill``:
+
+        * ``None`` leaves it as None
+        * ``'forward'`` repeats the last value before it, if any
+        * ``'nearest'`` takes the value of the datapoint closest in time,
+          the earlier one when two are as close
+
+        :param datastream_ids: The IDs of the datastreams to merge
+        :param start: Defines the starting point of the query
+        :param end: Defines the end point of the data returned
+        :param interval: The interval of the datapoints requested, see
+            :meth:`.DatapointsManager.history`
+        :param fill: How values missing from a row are filled in
+        :param columns: Return a dict of lists, one with the timestamps under
+            'at' and one for each datastream under its ID, instead of rows
+        :param typed: Convert the values to floats, see
+            :meth:`.DatapointsManager.history`
+        :returns: An iterator of ``(at, value, ...)`` tuples, or a dict of
+            columns
+
+        """
+        if fill not in (None, 'forward', 'nearest'):
+            raise ValueError("fill must be None, 'forward' or 'nearest'")
+        datastream_ids = list(datastream_ids)
+        params = {'interval': interval} if interval is not None else {}
+        datapoints = []
+        for datastream_id in datastream_ids:
+            datastream = self._coerce_datastream(Datastream(id=datastream_id))
+            history = datastream.datapoints._paginate_history(
+                start, end, **params)
+            if typed:
+                history = datastream.datapoints._typed_history(history)
+            datapoints.append(history)
+        rows = _merge_history(datapoints, fill)
+        if not columns:
+            return rows
+        names = ['at'] + datastream_ids
+        merged = {name: [] for name in names}
+        for row in rows:
+            for name, value in zip(names, row):
+                merged[name].append(value)
+        return merged
+
     def delete(self, id_or_url):
         """Delete a datastream by id or url.
 
@@ -538,6 +891,9 @@ class DatastreamsManager(Sequence, ManagerBase):
             # Strip out the readonly fields and manually set later.
             readonly = {f: d.pop(f) for f in self._readonly_fields if f in d}
             datastream = Datastream(**d)
+            # Set before the datapoints manager is created so it can find the
+            # client through this manager.
+            datastream._manager = self
             # Explicitely set the readonly fields we stripped out earlier.
             for name, value in readonly.items():
                 setattr(datastream, name, value)
@@ -571,9 +927,20 @@ class DatapointsManager(Sequence, ManagerBase):
         self.parent = datastream
         datastream_manager = getattr(datastream, '_manager', None)
         self.client = getattr(datastream_manager, 'client', None)
+        self._index = None
 
     def __contains__(self, value):
-        return value in self.datapoints['datapoints']
+        """Test for a datapoint, or a datapoint at a datetime, by timestamp."""
+        if not isinstance(value, (Datapoint, datetime)):
+            return value in self._datapoints
+        times, order = self._indexes()
+        at = value if isinstance(value, datetime) else _datapoint_time(value)
+        lo, hi = bisect_left(times, at), bisect_right(times, at)
+        if isinstance(value, datetime):
+            return lo < hi
+        datapoints = self._datapoints
+        return any(datapoints[order[i] if order else i] is value
+                   for i in range(lo, hi))
 
     def __getitem__(self, item):
         return self._datapoints[item]
@@ -585,11 +952,122 @@ class DatapointsManager(Sequence, ManagerBase):
     def _datapoints(self):
         return self.parent._data['datapoints']
 
-    def create(self, value, at=None):
+    def between(self, start=None, end=None):
+        """Return a view of the datapoints from start until before end.
+
+        The datapoints held are indexed by timestamp on first use, so lookups
+        by time are binary searches. Views are sequences in time order which
+        refer to the same :class:`.Datapoint` objects rather than copies.
+
+        >>> import xively
+        >>> import datetime
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> feed = api.feeds.get(7021)
+        >>> datastream = feed.datastreams.get("random5",
+        ...     start=datetime.datetime(2013, 1, 1, 14, 0, 0),
+        ...     end=datetime.datetime(2013, 1, 1, 16, 0, 0))
+        >>> view = datastream.datapoints.between(
+        ...     datetime.datetime(2013, 1, 1, 15, 0, 0),
+        ...     datetime.datetime(2013, 1, 1, 15, 30, 0))
+        >>> [d.value for d in view]  # doctest: +IGNORE_UNICODE
+        ['0.60897230', '0.52898451']
+        >>> datastream.datapoints.at_or_before(
+        ...     datetime.datetime(2013, 1, 1, 15, 0, 0)).value
+        ... # doctest: +IGNORE_UNICODE
+        '0.48122377'
+        >>> len(datastream.datapoints.resample(datetime.timedelta(hours=1)))
+        2
+
+        :param start: A datetime, or None from the first datapoint
+        :param end: A datetime, or None to the last datapoint
+
+        """
+        times, order = self._indexes()
+        lo = 0 if start is None else bisect_left(times, start)
+        hi = len(times) if end is None else bisect_left(times, end)
+        return DatapointsView(self._datapoints, _positions(order, lo, hi))
+
+    def at_or_before(self, at):
+        """Return the latest datapoint not later than at, or None."""
+        times, order = self._indexes()
+        i = bisect_right(times, at) - 1
+        if i < 0:
+            return None
+        return self._datapoints[order[i] if order else i]
+
+    def nearest(self, at):
+        """Return the datapoint closest in time to at, or None if empty.
+
+        When two datapoints are as close, the earlier one is returned.
+
+        """
+        times, order = self._indexes()
+        if not times:
+            return None
+        i = bisect_left(times, at)
+        if i == len(times) or (i > 0 and at - times[i - 1] <= times[i] - at):
+            i -= 1
+        return self._datapoints[order[i] if order else i]
+
+    def resample(self, interval, start=None, end=None):
+        """Return a view of the last datapoint in each interval.
+
+        Intervals are aligned to midnight of the first datapoint's day, and
+        empty intervals are skipped.
+
+        :param interval: The length of each interval, as a timedelta or in
+            seconds
+        :param start: A datetime, or None from the first datapoint
+        :param end: A datetime, or None to the last datapoint
+
+        """
+        if not isinstance(interval, timedelta):
+            interval = timedelta(seconds=interval)
+        times, order = self._indexes()
+        lo = 0 if start is None else bisect_left(times, start)
+        hi = len(times) if end is None else bisect_left(times, end)
+        positions = []
+        if lo < hi:
+            origin = datetime.combine(times[lo].date(), datetime.min.time())
+            seconds = interval.total_seconds()
+            i = lo
+            while i < hi:
+                bucket = (times[i] - origin).total_seconds() // seconds
+                boundary = origin + interval * int(bucket + 1)
+                i = bisect_left(times, boundary, i + 1, hi)
+                positions.append(order[i - 1] if order else i - 1)
+        return DatapointsView(self._datapoints, positions)
+
+    def _reindex(self):
+        """Rebuild the index of the datapoints by timestamp.
+
+        The index is also rebuilt on the next lookup if the list of datapoints
+        is replaced or grows or shrinks in place.
+
+        """
+        datapoints = self._datapoints
+        times = [_datapoint_time(datapoint) for datapoint in datapoints]
+        order = None
+        if any(a > b for a, b in zip(times, islice(times, 1, None))):
+            order = sorted(range(len(times)), key=times.__getitem__)
+            times = [times[i] for i in order]
+        self._index = ((id(datapoints), len(datapoints)), times, order)
+        return times, order
+
+    def _indexes(self):
+        datapoints = self._datapoints
+        if (self._index is None or
+                self._index[0] != (id(datapoints), len(datapoints))):
+            return self._reindex()
+        return self._index[1:]
+
+    def create(self, value, at=None, journal=None):
         """Create a single new datapoint for this datastream.
 
         :param at: The timestamp of the datapoint (default: datetime.now())
         :param value: The value at this time
+        :param journal: A :class:`.WriteJournal` recording the write, so the
+            datapoint is not sent again if it was already created
 
         To create multiple datapoints at the same time do the following
         instead:
@@ -611,14 +1089,150 @@ class DatapointsManager(Sequence, ManagerBase):
         >>> # Then send them to the server.
         >>> datastream.update(fields='datapoints')
 
+        Datapoints already encoded, as JSON or CSV, can be sent as they are
+        by giving a :class:`.RawPayload` as the value, in which case nothing
+        is returned:
+
+        >>> datastream.datapoints.create(xively.RawPayload(
+        ...     b'{"datapoints": [{"at": "2010-05-20T11:01:47Z", "value": 298}]}'))
+
         """
+        if isinstance(value, RawPayload):
+            response = self.client.post(self.url(), data=value)
+            response.raise_for_status()
+            return
         at = at or datetime.now()
         datapoint = Datapoint(at, value)
+        if journal is not None and not journal.prepare(self, [datapoint]):
+            return datapoint
         payload = {'datapoints': [datapoint]}
         response = self.client.post(self.url(), data=payload)
         response.raise_for_status()
+        if journal is not None:
+            journal.commit(self, [datapoint])
         return datapoint
 
+    def bulk_create(self, datapoints, batch_size=500, workers=4, retries=3,
+                    backoff=1.0, callback=None, journal=None):
+        """Create any number of datapoints in batches.
+
+        :param datapoints: An iterable of (at, value) pairs or
+            :class:`.Datapoint` objects, which is consumed lazily
+        :param batch_size: Number of datapoints sent in each request
+        :param workers: Number of requests kept in flight at once
+        :param retries: Number of times a failed batch is sent again
+        :param backoff: Seconds to wait before the first retry, doubling for
+            each following retry
+        :param callback: Called with a :class:`.BulkProgress` after each
+            batch is sent, from the worker threads. An exception it raises
+            stops the upload like a failed batch
+        :param journal: A :class:`.WriteJournal` recording each batch, so
+            datapoints already created are left out of retries and replays
+        :returns: A :class:`.BulkProgress` for the whole upload
+
+        Only a few batches are held in memory at once, so the datapoints can
+        come from a generator of any length, e.g. rows of a CSV file:
+
+        >>> import xively
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> feed = api.feeds.get(7021)
+        >>> datastream = feed.datastreams[0]
+        >>> rows = (("2010-05-20T11:01:%02dZ" % i, i) for i in range(60))
+        >>> progress = datastream.datapoints.bulk_create(rows, batch_size=25)
+        >>> progress.count, progress.batches
+        (60, 3)
+
+        If a batch still fails after the given number of retries, no further
+        batches are sent and its exception is raised once the batches already
+        in flight have finished.
+
+        With a journal, a batch that timed out is checked against the
+        journal, and the datastream's history if it verifies, before it is
+        sent again, and an upload started over after a failure only sends
+        the datapoints not created the first time. Datapoints left out are
+        counted in ``skipped``.
+
+        """
+        url = self.url()
+        progress = BulkProgress()
+        batches = Queue(maxsize=workers * 2)
+        errors = []
+        lock = threading.Lock()
+
+        def post(batch):
+            for attempt in range(retries + 1):
+                try:
+                    if journal is not None:
+                        sending = journal.prepare(self, batch)
+                        with lock:
+                            progress.skipped += len(batch) - len(sending)
+                        batch = sending
+                        if not batch:
+                            return batch
+                    response = self.client.post(
+                        url, data={'datapoints': batch})
+                    response.raise_for_status()
+                    if journal is not None:
+                        journal.commit(self, batch)
+                    return batch
+                except Exception:
+                    if attempt == retries:
+                        raise
+                    with lock:
+                        progress.retries += 1
+                    time.sleep(backoff * 2 ** attempt)
+
+        def work():
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if errors:
+                    continue
+                try:
+                    batch = post(batch)
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                with lock:
+                    progress.count += len(batch)
+                    progress.batches += 1
+                if callback is not None:
+                    try:
+                        callback(progress)
+                    except Exception as e:
+                        errors.append(e)
+
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            datapoints = iter(datapoints)
+            while not errors:
+                batch = [self._bulk_datapoint(d)
+                         for d in islice(datapoints, batch_size)]
+                if not batch:
+                    break
+                batches.put(batch)
+        finally:
+            for thread in threads:
+                batches.put(None)
+            for thread in threads:
+                thread.join()
+            progress.finish()
+        if errors:
+            raise errors[0]
+        return progress
+
+    def _bulk_datapoint(self, d):
+        """Returns the payload of one datapoint for bulk_create."""
+        if isinstance(d, Datapoint):
+            at, value = d.at, d.value
+        else:
+            at, value = d
+        return {'at': at, 'value': value}
+
     def update(self, at, value):
         """Update the value of a datapiont at a given timestamp.
 
@@ -647,7 +1261,8 @@ class DatapointsManager(Sequence, ManagerBase):
         return self._coerce_datapoint(data)
 
     def history(self, start=None, end=None, duration=None, find_previous=None,
-                limit=None, interval_type=None, interval=None):
+                limit=None, interval_type=None, interval=None, cache=None,
+                typed=False):
         """Fetch and return a list of datapoints in a given timerange.
 
         :param start: Defines the starting point of the query
@@ -667,6 +1282,16 @@ class DatapointsManager(Sequence, ManagerBase):
             Determines what interval of data is requested and is defined in
             seconds between the datapoints. If a value is passed in which does
             not match one of these values, it is rounded up to the next value.
+        :param cache:
+            A :class:`.HistoryCache` to read previously fetched datapoints
+            from. Only the parts of the range missing from the cache are
+            requested from the API. The cache is used when both start and end
+            are datetimes and neither duration nor find_previous are given.
+        :param typed:
+            Convert the values, which the API returns as strings, to floats.
+            Each page of values is converted at once, with NumPy when it is
+            installed. Values which are not numbers are left as they are.
+            See :meth:`history_arrays` to get the values as an array.
 
         .. note::
 
@@ -715,7 +1340,54 @@ class DatapointsManager(Sequence, ManagerBase):
         ===== ============================== ==========================
 
         """
-        url = self.url('..').rstrip('/')
+        if (cache is not None and isinstance(start, datetime) and
+                isinstance(end, datetime) and duration is None and
+                find_previous is None):
+            datapoints = self._cached_history(
+                cache, start, end, limit, interval_type, interval)
+        else:
+            params = {k: v for k, v in (
+                ('start', start),
+                ('end', end),
+                ('duration', duration),
+                ('find_previous', find_previous),
+                ('limit', limit),
+                ('interval_type', interval_type),
+                ('interval', interval),
+            ) if v is not None}
+            datapoints = self._fetch_history(params)
+        if typed:
+            datapoints = self._typed_history(datapoints)
+        for datapoint in datapoints:
+            yield datapoint
+
+    def ahistory(self, start=None, end=None, duration=None,
+                 find_previous=None, limit=None, interval_type=None,
+                 interval=None, typed=False, prefetch=1, executor=None):
+        """Return an async iterator of the datapoints in a given timerange.
+
+        When start and end are both datetimes, and neither duration,
+        find_previous nor limit are given, every datapoint in the range is
+        fetched in pages, with the next page fetched while the current one
+        is consumed. Otherwise a single request is made.
+
+        :param prefetch: Number of pages fetched ahead
+        :param executor: The executor to make requests in, see
+            :class:`.AsyncPageIterator`
+
+        See :meth:`history` for the other parameters.
+
+        Usage::
+
+            >>> async def mean(datastream, start, end):  # doctest: +SKIP
+            ...     total = count = 0
+            ...     async for datapoint in datastream.datapoints.ahistory(
+            ...             start, end, typed=True, prefetch=2):
+            ...         total += datapoint.value
+            ...         count += 1
+            ...     return total / count
+
+        """
         params = {k: v for k, v in (
             ('start', start),
             ('end', end),
@@ -725,13 +1397,110 @@ class DatapointsManager(Sequence, ManagerBase):
             ('interval_type', interval_type),
             ('interval', interval),
         ) if v is not None}
+        if (isinstance(start, datetime) and isinstance(end, datetime) and
+                duration is None and find_previous is None and limit is None):
+            del params['start'], params['end']
+            pages = self._history_pages(start, end, **params)
+        else:
+            pages = (self._fetch_history(params) for _ in range(1))
+        if typed:
+            pages = (list(self._typed_history(page)) for page in pages)
+        return AsyncPageIterator(pages, prefetch, executor)
+
+    def history_arrays(self, *args, **kwargs):
+        """Fetch the datapoints in a given timerange as arrays.
+
+        Takes the same parameters as :meth:`history`, except typed.
+
+        :returns: A ``(times, values, mask)`` tuple. times is a list of the
+            datapoints' datetimes. values is a NumPy float64 array of their
+            values, or an array('d') when NumPy is not installed. mask is a
+            boolean array, or a list, True for each value which is not a
+            number, whose float in values is then NaN.
+
+        """
+        times, values = [], []
+        for datapoint in self.history(*args, **kwargs):
+            times.append(datapoint.at)
+            values.append(datapoint.value)
+        values, mask = _to_floats(values)
+        return times, values, mask
+
+    def _typed_history(self, datapoints):
+        """Yield the datapoints with float values, converting page by page."""
+        datapoints = iter(datapoints)
+        while True:
+            page = list(islice(datapoints, MAX_DATAPOINTS))
+            if not page:
+                break
+            _set_floats(page, ['value'] * len(page))
+            for datapoint in page:
+                yield datapoint
+
+    def _fetch_history(self, params):
+        """Request history with the given parameters and return Datapoints."""
+        url = self.url('..').rstrip('/')
         params = self._prepare_params(params)
         response = self.client.get(url, params=params)
         response.raise_for_status()
         data = response.json()
+        datapoints = []
         for datapoint_data in data.get('datapoints', []):
             datapoint_data['at'] = self._parse_datetime(datapoint_data['at'])
-            yield self._coerce_datapoint(datapoint_data)
+            datapoints.append(self._coerce_datapoint(datapoint_data))
+        return datapoints
+
+    def _paginate_history(self, start, end, page_size=MAX_DATAPOINTS,
+                          **params):
+        """Yield every datapoint from start to end, a page at a time."""
+        for datapoints in self._history_pages(start, end, page_size, **params):
+            for datapoint in datapoints:
+                yield datapoint
+
+    def _history_pages(self, start, end, page_size=MAX_DATAPOINTS, **params):
+        """Yield lists of every datapoint from start to end, page by page.
+
+        The range is split into the longest windows the API allows for the
+        interval. Within a window each following page starts just after the
+        last timestamp returned by the previous one, until a page comes back
+        short.
+
+        """
+        window = _max_history_range(params.get('interval'))
+        params['limit'] = page_size
+        while start < end:
+            window_end = min(end, start + window)
+            params.update(start=start, end=window_end)
+            while True:
+                datapoints = self._fetch_history(params)
+                yield datapoints
+                if len(datapoints) < page_size:
+                    break
+                params['start'] = datapoints[-1].at + timedelta(microseconds=1)
+            start = window_end
+
+    def _cached_history(self, cache, start, end, limit, interval_type,
+                        interval):
+        """Yield history between start and end, filling gaps in the cache."""
+        feed = self.parent._manager.parent
+        key = cache.key(feed.id, self.parent.id, interval, interval_type)
+        params = {k: v for k, v in (
+            ('interval_type', interval_type),
+            ('interval', interval),
+        ) if v is not None}
+        # The segments already stored must not be evicted to make room for
+        # the gaps, and are opened by read() before they are unpinned.
+        with cache.pinned(key, start, end):
+            for gap_start, gap_end in cache.missing(key, start, end):
+                datapoints = self._paginate_history(
+                    gap_start, gap_end, **params)
+                cache.store(key, gap_start, gap_end,
+                            [(d.at, d.value) for d in datapoints])
+            stored = cache.read(key, start, end)
+        for count, (at, value) in enumerate(stored):
+            if limit is not None and count >= limit:
+                break
+            yield self._coerce_datapoint({'at': at, 'value': value})
 
     def delete(self, at=None, start=None, end=None, duration=None):
         """Delete a datapoint or a range of datapoints.
@@ -782,6 +1551,69 @@ class DatapointsManager(Sequence, ManagerBase):
         return Datapoint(**d._data)
 
 
+class DatapointsView(Sequence):
+    """A time ordered, read only view of some datapoints of a datastream.
+
+    Returned by :meth:`.DatapointsManager.between` and
+    :meth:`~.DatapointsManager.resample`. A view holds positions in the
+    datastream's list of datapoints rather than copies of them.
+
+    """
+
+    def __init__(self, datapoints, positions):
+        self._datapoints = datapoints
+        self._positions = positions
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return DatapointsView(self._datapoints, self._positions[item])
+        return self._datapoints[self._positions[item]]
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class BulkProgress(object):
+    """Progress and throughput of a :meth:`.DatapointsManager.bulk_create`.
+
+    :ivar count: Number of datapoints created so far
+    :ivar batches: Number of batches sent successfully
+    :ivar retries: Number of times a failed batch was sent again
+    :ivar skipped: Number of datapoints left out as already created, when
+        using a :class:`.WriteJournal`
+
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.batches = 0
+        self.retries = 0
+        self.skipped = 0
+        self.started = time.time()
+        self.finished = None
+
+    def __repr__(self):
+        return "<{}.{}(count={}, rate={:.1f}/s)>".format(
+            __package__, self.__class__.__name__, self.count, self.rate)
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def elapsed(self):
+        """Seconds since the upload started, until it finished."""
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        """Datapoints created per second."""
+        elapsed = self.elapsed
+        return self.count / elapsed if elapsed else 0.0
+
+
 class TriggersManager(ManagerBase):
     """Manage :class:`.Trigger`.
 
@@ -853,6 +1685,7 @@ class TriggersManager(ManagerBase):
         trigger._manager = self
         location = response.headers['location']
         trigger._data['id'] = int(location.rsplit('/', 1)[1])
+        trigger._mark_saved()
         return trigger
 
     def get(self, id_or_url):
@@ -875,6 +1708,7 @@ class TriggersManager(ManagerBase):
         if user:
             trigger._data['user'] = user
         trigger._manager = self
+        trigger._mark_saved()
         return trigger
 
     def update(self, id_or_url, **kwargs):
@@ -905,8 +1739,19 @@ class TriggersManager(ManagerBase):
         for data in json:
             trigger = self._coerce_trigger(data)
             trigger._manager = self
+            trigger._mark_saved()
             yield trigger
 
+    def alist(self, feed_id=None, executor=None):
+        """Return an async iterator of triggers.
+
+        The request is made in the executor, see :class:`.AsyncPageIterator`.
+        See :meth:`list` for the other parameters.
+
+        """
+        pages = (list(self.list(feed_id)) for _ in range(1))
+        return AsyncPageIterator(pages, executor=executor)
+
     def delete(self, id_or_url):
         """Delete a trigger by id or url.
 
@@ -1001,6 +1846,16 @@ class KeysManager(ManagerBase):
             key = self._coerce_key(data)
             yield key
 
+    def alist(self, feed_id=None, executor=None):
+        """Return an async iterator of API keys.
+
+        The request is made in the executor, see :class:`.AsyncPageIterator`.
+        See :meth:`list` for the other parameters.
+
+        """
+        pages = (list(self.list(feed_id)) for _ in range(1))
+        return AsyncPageIterator(pages, executor=executor)
+
     def get(self, key_id):
         """Fetch and return an API key by its id.
 
@@ -1066,6 +1921,213 @@ class KeysManager(ManagerBase):
         return resource
 
 
+def _max_history_range(interval):
+    """Return the longest range of history that can be queried at once.
+
+    >>> _max_history_range(None) == timedelta(hours=6)
+    True
+    >>> _max_history_range(120) == timedelta(days=5)
+    True
+
+    """
+    interval = int(interval or 0)
+    for value, max_range in MAX_HISTORY_RANGES:
+        if interval <= value:
+            return max_range
+    return max_range
+
+
+_numpy = None
+
+
+def _to_floats(values):
+    """Convert a sequence of values to floats in a single batch.
+
+    Returns a ``(floats, mask)`` pair of NumPy arrays, or of an array('d')
+    and a list when NumPy is not installed. The mask is True for each value
+    which is not a number, whose float is then NaN.
+
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy as _numpy
+        except ImportError:
+            _numpy = False
+    if _numpy:
+        try:
+            floats = _numpy.asarray(values).astype(_numpy.float64)
+        except (TypeError, ValueError):
+            pass
+        else:
+            return floats, _numpy.zeros(len(floats), dtype=bool)
+    floats, mask = array('d'), []
+    for value in values:
+        try:
+            floats.append(float(value))
+            mask.append(False)
+        except (TypeError, ValueError):
+            floats.append(float('nan'))
+            mask.append(True)
+    if _numpy:
+        return _numpy.asarray(floats), _numpy.asarray(mask, dtype=bool)
+    return floats, mask
+
+
+def _set_floats(instances, fields):
+    """Replace the named field of each instance with its value as a float."""
+    floats, mask = _to_floats(
+        [instance._data[field] for instance, field in zip(instances, fields)])
+    for instance, field, value, masked in zip(
+            instances, fields, floats.tolist(), mask):
+        if not masked:
+            instance._data[field] = value
+
+
+def _parallel(func, items, workers):
+    """Return the results of func for each item, called from worker threads.
+
+    The first exception raised by func is raised once all calls finished.
+
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    tasks = Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+
+    def work():
+        while not errors:
+            try:
+                index, item = tasks.get_nowait()
+            except Empty:
+                break
+            try:
+                results[index] = func(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=work)
+               for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+# Ends the datapoints put on a queue by _prefetch.
+_END = object()
+
+
+def _prefetch(datapoints, stopped, size=MAX_DATAPOINTS):
+    """Return an iterator of the datapoints, which a thread fetches ahead.
+
+    At most size datapoints are fetched before they are taken. The thread
+    gives up once stopped is set.
+
+    """
+    queue = Queue(maxsize=size)
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            for datapoint in datapoints:
+                if not put(datapoint):
+                    return
+            put(_END)
+        except Exception as e:
+            put((_END, e))
+
+    def take():
+        while True:
+            item = queue.get()
+            if item is _END:
+                break
+            if isinstance(item, tuple) and item[0] is _END:
+                raise item[1]
+            yield item
+
+    thread = threading.Thread(target=fetch)
+    thread.daemon = True
+    thread.start()
+    return take()
+
+
+def _merge_history(histories, fill):
+    """Yield rows of values from iterables of datapoints in time order."""
+    stopped = threading.Event()
+    streams = [_prefetch(history, stopped) for history in histories]
+    count = len(streams)
+    heads = [None] * count
+    previous = [None] * count
+    heap = []
+    try:
+        for i, stream in enumerate(streams):
+            heads[i] = next(stream, None)
+            if heads[i] is not None:
+                heap.append((heads[i].at, i))
+        heapq.heapify(heap)
+        while heap:
+            at = heap[0][0]
+            row = [_END] * count
+            while heap and heap[0][0] == at:
+                _, i = heapq.heappop(heap)
+                row[i] = heads[i].value
+                previous[i] = heads[i]
+                heads[i] = next(streams[i], None)
+                if heads[i] is not None:
+                    heapq.heappush(heap, (heads[i].at, i))
+            for i, value in enumerate(row):
+                if value is not _END:
+                    continue
+                before, after = previous[i], heads[i]
+                if fill == 'forward' or (fill == 'nearest' and after is None):
+                    row[i] = before.value if before is not None else None
+                elif fill == 'nearest':
+                    if before is None or after.at - at < at - before.at:
+                        row[i] = after.value
+                    else:
+                        row[i] = before.value
+                else:
+                    row[i] = None
+            yield (at,) + tuple(row)
+    finally:
+        stopped.set()
+        for stream in streams:
+            stream.close()
+
+
+def _positions(order, lo, hi):
+    """Return the list positions of the index entries from lo to hi."""
+    if order is None:
+        return range(lo, hi)
+    return order[lo:hi]
+
+
+def _datapoint_time(datapoint):
+    """Return the timestamp of a datapoint as a datetime."""
+    at = datapoint.at if isinstance(datapoint, Datapoint) else datapoint['at']
+    if isinstance(at, datetime):
+        return at
+    at = at.rstrip('Z')
+    if '.' in at:
+        return datetime.strptime(at, "%Y-%m-%dT%H:%M:%S.%f")
+    return datetime.strptime(at, "%Y-%m-%dT%H:%M:%S")
+
+
 def _id_from_url(url):
     """Return the last part or a url
 
@@ -1075,3 +2137,9 @@ def _id_from_url(url):
     """
     id = url.rsplit('/', 1)[1]
     return id
+
+
+try:
+    _string_types = (basestring,)
+except NameError:
+    _string_types = (str,)
@@ -11,6 +11,17 @@ __all__ = ['Feed', 'Datastream', 'Datapoint', 'Location', 'Waypoint',
 class Base(object):
     """Abstract base class to store API data and allow (de)serialisation."""
 
+    # Names of the attributes changed since the object was fetched from or
+    # last saved to the API, or None if changes are not being tracked.
+    _changed = None
+
+    # Copies of the lists and dicts in the state when it was last saved, to
+    # find the ones changed in place, e.g. by feed.tags.append().
+    _saved = None
+
+    # Names of the attributes left out of the state when they are empty.
+    _omit_empty = ()
+
     def __init__(self):
         self._data = {}
 
@@ -19,7 +30,67 @@ class Base(object):
 
         This is the data that should be sent to the Xively API.
         """
-        return {k: v for k, v in self._data.items() if v is not None}
+        state = {k: v for k, v in self._data.items() if v is not None}
+        for name in self._omit_empty:
+            if name in state and not state[name]:
+                del state[name]
+        return state
+
+    def _changed_state(self):
+        """Returns the part of the state changed since it was last saved.
+
+        Objects created locally, and so never fetched or saved, return their
+        entire state. Nested objects such as a location are included whole if
+        any of their attributes changed.
+        """
+        state = self.__getstate__()
+        changed = self._changed_fields()
+        if changed is None:
+            return state
+        return {k: v for k, v in state.items()
+                if k in changed or
+                (isinstance(v, Base) and v._has_changed())}
+
+    def _changed_fields(self):
+        """Returns the names of the attributes set or changed in place since
+        the object was last saved, or None if changes are not tracked."""
+        if self._changed is None:
+            return None
+        changed = set(self._changed)
+        for name, saved in self._saved.items():
+            if self._data.get(name) != saved:
+                changed.add(name)
+        return changed
+
+    def _has_changed(self):
+        """Returns True if the object differs from its saved state."""
+        if self._changed_fields() != set():
+            return True
+        for value in self._data.values():
+            for item in (value if isinstance(value, list) else (value,)):
+                if isinstance(item, Base) and item._has_changed():
+                    return True
+        return False
+
+    def _mark_changed(self, name):
+        if self._changed is not None:
+            self._changed.add(name)
+
+    def _mark_saved(self):
+        """Records the current state, and of nested objects, as saved."""
+        self._changed = set()
+        self._saved = {name: _copy(value)
+                       for name, value in self._data.items()
+                       if isinstance(value, (list, dict))}
+        for value in self._data.values():
+            for item in (value if isinstance(value, list) else (value,)):
+                if isinstance(item, Base):
+                    item._mark_saved()
+
+    def __reduce__(self):
+        """Pickles just the data, so models can be sent to other processes
+        without their managers and clients."""
+        return _restore, (self.__class__, self._data)
 
     def __getattr__(self, name):
         """Looks up and returns an attribute from the state."""
@@ -34,6 +105,7 @@ class Base(object):
         """Sets the value of an attribute in the state."""
         if not name.startswith('_') and name not in dir(self.__class__):
             self._data[name] = value
+            self._mark_changed(name)
         else:
             super(Base, self).__setattr__(name, value)
 
@@ -109,8 +181,7 @@ class Feed(Base):
 
         """
         if self._datastreams_manager is None:
-            import xively.managers
-            self._datastreams_manager = xively.managers.DatastreamsManager(self)
+            self._datastreams_manager = _managers().DatastreamsManager(self)
         return self._datastreams_manager
 
     @datastreams.setter  # NOQA
@@ -119,8 +190,23 @@ class Feed(Base):
         if manager:
             # Accessing self.datastreams will create a DatastreamsManager if
             # one didn't already exist.
-            manager._coerce_datastreams(datastreams, self.datastreams)
+            datastreams = manager._coerce_datastreams(
+                datastreams, self.datastreams)
         self._data['datastreams'] = datastreams
+        if self._datastreams_manager is not None:
+            self._datastreams_manager._reindex()
+        self._mark_changed('datastreams')
+
+    def _changed_state(self):
+        state = super(Feed, self)._changed_state()
+        changed = self._changed_fields()
+        if changed is not None and 'datastreams' not in changed:
+            datastreams = [d._changed_state()
+                           for d in self._data.get('datastreams') or []
+                           if isinstance(d, Base) and d._has_changed()]
+            if datastreams:
+                state['datastreams'] = datastreams
+        return state
 
     def update(self, fields=None):
         """Updates feed and datastreams via the API.
@@ -130,16 +216,49 @@ class Feed(Base):
         timestamp in the "updated" attribute and sets the feed to "live" if it
         wasn't before.
 
+        For a feed fetched from the API only the fields, and datastreams,
+        changed since it was fetched or last updated are sent, and nothing
+        is sent if none were.
+
         :param fields: If given, only update these fields.
         :type fields: list of strings
 
         """
         url = self.id
-        state = self.__getstate__()
         if fields is not None:
             fields = set(fields)
-            state = {k: v for k, v in state.items() if k in fields}
+            state = {k: v for k, v in self.__getstate__().items()
+                     if k in fields}
+        elif not self._has_changed():
+            return
+        else:
+            state = self._changed_state()
         self._manager.update(url, **state)
+        if fields is None:
+            self._mark_saved()
+
+    def history(self, datastream_ids, start, end, **kwargs):
+        """Returns the history of several datastreams on one time axis.
+
+        This is a shortcut for :meth:`.DatastreamsManager.history`, see there
+        for the other arguments.
+
+        Usage::
+
+            >>> import xively
+            >>> import datetime
+            >>> api = xively.XivelyAPIClient("API_KEY")
+            >>> feed = api.feeds.get(7021)
+            >>> rows = feed.history(
+            ...     ["random5", "random60"],
+            ...     start=datetime.datetime(2013, 1, 1, 14, 0, 0),
+            ...     end=datetime.datetime(2013, 1, 1, 16, 0, 0))
+            >>> next(rows)  # doctest: +IGNORE_UNICODE +NORMALIZE_WHITESPACE
+            (datetime.datetime(2013, 1, 1, 14, 14, 55, 118845),
+             '0.25741970', '0.25741970')
+
+        """
+        return self.datastreams.history(datastream_ids, start, end, **kwargs)
 
     def delete(self):
         """Delete this feed via the API.
@@ -166,6 +285,7 @@ class Datastream(Base):
     """
 
     _datapoints_manager = None
+    _omit_empty = ('datapoints',)
 
     def __init__(self, id, tags=None, unit=None, min_value=None,
                  max_value=None, current_value=None, datapoints=None, at=None):
@@ -181,10 +301,10 @@ class Datastream(Base):
         }
         self.datapoints = datapoints or []
 
-    def __getstate__(self):
-        state = super(Datastream, self).__getstate__()
-        if not state['datapoints']:
-            state.pop('datapoints')
+    def _changed_state(self):
+        state = super(Datastream, self)._changed_state()
+        # The id is needed to know which datastream of a feed changed.
+        state['id'] = self.id
         return state
 
     def __repr__(self):
@@ -216,28 +336,39 @@ class Datastream(Base):
 
         """
         if self._datapoints_manager is None:
-            import xively.managers
-            self._datapoints_manager = xively.managers.DatapointsManager(self)
+            self._datapoints_manager = _managers().DatapointsManager(self)
         return self._datapoints_manager
 
     @datapoints.setter  # NOQA
     def datapoints(self, datapoints):
         self._data['datapoints'] = datapoints
+        if self._datapoints_manager is not None:
+            # Indexed again by timestamp on the next lookup.
+            self._datapoints_manager._index = None
+        self._mark_changed('datapoints')
 
     def update(self, fields=None):
         """Sends the current state of this datastream to Xively.
 
-        This method updates just the single datastream.
+        This method updates just the single datastream. For a datastream
+        fetched from the API only the fields changed since it was fetched or
+        last updated are sent, and nothing is sent if none were.
 
         :param fields: If given, only update these fields.
         :type fields: list of strings
 
         """
-        state = self.__getstate__()
         if fields is not None:
             fields = set(fields)
-            state = {k: v for k, v in state.items() if k in fields}
+            state = {k: v for k, v in self.__getstate__().items()
+                     if k in fields}
+        elif not self._has_changed():
+            return
+        else:
+            state = self._changed_state()
         self._manager.update(self.id, **state)
+        if fields is None:
+            self._mark_saved()
 
     def delete(self):
         """Delete this datastream from Xively.
@@ -309,6 +440,22 @@ class Location(Base):
         if waypoints is not None:
             self._data['waypoints'] = waypoints
 
+    @property
+    def track(self):
+        """The waypoints as a :class:`.WaypointTrack`.
+
+        Waypoints already held as a track, e.g. those of a feed fetched with
+        ``waypoints='track'``, are returned as they are. A list of waypoints
+        is copied into a new track each time, so changes to it do not change
+        the waypoints.
+
+        """
+        from xively.geo import WaypointTrack
+        waypoints = self._data.get('waypoints')
+        if isinstance(waypoints, WaypointTrack):
+            return waypoints
+        return WaypointTrack(waypoints or ())
+
 
 class Waypoint(Base):
     """A waypoint represents where a mobile feed was at a particular time.
@@ -370,16 +517,26 @@ class Trigger(Base):
     def update(self, fields=None):
         """Update an existing trigger.
 
+        For a trigger fetched from the API only the fields changed since it
+        was fetched or last updated are sent, and nothing is sent if none
+        were.
+
         :param fields: If given, only update these fields
         :type fields: list of strings
 
         """
-        state = self.__getstate__()
-        state.pop('id', None)
         if fields is not None:
             fields = set(fields)
-            state = {k: v for k, v in state.items() if k in fields}
+            state = {k: v for k, v in self.__getstate__().items()
+                     if k in fields}
+        elif not self._has_changed():
+            return
+        else:
+            state = self._changed_state()
+        state.pop('id', None)
         self._manager.update(self.id, **state)
+        if fields is None:
+            self._mark_saved()
 
     def delete(self):
         """Delete a trigger.
@@ -478,3 +635,37 @@ class Resource(Base):
         }
         if datastream_id:
             self._data['datastream_id'] = datastream_id
+
+
+_managers_module = None
+
+
+def _managers():
+    """Return the xively.managers module, importing it on first use.
+
+    The managers module depends on this one, so it cannot be imported at the
+    top; keeping a reference saves repeating the import for every model.
+
+    """
+    global _managers_module
+    if _managers_module is None:
+        from xively import managers
+        _managers_module = managers
+    return _managers_module
+
+
+def _copy(value):
+    """Returns a copy of the lists and dicts in value, keeping the models
+    and other values they hold."""
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    return value
+
+
+def _restore(cls, data):
+    """Returns a model of class cls holding data, unpickling a model."""
+    obj = cls.__new__(cls)
+    object.__setattr__(obj, '_data', dict(data))
+    return obj
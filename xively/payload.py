@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+
+__all__ = ['RawPayload']
+
+
+class RawPayload(object):
+    r"""Request data which has already been encoded, e.g. JSON or CSV.
+
+    A RawPayload is passed to the API as it is, without being decoded or
+    serialised again, for instance when relaying messages from a queue.
+
+    :param data: The encoded data
+    :type data: bytes, str or memoryview
+    :param content_type: The media type of the data
+    :type content_type: str ['application/json']
+
+    Usage::
+
+        >>> import xively
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> payload = xively.RawPayload(b'{"title": "Relayed"}')
+        >>> api.feeds.update(7021, payload=payload)
+        >>> csv = xively.RawPayload(b"0,123\r\n", content_type='text/csv')
+
+    """
+
+    def __init__(self, data, content_type='application/json'):
+        self.data = data
+        self.content_type = content_type
+
+    def __repr__(self):
+        return "<{}.{}({!r}, {} bytes)>".format(
+            __package__, self.__class__.__name__, self.content_type,
+            len(self.body))
+
+    @property
+    def body(self):
+        """The data as bytes or str, as requests does not send memoryviews."""
+        if isinstance(self.data, memoryview):
+            return self.data.tobytes()
+        return self.data
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from datetime import datetime
+
+try:
+    from Queue import Empty, Full, Queue
+except ImportError:
+    from queue import Empty, Full, Queue  # NOQA
+
+from xively.models import Datapoint, Datastream
+
+
+__all__ = ['Parser', 'Pipeline']
+
+
+# Marks the end of the readings on the queue.
+_END = object()
+
+
+class Parser(object):
+    """Turns raw data read from a source into datastream readings.
+
+    Subclass this and override :meth:`parse` to plug a new kind of device
+    into a :class:`.Pipeline`. Any callable taking the raw data and
+    returning readings can be used as a parser too.
+
+    """
+
+    def __call__(self, data):
+        return self.parse(data)
+
+    def parse(self, data):
+        """Return an iterable of readings for a piece of raw data.
+
+        A reading is a ``(datastream_id, value)`` or
+        ``(datastream_id, value, at)`` tuple. Readings without a timestamp
+        are given the time they were read.
+
+        """
+        raise NotImplementedError
+
+
+class Pipeline(object):
+    """Read values from a device and upload them to a feed separately.
+
+    A reader thread takes raw data from the source, parses it into readings
+    and puts them on a bounded queue without waiting for the network. An
+    uploader thread collects the readings per datastream and sends them to
+    the feed every ``flush_interval`` seconds in a single update.
+
+    :param feed: The :class:`.Feed` to upload to
+    :param source: An iterable of raw data, e.g. an open serial port
+    :param parser: A :class:`.Parser`, or callable, turning raw data into
+        readings
+    :param flush_interval: Seconds between uploads
+    :param keep: 'latest' to send only the latest value of each datastream,
+        or 'all' to also send every value read as datapoints
+    :param queue_size: Most readings waiting to be uploaded, readings are
+        dropped, and counted in ``dropped``, rather than block the reader
+
+    Raw data the parser fails on, or turns into malformed readings, is
+    skipped and counted in ``parse_errors``.
+
+    Usage::
+
+        >>> import xively
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> feed = api.feeds.get(7021)
+        >>> lines = ["tmpr=21.5", "watts=340", "tmpr=21.7"]
+        >>> parser = lambda line: [line.split('=')]
+        >>> pipeline = xively.Pipeline(feed, lines, parser)
+        >>> pipeline.run()
+        >>> sorted((d.id, d.current_value) for d in feed.datastreams)
+        [('tmpr', '21.7'), ('watts', '340')]
+
+    """
+
+    def __init__(self, feed, source, parser, flush_interval=5.0,
+                 keep='latest', queue_size=10000):
+        if keep not in ('latest', 'all'):
+            raise ValueError("keep must be 'latest' or 'all'")
+        self.feed = feed
+        self.source = source
+        self.parser = parser
+        self.flush_interval = flush_interval
+        self.keep = keep
+        self.read = 0
+        self.dropped = 0
+        self.parse_errors = 0
+        self.uploads = 0
+        self.errors = []
+        self._readings = Queue(maxsize=queue_size)
+        self._pending = {}
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start the reader and uploader threads."""
+        self._threads = [threading.Thread(target=self._read),
+                         threading.Thread(target=self._upload)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stop reading and upload any readings still waiting."""
+        self._stopped.set()
+        self._readings.put(_END)
+        self._threads[1].join()
+
+    def run(self):
+        """Read the whole source, uploading as it goes, then return."""
+        self.start()
+        for thread in self._threads:
+            thread.join()
+
+    def _read(self):
+        try:
+            for data in self.source:
+                if self._stopped.is_set():
+                    break
+                try:
+                    for reading in self.parser(data) or ():
+                        self._put(reading)
+                except Exception:
+                    # Skip data the parser can't make sense of, e.g. a
+                    # line garbled on the wire, and carry on reading.
+                    self.parse_errors += 1
+        finally:
+            self._readings.put(_END)
+
+    def _put(self, reading):
+        if len(reading) == 2:
+            datastream_id, value = reading
+            at = datetime.utcnow()
+        else:
+            datastream_id, value, at = reading
+        try:
+            self._readings.put_nowait((datastream_id, value, at))
+            self.read += 1
+        except Full:
+            self.dropped += 1
+
+    def _upload(self):
+        next_flush = time.time() + self.flush_interval
+        finished = False
+        while not finished:
+            finished = self._collect(next_flush)
+            if finished or time.time() >= next_flush:
+                self.flush()
+                next_flush = time.time() + self.flush_interval
+
+    def _collect(self, deadline):
+        """Add readings queued until deadline to the pending values.
+
+        Returns True once the end of the readings has been reached.
+
+        """
+        while True:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    reading = self._readings.get(timeout=timeout)
+                else:
+                    reading = self._readings.get_nowait()
+            except Empty:
+                return False
+            if reading is _END:
+                return True
+            datastream_id, value, at = reading
+            if self.keep == 'all':
+                self._pending.setdefault(datastream_id, []).append((at, value))
+            else:
+                self._pending[datastream_id] = [(at, value)]
+
+    def flush(self):
+        """Upload the pending readings to the feed now.
+
+        If the upload fails the readings are kept, and merged with any newer
+        ones, to be sent with the next upload.
+
+        """
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        datastreams = []
+        for datastream_id, values in sorted(pending.items()):
+            at, value = values[-1]
+            datastream = Datastream(id=datastream_id, current_value=value,
+                                    at=at)
+            if self.keep == 'all':
+                datastream.datapoints = [Datapoint(a, v) for a, v in values]
+            datastreams.append(datastream)
+        self.feed.datastreams = datastreams
+        try:
+            self.feed.update(fields=['datastreams'])
+        except Exception as e:
+            self.errors.append(e)
+            for datastream_id, values in pending.items():
+                newer = self._pending.get(datastream_id, [])
+                if self.keep == 'all':
+                    self._pending[datastream_id] = values + newer
+                else:
+                    self._pending[datastream_id] = newer or values
+        else:
+            self.uploads += 1
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import threading
+import time
+
+from itertools import count, islice
+
+
+__all__ = ['WriteScheduler', 'ScheduledWrite']
+
+
+class WriteScheduler(object):
+    """Share a client's writes fairly between feeds.
+
+    Writes are queued per feed and per priority class and sent by a fixed
+    number of worker threads, which is the most requests in flight at once.
+    Writes of the 'realtime' class are always sent ahead of those of the
+    'bulk' class. Within a class, feeds take turns by weighted fair
+    queuing: each write is tagged with a virtual finish time, its cost
+    divided by its feed's weight added to the finish time of the feed's
+    previous write, and the write with the earliest tag is sent next. A
+    feed backfilling thousands of datapoints therefore gets its share of
+    the workers, not all of them, and real-time updates are never queued
+    behind it.
+
+    :param concurrency: Number of writes sent at the same time
+    :type concurrency: int [4]
+    :param weights: Weight of each feed by ID, feeds not given have a
+        weight of 1
+
+    Usage::
+
+        >>> import xively
+        >>> api = xively.XivelyAPIClient("API_KEY")
+        >>> feed = api.feeds.get(7021)
+        >>> scheduler = xively.WriteScheduler(concurrency=2).start()
+        >>> datastream = feed.datastreams[0]
+        >>> rows = (("2013-01-01T00:%02d:00Z" % i, i) for i in range(60))
+        >>> backfill = scheduler.bulk_create(datastream, rows, batch_size=25)
+        >>> datastream.current_value = 42
+        >>> write = scheduler.update(feed, fields=['datastreams'])
+        >>> scheduler.close()
+        >>> write.done(), [w.done() for w in backfill]
+        (True, [True, True, True])
+        >>> scheduler.metrics()[('bulk', 7021)]['completed']
+        3
+
+    """
+
+    #: The priority classes, in the order they are served.
+    PRIORITIES = ('realtime', 'bulk')
+
+    def __init__(self, concurrency=4, weights=None):
+        self.concurrency = concurrency
+        self.weights = dict(weights or {})
+        self._queues = {}
+        self._heaps = dict((priority, []) for priority in self.PRIORITIES)
+        self._virtual_time = dict.fromkeys(self.PRIORITIES, 0.0)
+        self._sequence = count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        self._threads = []
+        self.active = 0
+
+    def start(self):
+        """Start the worker threads sending the queued writes."""
+        self._threads = [threading.Thread(target=self._work)
+                         for _ in range(self.concurrency)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def close(self):
+        """Wait for the queued writes to be sent and stop the workers."""
+        with self._wakeup:
+            self._closed = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, feed_id, func, args=(), kwargs=None,
+               priority='realtime', cost=1):
+        """Queue a call writing to a feed.
+
+        :param feed_id: The ID of the feed written to, which picks the queue
+            and the weight
+        :param func: The function making the write, e.g. a manager method
+        :param args: Positional arguments for func
+        :param kwargs: Keyword arguments for func
+        :param priority: The priority class, 'realtime' or 'bulk'
+        :param cost: The size of the write, e.g. its number of datapoints,
+            counted against the feed's share
+        :returns: A :class:`.ScheduledWrite`
+
+        """
+        if priority not in self._heaps:
+            raise ValueError("priority must be one of {}".format(
+                ", ".join(self.PRIORITIES)))
+        write = ScheduledWrite(func, args, kwargs or {})
+        with self._wakeup:
+            if self._closed:
+                raise RuntimeError("The scheduler is closed")
+            self._push(feed_id, write, priority, cost)
+        return write
+
+    def update(self, feed, **kwargs):
+        """Queue a real-time update of a feed, see :meth:`.Feed.update`."""
+        return self.submit(feed.id, feed.update, kwargs=kwargs)
+
+    def bulk_create(self, datastream, datapoints, batch_size=500, ahead=2,
+                    **kwargs):
+        """Queue the creation of datapoints in bulk, a batch per write.
+
+        Each batch is a separate write so real-time updates, and other
+        feeds, can be sent in between. The datapoints are read into batches
+        as they are sent: ``ahead`` batches are queued straight away, and
+        each batch queues the next one when it starts being sent, so only a
+        few batches are held in memory however many datapoints there are.
+
+        :param datastream: The :class:`.Datastream` to create datapoints for
+        :param datapoints: An iterable of (at, value) pairs or
+            :class:`.Datapoint` objects
+        :param batch_size: Number of datapoints in each write
+        :param ahead: Number of batches queued at once
+        :param kwargs: Other arguments for
+            :meth:`.DatapointsManager.bulk_create`, e.g. a journal
+        :returns: A list of :class:`.ScheduledWrite`, one per batch, which
+            grows as batches are queued and is complete once the scheduler
+            is closed
+
+        """
+        feed_id = datastream._manager.parent.id
+        kwargs.update(batch_size=batch_size, workers=1)
+        writes = []
+        datapoints = iter(datapoints)
+        lock = threading.Lock()
+
+        def queue_next():
+            """Read the next batch and queue it, returning False at the end."""
+            with lock:
+                batch = list(islice(datapoints, batch_size))
+                if not batch:
+                    return False
+                write = ScheduledWrite(send, (batch,), kwargs)
+                writes.append(write)
+                with self._wakeup:
+                    self._push(feed_id, write, 'bulk', len(batch))
+            return True
+
+        def send(batch, **kwargs):
+            try:
+                queue_next()
+            except Exception as e:
+                # The rest of the datapoints could not be read, which is
+                # reported as a failed write of its own.
+                failed = ScheduledWrite(_raise, (e,), {})
+                failed._run()
+                writes.append(failed)
+            return datastream.datapoints.bulk_create(batch, **kwargs)
+
+        with self._wakeup:
+            if self._closed:
+                raise RuntimeError("The scheduler is closed")
+        for _ in range(ahead):
+            if not queue_next():
+                break
+        return writes
+
+    def depth(self, feed_id, priority='realtime'):
+        """Return the number of writes waiting in a feed's queue."""
+        queue = self._queues.get((priority, feed_id))
+        return queue.depth if queue is not None else 0
+
+    def metrics(self):
+        """Return the metrics of every queue.
+
+        :returns: A dict of ``{(priority, feed_id): metrics}``, where the
+            metrics are a dict of the number of writes waiting ('depth'),
+            'submitted', 'completed' and 'failed', and the mean and longest
+            seconds writes waited to be sent ('wait', 'max_wait') and until
+            they finished ('latency', 'max_latency')
+
+        """
+        with self._lock:
+            return dict((key, queue.metrics())
+                        for key, queue in self._queues.items())
+
+    def _push(self, feed_id, write, priority, cost):
+        """Queue a write, tagged with its finish time. Call with the lock."""
+        key = (priority, feed_id)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = _QueueState()
+        weight = self.weights.get(feed_id, 1)
+        start = max(self._virtual_time[priority], queue.finish)
+        queue.finish = start + float(cost) / weight
+        queue.depth += 1
+        queue.submitted += 1
+        heapq.heappush(self._heaps[priority],
+                       (queue.finish, next(self._sequence), key, write))
+        self._wakeup.notify()
+
+    def _next(self):
+        """Wait for and return the next write to send, or None to stop."""
+        with self._wakeup:
+            while True:
+                for priority in self.PRIORITIES:
+                    heap = self._heaps[priority]
+                    if heap:
+                        finish, _, key, write = heapq.heappop(heap)
+                        self._virtual_time[priority] = finish
+                        self._queues[key].depth -= 1
+                        self.active += 1
+                        return key, write
+                if self._closed:
+                    return None
+                self._wakeup.wait()
+
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                break
+            key, write = item
+            write._run()
+            with self._lock:
+                self.active -= 1
+                self._queues[key].record(write)
+
+
+class ScheduledWrite(object):
+    """A write queued by a :class:`.WriteScheduler`.
+
+    :ivar submitted: Time the write was queued
+    :ivar started: Time the write started being sent
+    :ivar finished: Time the write finished
+
+    """
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._value = None
+        self._error = None
+        self._done = threading.Event()
+
+    def done(self):
+        """Return True once the write has finished."""
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the write to finish and return what it returned.
+
+        The exception the write raised, if any, is raised instead.
+
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("The write has not finished")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _run(self):
+        self.started = time.time()
+        try:
+            self._value = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self._error = e
+        self.finished = time.time()
+        self._done.set()
+
+
+def _raise(error):
+    raise error
+
+
+class _QueueState(object):
+    """The finish tag and counters of one queue of a WriteScheduler."""
+
+    def __init__(self):
+        self.finish = 0.0
+        self.depth = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, write):
+        wait = write.started - write.submitted
+        latency = write.finished - write.submitted
+        if write._error is None:
+            self.completed += 1
+        else:
+            self.failed += 1
+        self.wait += wait
+        self.latency += latency
+        self.max_wait = max(self.max_wait, wait)
+        self.max_latency = max(self.max_latency, latency)
+
+    def metrics(self):
+        finished = self.completed + self.failed
+        return {
+            'depth': self.depth,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'wait': self.wait / finished if finished else 0.0,
+            'max_wait': self.max_wait,
+            'latency': self.latency / finished if finished else 0.0,
+            'max_latency': self.max_latency,
+        }
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+
+from xively.models import Base
+
+
+__all__ = ['Serializer']
+
+
+class Serializer(object):
+    """Encodes models and the data holding them as JSON in a single pass.
+
+    The stdlib encoder calls back into Python for every model, whose
+    ``__getstate__`` builds a new dict to be encoded, and again for every
+    datetime. This serializer instead reads each model's data directly,
+    using a plan compiled for the model's class and the layout of its
+    fields, and skips None fields without building any dicts. A plan
+    checks the classes of the values against those of the first model it
+    was compiled for, so the common case, e.g. datapoints with a datetime
+    and a string, is a single string formatting. Lists of models, e.g. the
+    datapoints of a datastream, are encoded by a plan looping over the
+    whole list.
+
+    The output is the same as :class:`.client.JSONEncoder` gives, which
+    uses a serializer when its options allow it. Models whose
+    ``__getstate__`` is overridden, and any object the serializer does not
+    know, are passed to the encoder's ``default``.
+
+    :param encoder: The :class:`.client.JSONEncoder` to give the same
+        output as
+    :param sort_keys: Sort the keys of objects
+
+    """
+
+    def __init__(self, encoder, sort_keys=False):
+        self.encoder = encoder
+        self.sort_keys = sort_keys
+        # The model classes encoded by plans, and the plans for models and
+        # for lists of models, by class and field layout.
+        self._models = set()
+        self._plans = {}
+        self._runs = {}
+        self._encoders = {
+            type(None): lambda o: 'null',
+            bool: lambda o: 'true' if o else 'false',
+            float: _float,
+            datetime: _datetime,
+            list: self._list,
+            tuple: self._list,
+            dict: self._dict,
+        }
+        for cls in _string_types:
+            self._encoders[cls] = encode_basestring_ascii
+        for cls in _integer_types:
+            self._encoders[cls] = _int
+
+    @classmethod
+    def supports(cls, encoder):
+        """Return True if a serializer gives the same output as encoder."""
+        return (encoder.ensure_ascii and encoder.allow_nan and
+                not encoder.skipkeys and encoder.indent is None and
+                encoder.item_separator == ', ' and
+                encoder.key_separator == ': ')
+
+    def encode(self, o):
+        """Return the JSON text of o."""
+        try:
+            return self._encode(o)
+        except _RecursionError:
+            # Let the encoder report the circular reference.
+            return _json_encode(self.encoder, o)
+
+    def _encode(self, o):
+        encode = self._encoders.get(o.__class__)
+        if encode is None:
+            encode = self._dispatch(o.__class__)
+        return encode(o)
+
+    def _dispatch(self, cls):
+        """Return, and remember, the function encoding instances of cls."""
+        if issubclass(cls, Base):
+            encode = self._model_encoder(cls)
+        elif issubclass(cls, _string_types):
+            encode = encode_basestring_ascii
+        elif issubclass(cls, bool):
+            encode = self._encoders[bool]
+        elif issubclass(cls, _integer_types):
+            encode = _int
+        elif issubclass(cls, float):
+            encode = _float
+        elif issubclass(cls, (list, tuple)):
+            encode = self._list
+        elif issubclass(cls, dict):
+            encode = self._dict
+        else:
+            encode = self._default
+        self._encoders[cls] = encode
+        return encode
+
+    def _default(self, o):
+        return self._encode(self.encoder.default(o))
+
+    def _list(self, o):
+        if o:
+            cls = o[0].__class__
+            if cls not in self._encoders:
+                self._dispatch(cls)
+            if cls in self._models:
+                layout = (cls, tuple(o[0]._data))
+                run = self._runs.get(layout)
+                if run is None:
+                    run = self._runs[layout] = self._plan(
+                        cls, o[0]._data, run=True)
+                return run(o)
+        encoders = self._encoders
+        dispatch = self._dispatch
+        return '[' + ', '.join([
+            (encoders.get(v.__class__) or dispatch(v.__class__))(v)
+            for v in o]) + ']'
+
+    def _dict(self, o):
+        if not all(isinstance(k, _string_types) for k in o):
+            # Keys that are not strings are converted by the encoder.
+            return _json_encode(self.encoder, o)
+        keys = sorted(o) if self.sort_keys else o
+        return '{' + ', '.join([
+            encode_basestring_ascii(k) + ': ' + self._encode(o[k])
+            for k in keys]) + '}'
+
+    def _model_encoder(self, cls):
+        if any('__getstate__' in vars(c) for c in cls.__mro__
+               if c is not Base and issubclass(c, Base)):
+            return self._default
+        self._models.add(cls)
+        plans = self._plans
+
+        def encode(o):
+            data = o._data
+            layout = (cls, tuple(data))
+            plan = plans.get(layout)
+            if plan is None:
+                plan = plans[layout] = self._plan(cls, data)
+            return plan(data)
+        return encode
+
+    def _plan(self, cls, data, run=False):
+        """Compile a function encoding the data of models like this one.
+
+        The function is specific to the class and the names, and order, of
+        the fields in data. It first tries a single format for models
+        whose values have the same classes as those in data, and otherwise
+        encodes each field in turn.
+
+        With run set, the function instead encodes a list of models in a
+        single loop, e.g. the datapoints of a datastream. Each model of the
+        class and field layout is tried with the format first, and any
+        other item is encoded on its own.
+
+        """
+        names = list(data)
+        if not all(isinstance(name, _string_types) for name in names):
+            if run:
+                return lambda items: '[' + ', '.join(
+                    [self._encode(item) for item in items]) + ']'
+            return lambda data: _json_encode(self.encoder, dict(
+                (k, v) for k, v in data.items() if v is not None))
+        layout = tuple(names)
+        if self.sort_keys:
+            names.sort()
+        omit_empty = set(cls._omit_empty)
+        context = {'encoders': self._encoders, 'dispatch': self._dispatch,
+                   'escape': encode_basestring_ascii, 'encode_int': _int,
+                   'encode_float': _float, 'C': cls, 'LAYOUT': layout}
+        reads, guards, formats, values = [], [], [], []
+        for i, name in enumerate(names):
+            v = 'v{}'.format(i)
+            reads.append('{} = data[{!r}]'.format(v, name))
+            key = encode_basestring_ascii(name).replace('%', '%%') + ': '
+            value = data[name]
+            if value is None:
+                guards.append('{} is None'.format(v))
+                continue
+            context['T{}'.format(i)] = value.__class__
+            guards.append('{}.__class__ is T{}'.format(v, i))
+            if name in omit_empty:
+                guards.append(v if value else 'not ' + v)
+                if not value:
+                    continue
+            fmt, expr = _inline(value.__class__, v)
+            formats.append(key + fmt)
+            values.append(expr)
+        guard = ' and '.join(guards) or 'True'
+        fast = '{!r} % ({})'.format('{' + ', '.join(formats) + '}',
+                                    ''.join(value + ', ' for value in values))
+        if run:
+            context['encode'] = self._encode
+            context['model'] = self._encoders[cls]
+            context['fields'] = self._plans.get((cls, layout)) or self._plan(
+                cls, data)
+            lines = ['def plan(items):',
+                     '    parts = []',
+                     '    append = parts.append',
+                     '    for o in items:',
+                     '        if o.__class__ is not C:',
+                     '            append(encode(o))',
+                     '            continue',
+                     '        data = o._data',
+                     '        if tuple(data) != LAYOUT:',
+                     '            append(model(o))',
+                     '            continue']
+            lines += ['        ' + read for read in reads]
+            lines += ['        if {}:'.format(guard),
+                      '            append({})'.format(fast),
+                      '        else:',
+                      '            append(fields(data))',
+                      "    return '[' + ', '.join(parts) + ']'"]
+        else:
+            lines = ['def plan(data):']
+            lines += ['    ' + read for read in reads]
+            lines += ['    if {}:'.format(guard),
+                      '        return ' + fast,
+                      '    parts = []']
+            for i, name in enumerate(names):
+                v = 'v{}'.format(i)
+                condition = '{} is not None'.format(v)
+                if name in omit_empty:
+                    condition += ' and ' + v
+                lines += [
+                    '    if {}:'.format(condition),
+                    '        parts.append({!r} + {})'.format(
+                        encode_basestring_ascii(name) + ': ',
+                        _ENCODE.format(v=v))]
+            lines.append("    return '{' + ', '.join(parts) + '}'")
+        exec(compile('\n'.join(lines), '<plan {}>'.format(cls.__name__),
+                     'exec'), context)
+        return context['plan']
+
+
+def _inline(cls, v):
+    """Return the format and the expression encoding a value of cls."""
+    if cls is datetime:
+        return '"%sZ"', v + '.isoformat()'
+    if cls is bool:
+        return '%s', "('true' if {} else 'false')".format(v)
+    if cls in _string_types:
+        return '%s', 'escape({})'.format(v)
+    if cls in _integer_types:
+        return '%s', 'encode_int({})'.format(v)
+    if cls is float:
+        return '%s', 'encode_float({})'.format(v)
+    return '%s', _ENCODE.format(v=v)
+
+
+def _datetime(o):
+    return '"' + o.isoformat() + 'Z"'
+
+
+def _float(o):
+    # The same as the stdlib encoder, with allow_nan.
+    if o != o:
+        return 'NaN'
+    if o == _INFINITY:
+        return 'Infinity'
+    if o == -_INFINITY:
+        return '-Infinity'
+    return float.__repr__(o)
+
+
+def _json_encode(encoder, o):
+    """Encode o with the stdlib encoder, bypassing any serializer."""
+    import json
+    return json.JSONEncoder.encode(encoder, o)
+
+
+# Encodes the value of a variable v in a plan.
+_ENCODE = '(encoders.get({v}.__class__) or dispatch({v}.__class__))({v})'
+
+_INFINITY = float('inf')
+
+try:
+    _string_types = (str, unicode)
+    _integer_types = (int, long)
+
+    def _int(o):
+        return '%d' % o
+except NameError:
+    _string_types = (str,)
+    _integer_types = (int,)
+    _int = int.__repr__
+
+try:
+    _RecursionError = RecursionError
+except NameError:
+    _RecursionError = RuntimeError
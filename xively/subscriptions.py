@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import threading
+import time
+from collections import deque
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue  # NOQA
+
+
+__all__ = ['Subscription']
+
+
+class Subscription(object):
+    """Watch feeds for new datastream values by polling them.
+
+    Each feed is polled on its own schedule. The interval shrinks towards
+    half the time observed between changes of a feed, grows while a feed
+    stays the same, and is set to ``frozen_interval`` for frozen feeds.
+    Polls are made by a few worker threads sharing the client's connection
+    pool, and no more than ``budget`` polls are started per second.
+
+    The callback is called with the feed and a list of the datastreams whose
+    ``at`` or ``current_value`` changed since the last poll (on the first
+    poll, all of them).
+
+    .. note:: Use :meth:`.FeedsManager.subscribe` to create and start a
+        subscription.
+
+    :param manager: The :class:`.FeedsManager` to poll feeds through
+    :param feed_ids: The IDs of the feeds to watch
+    :param callback: Called as ``callback(feed, datastreams)``
+    :param min_interval: Shortest time in seconds between polls of a feed
+    :param max_interval: Longest time in seconds between polls of a live feed
+    :param frozen_interval: Time in seconds between polls of a frozen feed
+    :param budget: Most polls started per second, across all feeds
+    :param workers: Number of polls made at the same time
+    :param max_errors: Number of recent errors kept in ``errors``
+
+    """
+
+    def __init__(self, manager, feed_ids, callback, min_interval=5,
+                 max_interval=300, frozen_interval=900, budget=10,
+                 workers=4, max_errors=100):
+        self.manager = manager
+        self.callback = callback
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.frozen_interval = frozen_interval
+        self.budget = budget
+        self.workers = workers
+        self.errors = deque(maxlen=max_errors)
+        self._feeds = {}
+        self._schedule = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._cancelled = threading.Event()
+        self._polls = Queue()
+        self._threads = []
+        now = time.time()
+        for feed_id in feed_ids:
+            self._feeds[feed_id] = _FeedState(min_interval)
+            heapq.heappush(self._schedule, (now, feed_id))
+
+    def start(self):
+        """Start polling the feeds in background threads."""
+        threads = [threading.Thread(target=self._dispatch)]
+        threads += [threading.Thread(target=self._work)
+                    for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self._threads = threads
+        return self
+
+    def cancel(self):
+        """Stop polling, waiting for polls in progress to finish."""
+        self._cancelled.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for _ in range(self.workers):
+            self._polls.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def interval(self, feed_id):
+        """Return the current time in seconds between polls of a feed."""
+        return self._feeds[feed_id].interval
+
+    def poll(self, feed_id):
+        """Poll a feed once, deliver its changes and schedule the next poll.
+
+        Errors fetching the feed, or raised by the callback, are added to
+        ``errors`` as ``(feed_id, exception)``, dropping the oldest once
+        ``max_errors`` are kept.
+
+        :returns: The list of changed datastreams
+
+        """
+        state = self._feeds[feed_id]
+        now = time.time()
+        changed = []
+        try:
+            try:
+                feed = self.manager.get(feed_id)
+            except Exception as e:
+                self.errors.append((feed_id, e))
+                state.interval = min(self.max_interval, state.interval * 2)
+                return changed
+            changed = [datastream for datastream in feed.datastreams
+                       if state.update(datastream)]
+            if getattr(feed, 'status', None) == 'frozen':
+                state.interval = self.frozen_interval
+            elif changed:
+                state.changed(now)
+                state.interval = max(self.min_interval, min(
+                    self.max_interval, state.period / 2.0))
+            else:
+                state.interval = min(self.max_interval, state.interval * 1.5)
+            if changed:
+                try:
+                    self.callback(feed, changed)
+                except Exception as e:
+                    self.errors.append((feed_id, e))
+        finally:
+            # The feed is polled again however this poll ended.
+            with self._wakeup:
+                heapq.heappush(self._schedule,
+                               (now + state.interval, feed_id))
+                self._wakeup.notify()
+        return changed
+
+    def _dispatch(self):
+        """Hand feeds to the workers as they become due, within budget."""
+        spacing = 1.0 / self.budget if self.budget else 0
+        while not self._cancelled.is_set():
+            with self._wakeup:
+                if not self._schedule:
+                    self._wakeup.wait()
+                    continue
+                due, feed_id = self._schedule[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+                heapq.heappop(self._schedule)
+            self._polls.put(feed_id)
+            if spacing:
+                self._cancelled.wait(spacing)
+
+    def _work(self):
+        while True:
+            feed_id = self._polls.get()
+            if feed_id is None or self._cancelled.is_set():
+                break
+            self.poll(feed_id)
+
+
+class _FeedState(object):
+    """The last values seen of a feed's datastreams and its update rate."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.period = None
+        self.last_change = None
+        self.values = {}
+
+    def update(self, datastream):
+        """Record a datastream's value, returning True if it changed."""
+        value = (getattr(datastream, 'at', None),
+                 getattr(datastream, 'current_value', None))
+        if self.values.get(datastream.id) == value:
+            return False
+        self.values[datastream.id] = value
+        return True
+
+    def changed(self, now):
+        """Update the average time between changes of the feed."""
+        if self.last_change is not None:
+            gap = now - self.last_change
+            if self.period is None:
+                self.period = gap
+            else:
+                self.period = (self.period + gap) / 2.0
+        self.last_change = now
+        if self.period is None:
+            self.period = self.interval * 2
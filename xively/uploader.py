@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import time
+import zlib
+
+try:
+    from Queue import Empty, Full
+except ImportError:
+    from queue import Empty, Full  # NOQA
+
+
+__all__ = ['ShardedUploader']
+
+
+class ShardedUploader(object):
+    """Upload feed updates from a pool of processes.
+
+    Serialising feeds to JSON is pure Python work, so a single process is
+    limited by the GIL in how many updates per second it can send. The
+    models submitted are pickled as they are, which is cheap, and are
+    encoded as JSON by the workers. Each
+    worker process of a ShardedUploader has its own
+    :class:`.XivelyAPIClient`, and therefore its own connection pool, and
+    every feed is always sent by the same worker so updates of a feed keep
+    their order.
+
+    :param key: A Xively API Key
+    :param processes: Number of worker processes (default: number of CPUs)
+    :param queue_size: Number of updates waiting per worker before
+        :meth:`submit` blocks
+    :type queue_size: int [1000]
+    :param kwargs: Other keyword arguments for each worker's
+        :class:`.XivelyAPIClient`
+
+    Usage::
+
+        >>> import xively
+        >>> uploader = xively.ShardedUploader("API_KEY", processes=4)
+        >>> datastreams = [xively.Datastream(id="3", current_value=1)]
+        >>> uploader.submit(7021, datastreams)  # doctest: +SKIP
+        >>> uploader.close()  # doctest: +SKIP
+        {'sent': 1, 'failed': 0, ...}
+
+    """
+
+    def __init__(self, key, processes=None, queue_size=1000, **kwargs):
+        self.processes = processes or multiprocessing.cpu_count()
+        self._results = multiprocessing.Queue()
+        self._queues = []
+        self._workers = []
+        for shard in range(self.processes):
+            queue = multiprocessing.Queue(maxsize=queue_size)
+            worker = multiprocessing.Process(
+                target=_work, args=(key, kwargs, queue, self._results))
+            worker.daemon = True
+            self._queues.append(queue)
+            self._workers.append(worker)
+        self.metrics = {'sent': 0, 'failed': 0, 'submitted': 0,
+                        'seconds': 0.0, 'errors': []}
+        self._started = False
+
+    def start(self):
+        """Start the worker processes, done by the first :meth:`submit`."""
+        if not self._started:
+            for worker in self._workers:
+                worker.start()
+            self._started = True
+
+    def shard(self, feed_id):
+        """Return the index of the worker that sends updates of a feed."""
+        return zlib.crc32(str(feed_id).encode('utf-8')) % self.processes
+
+    def submit(self, feed_id, datastreams, **fields):
+        """Queue an update of a feed's datastreams and other fields.
+
+        :param feed_id: The ID of the feed to update
+        :param datastreams: A list of :class:`.Datastream` objects, or
+            dicts of datastream fields
+        :param fields: Other feed fields to update
+
+        """
+        self.start()
+        item = (feed_id, list(datastreams), fields)
+        self._queues[self.shard(feed_id)].put(item)
+        self.metrics['submitted'] += 1
+        self.collect()
+
+    def collect(self):
+        """Add the results reported by workers so far to the metrics."""
+        while True:
+            try:
+                result = self._results.get_nowait()
+            except Exception:
+                break
+            self._record(result)
+        return self.metrics
+
+    def close(self):
+        """Wait for all queued updates to be sent and stop the workers.
+
+        A worker that died is not waited for, and is reported in the
+        errors with its exit code. The updates it had not sent are lost.
+
+        :returns: The aggregated metrics of all workers
+
+        """
+        if self._started:
+            for queue, worker in zip(self._queues, self._workers):
+                while worker.is_alive():
+                    try:
+                        queue.put(None, timeout=0.1)
+                        break
+                    except Full:
+                        continue
+            finished = 0
+            while finished < len(self._workers):
+                try:
+                    result = self._results.get(timeout=0.1)
+                except Empty:
+                    # Stop waiting once every worker has exited, having
+                    # finished or died, and all their results are read.
+                    if (not any(w.is_alive() for w in self._workers) and
+                            self._results.empty()):
+                        break
+                    continue
+                if result is None:
+                    finished += 1
+                else:
+                    self._record(result)
+            for shard, worker in enumerate(self._workers):
+                worker.join()
+                if worker.exitcode:
+                    self.metrics['errors'].append((None, (
+                        "Worker {} exited with code {}".format(
+                            shard, worker.exitcode))))
+            self._started = False
+        return self.metrics
+
+    def _record(self, result):
+        feed_id, seconds, error = result
+        self.metrics['seconds'] += seconds
+        if error is None:
+            self.metrics['sent'] += 1
+        else:
+            self.metrics['failed'] += 1
+            self.metrics['errors'].append((feed_id, error))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _work(key, kwargs, queue, results):
+    """Send the feed updates taken from queue until told to stop."""
+    import xively
+    api = xively.XivelyAPIClient(key, **kwargs)
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        feed_id, datastreams, fields = item
+        started = time.time()
+        error = None
+        try:
+            api.feeds.update(feed_id, datastreams=datastreams, **fields)
+        except Exception as e:
+            error = repr(e)
+        results.put((feed_id, time.time() - started, error))
+    results.put(None)